@@ -0,0 +1,284 @@
+""" The ChessArena module plays engine against engine to measure whether a
+change makes the engine stronger. Two engine settings play each other
+from a list of openings, every opening twice with the colors swapped, in a
+pool of processes. The result is given as an Elo difference with a 95%
+error bar, and an optional sequential probability ratio test (SPRT) stops
+the match as soon as the games show which of two Elo hypotheses is true.
+
+An engine is described as comma separated settings:
+    name=new,movetime=0.1,depth=64,hash=16,tablebases=tablebases
+movetime is the time per move in seconds (0 for no limit, then give a
+depth); an engine that takes more than movetime plus the time margin for a
+move loses the game on time.
+
+usage:
+    python ChessArena.py --engine name=fast,movetime=0.1 --engine name=slow,depth=2 --games 200
+    python ChessArena.py --engine movetime=0.2 --engine movetime=0.1 --openings openings.epd --sprt 0 10
+"""
+
+import argparse
+import math
+import multiprocessing
+import time
+import ChessEngine
+import ChessSearch
+import ChessTablebase
+import ChessTransposition
+
+ENGINE_SETTINGS = {'name': str, 'movetime': float, 'depth': int, 'hash': int, 'tablebases': str}
+DEFAULT_ENGINE = {'movetime': 0.1, 'depth': None, 'hash': 16, 'tablebases': None}
+
+
+def parse_engine(text, default_name='engine'):
+    """ turns 'name=new,movetime=0.1' into a dict of engine settings """
+    engine = dict(DEFAULT_ENGINE, name=default_name)
+    for setting in filter(None, text.split(',')):
+        key, _, value = setting.partition('=')
+        if key not in ENGINE_SETTINGS or not value:
+            raise ValueError(f'invalid engine setting: {setting!r}')
+        try:
+            engine[key] = ENGINE_SETTINGS[key](value)
+        except ValueError:
+            raise ValueError(f'invalid engine setting: {setting!r}') from None
+    if engine['movetime'] is not None and engine['movetime'] < 0:
+        raise ValueError('movetime can not be below 0 seconds')
+    if not engine['movetime']:
+        engine['movetime'] = None
+    return engine
+
+
+def _new_searcher(engine):
+    tablebases = ChessTablebase.Tablebases(engine['tablebases']) if engine['tablebases'] else None
+    return ChessSearch.Searcher(ChessTransposition.TranspositionTable(engine['hash']), tablebases=tablebases)
+
+
+def game_over(gamestate, valid_moves, max_plies, plies):
+    """ returns (result, reason) if the game has ended, otherwise None """
+    if not valid_moves:
+        if gamestate.in_check():
+            return ('0-1' if gamestate.whiteTurn else '1-0'), 'checkmate'
+        return '1/2-1/2', 'stalemate'
+    if gamestate.is_threefold_repetition():
+        return '1/2-1/2', 'repetition'
+    if gamestate.is_fifty_move_draw():
+        return '1/2-1/2', 'fifty-move rule'
+    if gamestate.is_insufficient_material():
+        return '1/2-1/2', 'insufficient material'
+    if plies >= max_plies:
+        return '1/2-1/2', 'move limit'
+    return None
+
+
+def play_game(task):
+    """ plays one game in a worker process. task is (index, opening
+    snapshot, white engine, black engine, max plies, time margin), returns
+    (index, result, reason, plies) with the result from white's point of view """
+    index, opening, white, black, max_plies, margin = task
+    gamestate = ChessEngine.GameState.from_snapshot(opening)
+    players = {True: (white, _new_searcher(white)), False: (black, _new_searcher(black))}
+    plies = 0
+    while True:
+        valid_moves = gamestate.get_valid_moves()
+        ending = game_over(gamestate, valid_moves, max_plies, plies)
+        if ending is not None:
+            return (index,) + ending + (plies,)
+        engine, searcher = players[gamestate.whiteTurn]
+        start = time.perf_counter()
+        result = searcher.search(gamestate, depth=engine['depth'], time_limit=engine['movetime'])
+        if engine['movetime'] is not None and time.perf_counter() - start > engine['movetime'] + margin:
+            return index, ('0-1' if gamestate.whiteTurn else '1-0'), 'time forfeit', plies
+        gamestate.move_piece(result.best_move)
+        plies += 1
+
+
+def expected_score(elo):
+    """ the score a player that is elo points stronger is expected to make """
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def elo_difference(score):
+    """ the Elo difference that gives the expected score, score is a fraction from 0 to 1 """
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return 400 * math.log10(score / (1 - score))
+
+
+def _score_and_variance(wins, draws, losses):
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    return score, variance
+
+
+def elo_estimate(wins, draws, losses):
+    """ returns (Elo difference, error) where the true difference lies
+    within the error of the estimate with 95% confidence """
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0, math.inf
+    score, variance = _score_and_variance(wins, draws, losses)
+    # a clean sweep, or games that all ended the same, say nothing about how big the difference is
+    if score in (0, 1) or variance == 0:
+        return elo_difference(score), math.inf
+    margin = 1.96 * math.sqrt(variance / games)
+    error = (elo_difference(score + margin) - elo_difference(score - margin)) / 2
+    return elo_difference(score), error
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    """ returns the log-likelihood ratio of the hypothesis that the
+    difference is elo1 against the hypothesis that it is elo0, with the
+    normal approximation of the game scores """
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0
+    score, variance = _score_and_variance(wins, draws, losses)
+    if variance == 0:
+        return 0.0
+    score0, score1 = expected_score(elo0), expected_score(elo1)
+    return games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+
+def sprt_bounds(alpha=0.05, beta=0.05):
+    """ returns the (lower, upper) bounds of the log-likelihood ratio, the
+    test accepts elo0 below the lower bound and elo1 above the upper one """
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+class Match(object):
+    """ The Match class keeps the score of a match between engine 'first'
+    and engine 'second' from the point of view of the first one. If sprt
+    is (elo0, elo1, alpha, beta), decision() tells when the match can stop.
+    """
+
+    def __init__(self, first, second, sprt=None):
+        self.first = first
+        self.second = second
+        self.sprt = sprt
+        self.wins = self.draws = self.losses = 0
+        self.reasons = {}   # how the games ended -> number of games
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    def add(self, result, first_is_white, reason):
+        if result == '1/2-1/2':
+            self.draws += 1
+        elif (result == '1-0') == first_is_white:
+            self.wins += 1
+        else:
+            self.losses += 1
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def llr(self):
+        elo0, elo1 = self.sprt[:2]
+        return sprt_llr(self.wins, self.draws, self.losses, elo0, elo1)
+
+    def decision(self):
+        """ returns 'H0' (elo0 accepted), 'H1' (elo1 accepted) or None """
+        if self.sprt is None:
+            return None
+        lower, upper = sprt_bounds(*self.sprt[2:])
+        llr = self.llr()
+        if llr <= lower:
+            return 'H0'
+        if llr >= upper:
+            return 'H1'
+        return None
+
+    def summary(self):
+        elo, error = elo_estimate(self.wins, self.draws, self.losses)
+        lines = [f'{self.first["name"]} vs {self.second["name"]}: +{self.wins} ={self.draws} -{self.losses} '
+                 f'({self.games} games)',
+                 f'Elo difference: {elo:.1f} +/- {error:.1f}']
+        if self.sprt is not None:
+            lower, upper = sprt_bounds(*self.sprt[2:])
+            decision = {'H0': f'H0 accepted (elo <= {self.sprt[0]})', 'H1': f'H1 accepted (elo >= {self.sprt[1]})',
+                        None: 'no decision'}[self.decision()]
+            lines.append(f'SPRT: llr {self.llr():.2f} ({lower:.2f}, {upper:.2f}), {decision}')
+        lines.append(', '.join(f'{reason}: {count}' for reason, count in sorted(self.reasons.items())))
+        return '\n'.join(lines)
+
+
+def game_tasks(first, second, openings, games, max_plies, margin):
+    """ yields the games of the match, every opening is played twice with
+    the colors swapped, odd indexes have the second engine as white """
+    for index in range(games):
+        opening = openings[(index // 2) % len(openings)]
+        white, black = (first, second) if index % 2 == 0 else (second, first)
+        yield index, opening, white, black, max_plies, margin
+
+
+def run_match(first, second, openings, games, processes=None, max_plies=300, margin=0.5, sprt=None,
+              report=None):
+    """ plays the match from the openings (a list of GameState.snapshot()
+    positions) and returns the Match. report is called with the Match
+    after every game. The games run in a pool of processes and are counted
+    in the order they finish; the match ends early once the SPRT comes to
+    a decision. """
+    match = Match(first, second, sprt)
+    tasks = game_tasks(first, second, openings, games, max_plies, margin)
+    if processes == 1:
+        results = map(play_game, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(play_game, tasks, chunksize=1)
+    try:
+        for index, result, reason, plies in results:
+            match.add(result, index % 2 == 0, reason)
+            if report is not None:
+                report(match)
+            if match.decision() is not None:
+                break
+    finally:
+        if processes != 1:
+            pool.terminate()
+            pool.join()
+    return match
+
+
+def read_openings(path):
+    """ returns the snapshot of every position of a FEN or EPD file """
+    return [gamestate.snapshot() for gamestate, ops in ChessEngine.read_positions(path)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play a match between two engine settings.')
+    parser.add_argument('--engine', action='append', required=True,
+                        help='engine settings (ex. name=new,movetime=0.1), give two')
+    parser.add_argument('--games', type=int, default=100, help='number of games (default: 100)')
+    parser.add_argument('--openings', help='FEN or EPD file of starting positions (default: the initial position)')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--max-plies', type=int, default=300, help='adjudicate a draw after this many plies')
+    parser.add_argument('--margin', type=float, default=0.5,
+                        help='seconds a move may take over movetime before it loses on time')
+    parser.add_argument('--sprt', type=float, nargs=2, metavar=('ELO0', 'ELO1'),
+                        help='stop when the games show the difference is elo0 or elo1')
+    parser.add_argument('--alpha', type=float, default=0.05, help='SPRT false positive rate')
+    parser.add_argument('--beta', type=float, default=0.05, help='SPRT false negative rate')
+    args = parser.parse_args()
+
+    if len(args.engine) != 2:
+        parser.error('give exactly two --engine settings')
+    first = parse_engine(args.engine[0], 'first')
+    second = parse_engine(args.engine[1], 'second')
+    openings = read_openings(args.openings) if args.openings else [ChessEngine.GameState().snapshot()]
+    if not openings:
+        parser.error(f'no positions in {args.openings}')
+    sprt = (args.sprt[0], args.sprt[1], args.alpha, args.beta) if args.sprt else None
+
+    def report(match):
+        elo, error = elo_estimate(match.wins, match.draws, match.losses)
+        print(f'game {match.games}: +{match.wins} ={match.draws} -{match.losses}, elo {elo:.1f} +/- {error:.1f}',
+              flush=True)
+
+    match = run_match(first, second, openings, args.games, args.processes, args.max_plies, args.margin, sprt,
+                      report)
+    print(match.summary())
+
+
+if __name__ == '__main__':
+    main()
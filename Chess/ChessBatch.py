@@ -0,0 +1,281 @@
+""" The ChessBatch module scores many positions at once with NumPy. The
+positions are packed into an array of shape (N, 12, 8, 8), one plane of
+zeros and ones per piece in the order of ChessEngine.PIECES with the
+squares in gameboard order, or into an (N, 64) array of piece codes
+(0 for an empty square, i + 1 for ChessEngine.PIECES[i]). Every feature
+is then computed for all N positions together with array operations:
+    score       ChessEval.evaluate, from the point of view of the side to move
+    midgame     the middlegame and endgame totals of ChessEval, white
+    endgame     pieces count positive
+    phase       the game phase of ChessEval
+    material    white material minus black material
+    mobility    (N, 2) pseudo-legal moves of white and black (no castling
+                or en passant, a promotion counts once)
+    attacked    (N, 2) squares attacked by white and black
+
+evaluate_position computes the same features for one GameState the
+scalar way, the batch results must always match it.
+
+NumPy is only needed by this module, the rest of the engine runs without it.
+
+usage:
+    python ChessBatch.py positions.epd --batch-size 4096 > scores.csv
+"""
+
+import argparse
+import itertools
+import sys
+import numpy as np
+import ChessEval
+from ChessEngine import (PIECES, KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, ROOK_RAYS, BISHOP_RAYS,
+                         sliding_attacks)
+
+FEATURES = ('score', 'midgame', 'endgame', 'phase', 'material', 'mobility', 'attacked')
+PLANE = {piece: i for i, piece in enumerate(PIECES)}   # piece -> plane index
+FEN_PIECES = {(piece[1] if piece[0] == 'w' else piece[1].lower()): piece for piece in PIECES}
+
+MIDGAME = np.array([ChessEval.MIDGAME_SCORES[piece] for piece in PIECES], dtype=np.int64)  # (12, 64)
+ENDGAME = np.array([ChessEval.ENDGAME_SCORES[piece] for piece in PIECES], dtype=np.int64)
+PHASE = np.array([ChessEval.PHASES[piece] for piece in PIECES], dtype=np.int64)
+MATERIAL = np.array([ChessEval.PIECE_VALUES[piece[1]] * (1 if piece[0] == 'w' else -1) for piece in PIECES],
+                    dtype=np.int64)
+
+ROOK_DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+# the row a pawn lands on after a double push
+DOUBLE_PUSH_ROWS = {color: np.zeros((8, 8), dtype=np.int64) for color in 'wb'}
+DOUBLE_PUSH_ROWS['w'][4] = 1
+DOUBLE_PUSH_ROWS['b'][3] = 1
+
+
+def _attack_matrix(table):
+    """ turns a list of 64 attack bitboards into a (64, 64) matrix with a
+    1 at [from square, attacked square] """
+    return np.array([[table[sq] >> to_sq & 1 for to_sq in range(64)] for sq in range(64)], dtype=np.int64)
+
+
+KNIGHT_MATRIX = _attack_matrix(KNIGHT_ATTACKS)
+KING_MATRIX = _attack_matrix(KING_ATTACKS)
+PAWN_MATRIX = {color: _attack_matrix(PAWN_ATTACKS[color]) for color in 'wb'}
+
+
+def fen_planes(fen, planes):
+    """ fills a (12, 8, 8) array with the pieces of a FEN string and
+    returns True if white is to move. Only the board and the side to
+    move are read, so no GameState has to be built. """
+    fields = fen.split()
+    if len(fields) < 2 or fields[1] not in ('w', 'b'):
+        raise ValueError(f'invalid FEN: {fen!r}')
+    ranks = fields[0].split('/')
+    if len(ranks) != 8:
+        raise ValueError(f'invalid FEN: {fen!r}')
+    for row, rank in enumerate(ranks):
+        col = 0
+        for char in rank:
+            if char in '12345678':
+                col += int(char)
+            elif char in FEN_PIECES and col < 8:
+                planes[PLANE[FEN_PIECES[char]], row, col] = 1
+                col += 1
+            else:
+                raise ValueError(f'invalid FEN: {fen!r}')
+        if col != 8:
+            raise ValueError(f'invalid FEN: {fen!r}')
+    return fields[1] == 'w'
+
+
+def pack_positions(positions):
+    """ packs a list of FEN strings and GameState objects into an
+    (N, 12, 8, 8) uint8 array and an (N,) bool array of white to move """
+    planes = np.zeros((len(positions), 12, 8, 8), dtype=np.uint8)
+    white_to_move = np.zeros(len(positions), dtype=bool)
+    bitboards = np.zeros((len(positions), 12), dtype=np.uint64)
+    from_gamestates = np.zeros(len(positions), dtype=bool)
+    for i, position in enumerate(positions):
+        if isinstance(position, str):
+            white_to_move[i] = fen_planes(position, planes[i])
+        else:
+            bitboards[i] = [position.bitboards[piece] for piece in PIECES]
+            white_to_move[i] = position.whiteTurn
+            from_gamestates[i] = True
+    if from_gamestates.any():
+        # unpack the bitboards of all the GameStates at once, bit sq is square sq
+        bits = (bitboards[from_gamestates, :, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+        planes[from_gamestates] = bits.astype(np.uint8).reshape(-1, 12, 8, 8)
+    return planes, white_to_move
+
+
+def squares_to_planes(squares):
+    """ turns an (N, 64) array of piece codes into (N, 12, 8, 8) planes """
+    squares = np.asarray(squares)
+    codes = np.arange(1, 13).reshape(1, 12, 1)
+    return (squares[:, None, :] == codes).astype(np.uint8).reshape(-1, 12, 8, 8)
+
+
+def planes_to_squares(planes):
+    """ turns (N, 12, 8, 8) planes into an (N, 64) array of piece codes """
+    planes = np.asarray(planes).reshape(-1, 12, 64)
+    return (planes * np.arange(1, 13, dtype=np.uint8).reshape(1, 12, 1)).sum(axis=1).astype(np.uint8)
+
+
+def _shift(boards, dr, dc):
+    """ moves every (8, 8) board of an (N, 8, 8) array dr rows and dc
+    columns, squares moved off the board are lost """
+    shifted = np.zeros_like(boards)
+    shifted[:, max(dr, 0):8 + min(dr, 0), max(dc, 0):8 + min(dc, 0)] = \
+        boards[:, max(-dr, 0):8 + min(-dr, 0), max(-dc, 0):8 + min(-dc, 0)]
+    return shifted
+
+
+def _slider_attacks(sliders, empty, directions):
+    """ returns (N, 8, 8) counts of how many of the sliders attack every
+    square. A ray is followed one square at a time and only continues
+    past empty squares, so it stops on the first piece it hits. """
+    counts = np.zeros_like(sliders)
+    for dr, dc in directions:
+        ray = _shift(sliders, dr, dc)
+        counts += ray
+        for step in range(6):
+            ray = _shift(ray * empty, dr, dc)
+            counts += ray
+    return counts
+
+
+def _side_features(flat, boards, color, own, enemies, empty):
+    """ returns (mobility, attacked squares) of one color as (N,) arrays """
+    offset = 0 if color == 'w' else 6
+    n = flat.shape[0]
+    # every array below counts, for every square, how many pieces of the color attack it
+    pieces = flat[:, offset + PLANE['wN']] @ KNIGHT_MATRIX + flat[:, offset + PLANE['wK']] @ KING_MATRIX
+    rooks = boards[:, offset + PLANE['wR']] + boards[:, offset + PLANE['wQ']]
+    bishops = boards[:, offset + PLANE['wB']] + boards[:, offset + PLANE['wQ']]
+    pieces = pieces + (_slider_attacks(rooks, empty, ROOK_DIRECTIONS) +
+                       _slider_attacks(bishops, empty, BISHOP_DIRECTIONS)).reshape(n, 64)
+    pawn_attacks = flat[:, offset + PLANE['wP']] @ PAWN_MATRIX[color]
+    attacked = ((pieces + pawn_attacks) > 0).sum(axis=1)
+
+    # pawns only move forward onto empty squares and only capture diagonally
+    pawns = boards[:, offset + PLANE['wP']]
+    step = -1 if color == 'w' else 1
+    single = _shift(pawns, step, 0) * empty
+    double = _shift(single, step, 0) * empty * DOUBLE_PUSH_ROWS[color]
+    pawn_moves = single.reshape(n, 64).sum(axis=1) + double.reshape(n, 64).sum(axis=1)
+    pawn_moves += (pawn_attacks * enemies).sum(axis=1)
+    mobility = (pieces * (1 - own)).sum(axis=1) + pawn_moves
+    return mobility, attacked
+
+
+def batch_evaluate(planes, white_to_move):
+    """ computes the features of N positions packed as (N, 12, 8, 8)
+    planes (or (N, 64) piece codes) and returns a dict of arrays, see
+    the module docstring """
+    planes = np.asarray(planes)
+    if planes.ndim == 2:
+        planes = squares_to_planes(planes)
+    n = planes.shape[0]
+    boards = planes.astype(np.int64)
+    flat = boards.reshape(n, 12, 64)
+    counts = flat.sum(axis=2)   # (N, 12) number of every piece
+
+    midgame = np.einsum('npq,pq->n', flat, MIDGAME)
+    endgame = np.einsum('npq,pq->n', flat, ENDGAME)
+    phase = np.minimum(counts @ PHASE, ChessEval.MAX_PHASE)
+    # rounded towards zero like ChessEval.blend, so negative scores round the same way
+    blended = midgame * phase + endgame * (ChessEval.MAX_PHASE - phase)
+    score = np.sign(blended) * (np.abs(blended) // ChessEval.MAX_PHASE)
+    score = np.where(white_to_move, score, -score)
+
+    white = flat[:, :6].sum(axis=1)     # (N, 64) occupancy of white
+    black = flat[:, 6:].sum(axis=1)
+    empty = (1 - white - black).reshape(n, 8, 8)
+    white_mobility, white_attacked = _side_features(flat, boards, 'w', white, black, empty)
+    black_mobility, black_attacked = _side_features(flat, boards, 'b', black, white, empty)
+    return {'score': score, 'midgame': midgame, 'endgame': endgame, 'phase': phase,
+            'material': counts @ MATERIAL,
+            'mobility': np.stack([white_mobility, black_mobility], axis=1),
+            'attacked': np.stack([white_attacked, black_attacked], axis=1)}
+
+
+def evaluate_positions(positions):
+    """ packs and evaluates a list of FEN strings and GameState objects """
+    return batch_evaluate(*pack_positions(positions))
+
+
+def evaluate_position(gamestate):
+    """ computes the features of one GameState the scalar way, square by
+    square with the ChessEngine attack tables. Returns a dict like
+    batch_evaluate with plain numbers instead of arrays. """
+    occupied = gamestate.occupancy['w'] | gamestate.occupancy['b']
+    features = {'score': ChessEval.evaluate(gamestate), 'midgame': gamestate.midgameScore,
+                'endgame': gamestate.endgameScore, 'phase': min(gamestate.gamePhase, ChessEval.MAX_PHASE),
+                'material': 0, 'mobility': [0, 0], 'attacked': [0, 0]}
+    for side, color in enumerate('wb'):
+        own = gamestate.occupancy[color]
+        enemies = occupied & ~own
+        attacked = 0
+        for piece in PIECES:
+            if piece[0] != color:
+                continue
+            bb = gamestate.bitboards[piece]
+            value = ChessEval.PIECE_VALUES[piece[1]] * bin(bb).count('1')
+            features['material'] += value if color == 'w' else -value
+            while bb:
+                bit = bb & -bb
+                bb ^= bit
+                sq = bit.bit_length() - 1
+                if piece[1] == 'P':
+                    attacks = PAWN_ATTACKS[color][sq]
+                    step = -8 if color == 'w' else 8
+                    moves = attacks & enemies
+                    if not occupied >> (sq + step) & 1:
+                        moves |= 1 << (sq + step)
+                        start_row = 6 if color == 'w' else 1
+                        if sq // 8 == start_row and not occupied >> (sq + 2 * step) & 1:
+                            moves |= 1 << (sq + 2 * step)
+                else:
+                    if piece[1] == 'N':
+                        attacks = KNIGHT_ATTACKS[sq]
+                    elif piece[1] == 'K':
+                        attacks = KING_ATTACKS[sq]
+                    else:
+                        attacks = 0
+                        if piece[1] in 'RQ':
+                            attacks |= sliding_attacks(sq, occupied, ROOK_RAYS)
+                        if piece[1] in 'BQ':
+                            attacks |= sliding_attacks(sq, occupied, BISHOP_RAYS)
+                    moves = attacks & ~own
+                attacked |= attacks
+                features['mobility'][side] += bin(moves).count('1')
+        features['attacked'][side] = bin(attacked).count('1')
+    return features
+
+
+def iter_batches(path, batch_size=4096):
+    """ yields (fens, features) for every batch_size positions of a FEN or
+    EPD file, reading the file lazily """
+    with open(path) as file:
+        lines = (line.strip() for line in file)
+        lines = (line for line in lines if line and not line.startswith('#'))
+        while True:
+            fens = [' '.join(line.split()[:4]) for line in itertools.islice(lines, batch_size)]
+            if not fens:
+                return
+            yield fens, evaluate_positions(fens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score the positions of a FEN or EPD file.')
+    parser.add_argument('path', help='the FEN or EPD file')
+    parser.add_argument('--batch-size', type=int, default=4096, help='positions evaluated together')
+    args = parser.parse_args()
+
+    print('fen,score,material,white_mobility,black_mobility,white_attacked,black_attacked')
+    for fens, features in iter_batches(args.path, args.batch_size):
+        for i, fen in enumerate(fens):
+            sys.stdout.write(f'{fen},{features["score"][i]},{features["material"][i]},'
+                             f'{features["mobility"][i, 0]},{features["mobility"][i, 1]},'
+                             f'{features["attacked"][i, 0]},{features["attacked"][i, 1]}\n')
+
+
+if __name__ == '__main__':
+    main()
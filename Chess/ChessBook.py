@@ -0,0 +1,156 @@
+""" The ChessBook module plays the first moves of a game from an opening
+book instead of searching them. A book is a binary file of 16-byte
+records sorted by the Zobrist key of the position:
+    bytes  0-7   position key (GameState.zobristKey), big-endian
+    bytes  8-9   move (see Move.encode)
+    bytes 10-11  weight, how often the move was played
+    bytes 12-15  unused, zero
+The file is opened with mmap and searched with a binary search, so opening
+a book does not read it, and every engine process on a machine shares the
+same copy in the page cache.
+
+usage:
+    python ChessBook.py build games.pgn book.bin --plies 16
+    python ChessBook.py probe book.bin --fen "<fen>"
+"""
+
+import argparse
+import mmap
+import os
+import random
+import struct
+import ChessEngine
+import ChessPGN
+
+RECORD = struct.Struct('>QHHI')
+RECORD_SIZE = RECORD.size   # 16 bytes
+KEY = struct.Struct('>Q')
+MAX_WEIGHT = 0xFFFF
+
+
+class OpeningBook(object):
+    """ The OpeningBook class looks up the book moves of a position. It
+    can be used in a with statement to close the file afterwards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size % RECORD_SIZE:
+            self.file.close()
+            raise ValueError(f'{path} is not an opening book, its size is not a multiple of {RECORD_SIZE}')
+        self.count = size // RECORD_SIZE
+        # mmap can not map an empty file
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _first_record(self, key):
+        """ returns the index of the first record with a key of at least key """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.data, middle * RECORD_SIZE)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def entries(self, gamestate):
+        """ returns the book moves of the position as a list of (Move(),
+        weight) tuples. Moves that are not legal in the position (from a
+        Zobrist key collision or a damaged book) are left out. """
+        key = gamestate.zobristKey
+        valid_moves = {move.encode(): move for move in gamestate.get_valid_moves()}
+        entries = []
+        for index in range(self._first_record(key), self.count):
+            record_key, code, weight, _ = RECORD.unpack_from(self.data, index * RECORD_SIZE)
+            if record_key != key:
+                break
+            if code in valid_moves:
+                entries.append((valid_moves[code], weight))
+        return entries
+
+    def choose_move(self, gamestate, best=False):
+        """ returns a book move for the position or None when the book has
+        none. The move is picked at random with the weights as odds, or the
+        move with the highest weight if best is True. """
+        entries = [(move, weight) for move, weight in self.entries(gamestate) if weight > 0]
+        if not entries:
+            return None
+        if best:
+            return max(entries, key=lambda entry: entry[1])[0]
+        return random.choices([move for move, weight in entries], [weight for move, weight in entries])[0]
+
+
+def write_book(path, counts):
+    """ writes a book file from a dict of (key, move code) -> weight """
+    with open(path, 'wb') as file:
+        for (key, code), weight in sorted(counts.items()):
+            file.write(RECORD.pack(key, code, min(weight, MAX_WEIGHT), 0))
+
+
+def build_book(pgn_path, book_path, plies=16, min_weight=1):
+    """ builds a book from the first plies moves of every game of a PGN
+    file. A move gets 2 points for every game its side won and 1 for every
+    draw, so the book prefers moves that scored well; moves with less than
+    min_weight points are left out. Returns the number of records. """
+    counts = {}
+    points = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1)}
+    for game in ChessPGN.iter_games(pgn_path):
+        if game.result not in points or 'FEN' in game.headers:
+            continue
+        white_points, black_points = points[game.result]
+        gamestate = ChessEngine.GameState()
+        for move in game.moves[:plies]:
+            weight = white_points if gamestate.whiteTurn else black_points
+            if weight:
+                entry = (gamestate.zobristKey, move.encode())
+                counts[entry] = counts.get(entry, 0) + weight
+            gamestate.move_piece(move)
+    counts = {entry: weight for entry, weight in counts.items() if weight >= min_weight}
+    write_book(book_path, counts)
+    return len(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or look up a chess opening book.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build a book from a PGN file')
+    build.add_argument('pgn', help='the PGN file')
+    build.add_argument('book', help='the book file to write')
+    build.add_argument('--plies', type=int, default=16, help='number of moves of every game to use')
+    build.add_argument('--min-weight', type=int, default=1, help='leave out moves with fewer points')
+    probe = commands.add_parser('probe', help='show the book moves of a position')
+    probe.add_argument('book', help='the book file')
+    probe.add_argument('--fen', default=ChessEngine.STARTING_FEN, help='the position (default: the starting position)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        records = build_book(args.pgn, args.book, args.plies, args.min_weight)
+        print(f'wrote {records} moves to {args.book}')
+    else:
+        gamestate = ChessEngine.GameState.from_fen(args.fen)
+        with OpeningBook(args.book) as book:
+            entries = book.entries(gamestate)
+            for move, weight in sorted(entries, key=lambda entry: -entry[1]):
+                print(f'{ChessPGN.move_to_san(gamestate, move)}: {weight}')
+            if not entries:
+                print('no book moves')
+
+
+if __name__ == '__main__':
+    main()
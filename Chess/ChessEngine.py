@@ -1,209 +1,562 @@
 """ The ChessEngine class is responsible for storing game info. It will also
 store and apply the moves that pieces can make. Lastly, it will store a
 move log (the backend).
+
+The board is stored twice: as bitboards (one 64-bit int per piece type and
+color) which the move generators work on, and as the 8x8 gameboard list
+which the frontend draws from. Both are kept in sync by move_piece and
+undo_move.
+
+Every position also has a 64-bit Zobrist key: the XOR of a random number
+for every piece on its square, the side to move, the castle rights and the
+en passant file. move_piece and undo_move update it by XOR-ing only the
+parts that change, so it can be used to look positions up in caches.
+The material and piece-square scores of ChessEval are kept up to date the
+same way, so a position can be evaluated without scanning the board.
+
+Positions can be read from and written to FEN strings, and read_positions
+streams positions out of FEN or EPD files one line at a time. A position
+can also be packed into a 71-byte snapshot with GameState.snapshot(), which
+is cheaper to make, restore and send to another process than a FEN string
+or a copy of the GameState with its move log.
 """
 
+import random
+import struct
+from ChessEval import MIDGAME_SCORES, ENDGAME_SCORES, PHASES
+
+# squares are numbered row * 8 + col, so square 0 is the top-left corner
+# of the gameboard (a8) and square 63 is the bottom-right corner (h1)
+FULL_BOARD = (1 << 64) - 1
+PIECES = ('wP', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bP', 'bN', 'bB', 'bR', 'bQ', 'bK')
+# the (x, y) position of every square, in the form the Move class takes it
+SQUARE_POS = [(sq % 8, sq // 8) for sq in range(64)]
+# the pieces a pawn can be promoted to
+PROMOTION_PIECES = ('Q', 'R', 'B', 'N')
+# the flags stored in the top 4 bits of an encoded move (see Move.encode)
+FLAG_PROMOTIONS = {'Q': 1, 'R': 2, 'B': 3, 'N': 4}
+FLAG_ENPASSANT = 5
+FLAG_CASTLE = 6
+# castle rights are stored as bits of one number, in the order of CastleRights.get_index()
+CASTLE_WKS, CASTLE_BKS, CASTLE_WQS, CASTLE_BQS = 1, 2, 4, 8
+# the castle rights that survive a move from or to each square: moving the
+# king or a rook from its starting square, or capturing a rook there, ends them
+CASTLE_RIGHTS_MASK = [15] * 64
+CASTLE_RIGHTS_MASK[0] = 15 ^ CASTLE_BQS     # a8
+CASTLE_RIGHTS_MASK[4] = 15 ^ CASTLE_BKS ^ CASTLE_BQS    # e8
+CASTLE_RIGHTS_MASK[7] = 15 ^ CASTLE_BKS     # h8
+CASTLE_RIGHTS_MASK[56] = 15 ^ CASTLE_WQS    # a1
+CASTLE_RIGHTS_MASK[60] = 15 ^ CASTLE_WKS ^ CASTLE_WQS   # e1
+CASTLE_RIGHTS_MASK[63] = 15 ^ CASTLE_WKS    # h1
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+FEN_CASTLE_RIGHTS = (('K', CASTLE_WKS), ('Q', CASTLE_WQS), ('k', CASTLE_BKS), ('q', CASTLE_BQS))
+# the squares (row, col) the king and the rook of every castle right start on
+CASTLE_HOME_SQUARES = ((CASTLE_WKS, 'wK', (7, 4), 'wR', (7, 7)), (CASTLE_WQS, 'wK', (7, 4), 'wR', (7, 0)),
+                       (CASTLE_BKS, 'bK', (0, 4), 'bR', (0, 7)), (CASTLE_BQS, 'bK', (0, 4), 'bR', (0, 0)))
+# a snapshot is one byte per square (0 for empty, 1-12 for PIECES), then
+# the side to move, the castle rights, the en passant square (64 for none),
+# the halfmove clock and the move number
+SNAPSHOT = struct.Struct('>64sBBBHH')
+SNAPSHOT_PIECES = ('--',) + PIECES
+SNAPSHOT_CODES = {piece: code for code, piece in enumerate(SNAPSHOT_PIECES)}
+NO_SQUARE = 64
+
+
+def _leaper_attacks(offsets):
+    """ builds a table of the squares a piece that jumps by the given
+    (row, col) offsets attacks from every square of the board """
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        bb = 0
+        for dr, dc in offsets:
+            if 0 <= r + dr <= 7 and 0 <= c + dc <= 7:
+                bb |= 1 << ((r + dr) * 8 + c + dc)
+        table.append(bb)
+    return table
+
+
+def _ray(sq, direction):
+    """ returns every square from sq (exclusive) to the edge of the board
+    in the given (row, col) direction """
+    r, c = divmod(sq, 8)
+    bb = 0
+    while True:
+        r += direction[0]
+        c += direction[1]
+        if r > 7 or c > 7 or r < 0 or c < 0:
+            return bb
+        bb |= 1 << (r * 8 + c)
+
+
+# random numbers for the Zobrist keys, the fixed seed keeps the keys the same
+# between runs so they can be stored in files
+_zobrist_random = random.Random(2020)
+ZOBRIST_PIECES = {piece: [_zobrist_random.getrandbits(64) for sq in range(64)] for piece in PIECES}
+ZOBRIST_BLACK_TURN = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLE = [_zobrist_random.getrandbits(64) for i in range(16)]  # indexed by CastleRights.get_index()
+ZOBRIST_ENPASSANT = [_zobrist_random.getrandbits(64) for col in range(8)]
+
+KNIGHT_ATTACKS = _leaper_attacks([(1, 2), (-1, 2), (1, -2), (-1, -2), (2, 1), (-2, 1), (2, -1), (-2, -1)])
+KING_ATTACKS = _leaper_attacks([(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)])
+# squares attacked by a pawn of the given color (white pawns move up the board)
+PAWN_ATTACKS = {'w': _leaper_attacks([(-1, 1), (-1, -1)]),
+                'b': _leaper_attacks([(1, 1), (1, -1)])}
+
+# a sliding ray is stored with a flag telling if the square numbers grow
+# along it, the first blocker on such a ray is its lowest set bit,
+# otherwise it is the highest set bit
+ROOK_RAYS = [([_ray(sq, d) for sq in range(64)], d[0] * 8 + d[1] > 0)
+             for d in [(1, 0), (-1, 0), (0, 1), (0, -1)]]
+BISHOP_RAYS = [([_ray(sq, d) for sq in range(64)], d[0] * 8 + d[1] > 0)
+               for d in [(1, 1), (1, -1), (-1, 1), (-1, -1)]]
+# every square a rook or bishop could reach from a square on an empty board
+ROOK_LINES = [sum(table[sq] for table, positive in ROOK_RAYS) for sq in range(64)]
+BISHOP_LINES = [sum(table[sq] for table, positive in BISHOP_RAYS) for sq in range(64)]
+
+
+def _between_table():
+    """ builds a 64x64 table of the squares strictly between two squares
+    that share a line, squares that do not share a line have nothing between them """
+    table = [[0] * 64 for sq in range(64)]
+    for rays, positive in ROOK_RAYS + BISHOP_RAYS:
+        for sq in range(64):
+            between = 0
+            ray = rays[sq]
+            while ray:
+                # walk the ray outward from sq one square at a time
+                bit = ray & -ray if positive else 1 << (ray.bit_length() - 1)
+                ray ^= bit
+                table[sq][bit.bit_length() - 1] = between
+                between |= bit
+    return table
+
+
+BETWEEN = _between_table()
+
+
+def sliding_attacks(sq, occupied, rays):
+    """ returns the squares a sliding piece on sq attacks. Every ray is
+    cut off after the first occupied square on it, which is included
+    since it may be a capture. """
+    attacks = 0
+    for table, positive in rays:
+        ray = table[sq]
+        blockers = ray & occupied
+        if blockers:
+            if positive:
+                first = (blockers & -blockers).bit_length() - 1
+            else:
+                first = blockers.bit_length() - 1
+            ray ^= table[first]
+        attacks |= ray
+    return attacks
+
+
 class GameState(object):
     """ The Gamestate class saves the state of the game (duh!). Is used
     to keep track of when the game will end and which pieces can move
     where.
     """
+    # the move generator of every piece type, looked up by name on every
+    # call so a method replaced on the class (see ChessProfile) is used
+    generatorFunctions = {
+        'P': '_generate_pawn_moves', 'R': '_generate_rook_moves',
+        'N': '_generate_knight_moves', 'B': '_generate_bishop_moves',
+        'K': '_generate_king_moves', 'Q': '_generate_queen_moves'}
 
-    def __init__(self):
+    def __init__(self, fen=STARTING_FEN):
         # gameboard is a 2d list
         # pieces are named by color (lowercase) and type (uppercase)
         # empty pieces are named '--'
-        self.generatorFunctions = {
-            'P': self._generate_pawn_moves, 'R': self._generate_rook_moves,
-            'N': self._generate_knight_moves, 'B': self._generate_bishop_moves,
-            'K': self._generate_king_moves, 'Q': self._generate_queen_moves}
-        self.gameboard = [
-            ['bR', 'bN', 'bB', 'bQ', 'bK', 'bB', 'bN', 'bR'],
-            ['bP' for i in range(8)],
-            ['--' for i in range(8)],
-            ['--' for i in range(8)],
-            ['--' for i in range(8)],
-            ['--' for i in range(8)],
-            ['wP' for i in range(8)],
-            ['wR', 'wN', 'wB', 'wQ', 'wK', 'wB', 'wN', 'wR']]
-        self.whiteTurn = True
-        self.moveLog = []  # a list of Move() objects
-        self.piecesCaptured = []  # a list of str of all captured pieces
-        self.wKLocation = (7, 4)    # white king pos stored as (row, col)
-        self.bKLocation = (0, 4)    # black king pos stored as (row, col)
-        self.enpassantSquare = ()   # the square where a en passant capture is possible
-        # keep track of castle rights
-        self.currentCastleRights = CastleRights(True, True, True, True)
-        self.castleRightsLog = [CastleRights(True, True, True, True)]
+        if fen is not None:  # from_snapshot sets the position up itself
+            self.load_fen(fen)
+
+    @classmethod
+    def from_fen(cls, fen):
+        """ returns a new GameState set up from a FEN string """
+        return cls(fen)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """ returns a new GameState set up from a snapshot() """
+        gamestate = cls(None)
+        gamestate.restore(snapshot)
+        return gamestate
 
     def reset_gamestate(self):
-        self.gameboard = [
-            ['bR', 'bN', 'bB', 'bQ', 'bK', 'bB', 'bN', 'bR'],
-            ['bP' for i in range(8)],
-            ['--' for i in range(8)],
-            ['--' for i in range(8)],
-            ['--' for i in range(8)],
-            ['--' for i in range(8)],
-            ['wP' for i in range(8)],
-            ['wR', 'wN', 'wB', 'wQ', 'wK', 'wB', 'wN', 'wR']]
-        self.whiteTurn = True
-        self.moveLog = []
-        self.piecesCaptured = []
-        self.wKLocation = (7, 4)
-        self.bKLocation = (0, 4)
-        self.enpassantSquare = ()
-        self.currentCastleRights = CastleRights(True, True, True, True)
-        self.castleRightsLog = [CastleRights(True, True, True, True)]
+        self.load_fen(STARTING_FEN)
+
+    def load_fen(self, fen):
+        """ sets up the position described by a FEN string, raises a
+        ValueError if the string is not a valid position. The halfmove
+        clock and move number fields may be left out, as in EPD. """
+        fields = fen.split()
+        ranks = fields[0].split('/') if fields else []
+        if len(fields) < 2 or len(ranks) != 8 or fields[1] not in ('w', 'b'):
+            raise ValueError(f'invalid FEN: {fen!r}')
+        board = []
+        for rank in ranks:
+            row = []
+            for char in rank:
+                if char in '12345678':
+                    row.extend(['--'] * int(char))
+                elif char.upper() in 'PNBRQK':
+                    row.append(('w' if char.isupper() else 'b') + char.upper())
+                else:
+                    raise ValueError(f'invalid FEN: {fen!r}')
+            if len(row) != 8:
+                raise ValueError(f'invalid FEN: {fen!r}')
+            board.append(row)
+        enpassant_square = ()
+        if len(fields) > 3 and fields[3] != '-':
+            # a pawn can only be taken en passant on the 3rd or 6th rank
+            enpassant = fields[3]
+            if len(enpassant) != 2 or enpassant[0] not in 'abcdefgh' or enpassant[1] not in '36':
+                raise ValueError(f'invalid en passant square in FEN: {fen!r}')
+            enpassant_square = (8 - int(enpassant[1]), ord(enpassant[0]) - ord('a'))
+        castle_rights = 0
+        castling = fields[2] if len(fields) > 2 else '-'
+        if castling != '-':
+            if not castling or any(char not in 'KQkq' or castling.count(char) > 1 for char in castling):
+                raise ValueError(f'invalid castling rights in FEN: {fen!r}')
+            for char, right in FEN_CASTLE_RIGHTS:
+                if char in castling:
+                    castle_rights |= right
+        clocks = fields[4:6]
+        if not all(clock.isdigit() for clock in clocks):
+            raise ValueError(f'invalid halfmove clock or move number in FEN: {fen!r}')
+        halfmove_clock = int(clocks[0]) if len(clocks) > 0 else 0
+        fullmove_number = int(clocks[1]) if len(clocks) > 1 else 1
+        try:
+            self.set_position(board, fields[1] == 'w', castle_rights, enpassant_square, halfmove_clock, fullmove_number)
+        except ValueError:
+            raise ValueError(f'FEN needs exactly one king of each color: {fen!r}') from None
+
+    def snapshot(self):
+        """ returns the position packed into 71 bytes (see SNAPSHOT). Like a
+        FEN string it holds the position only, not the moves that led to it. """
+        codes = SNAPSHOT_CODES
+        board = bytes([codes[piece] for row in self.gameboard for piece in row])
+        enpassant = self.enpassantSquare[0] * 8 + self.enpassantSquare[1] if self.enpassantSquare else NO_SQUARE
+        return SNAPSHOT.pack(board, self.whiteTurn, self.castleRights, enpassant,
+                             self.halfmoveClock, self.fullmoveNumber)
+
+    def restore(self, snapshot):
+        """ sets up the position of a snapshot(), raises a ValueError if it
+        is not a valid snapshot. The move log starts over, like load_fen. """
+        try:
+            board, white_turn, castle_rights, enpassant, halfmove_clock, fullmove_number = SNAPSHOT.unpack(snapshot)
+        except (struct.error, TypeError):
+            raise ValueError(f'invalid snapshot: {snapshot!r}') from None
+        if max(board) >= len(SNAPSHOT_PIECES) or castle_rights > 15 or enpassant > NO_SQUARE:
+            raise ValueError(f'invalid snapshot: {snapshot!r}')
+        pieces = [SNAPSHOT_PIECES[code] for code in board]
+        self.set_position([pieces[row * 8:row * 8 + 8] for row in range(8)], bool(white_turn), castle_rights,
+                          divmod(enpassant, 8) if enpassant != NO_SQUARE else (), halfmove_clock, fullmove_number)
+
+    def set_position(self, board, white_turn, castle_rights, enpassant_square=(), halfmove_clock=0,
+                     fullmove_number=1):
+        """ sets up a position from a 2d list of pieces and the rest of the
+        state, with an empty move log. Raises a ValueError if either side
+        does not have exactly one king. Castle rights whose king or rook is
+        not on its starting square are dropped. """
+        self.load_board(board)
+        if bin(self.bitboards['wK']).count('1') != 1 or bin(self.bitboards['bK']).count('1') != 1:
+            raise ValueError('a position needs exactly one king of each color')
+        for right, king, (king_row, king_col), rook, (rook_row, rook_col) in CASTLE_HOME_SQUARES:
+            if self.gameboard[king_row][king_col] != king or self.gameboard[rook_row][rook_col] != rook:
+                castle_rights &= ~right
+
+        self.whiteTurn = white_turn
+        self.moveLog = []  # a list of Move() objects
+        self.piecesCaptured = []  # a list of str of the captured pieces, in the order they were taken
+        self.update_kings_position()    # king positions stored as (row, col) in wKLocation and bKLocation
+        # the square where a en passant capture is possible
+        self.enpassantSquare = enpassant_square
+        # keep track of castle rights, as CASTLE_* bits
+        self.castleRights = castle_rights
+        # moves since the last capture or pawn move, and the number of the current move
+        self.halfmoveClock = halfmove_clock
+        self.fullmoveNumber = fullmove_number
+        # the state move_piece cannot rebuild from the move itself, one
+        # (captured piece, castle rights, enpassant square, halfmove clock) tuple per move
+        self.stateLog = []
+        self.zobristKey = self.compute_zobrist_key()
+        # the Zobrist key of the position before every move, to find repetitions
+        self.zobristHistory = []
+
+    def to_fen(self):
+        """ returns the position as a FEN string """
+        ranks = []
+        for row in self.gameboard:
+            rank = ''
+            empty = 0
+            for piece in row:
+                if piece == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1] if piece[0] == 'w' else piece[1].lower()
+            ranks.append(rank + (str(empty) if empty else ''))
+        castling = ''.join(char for char, right in FEN_CASTLE_RIGHTS if self.castleRights & right) or '-'
+        enpassant = '-'
+        if self.enpassantSquare:
+            enpassant = Move.y_to_rank[self.enpassantSquare[1]] + Move.x_to_file[self.enpassantSquare[0]]
+        return ' '.join(['/'.join(ranks), 'w' if self.whiteTurn else 'b', castling, enpassant,
+                         str(self.halfmoveClock), str(self.fullmoveNumber)])
+
+    @property
+    def currentCastleRights(self):
+        """ the castle rights as a CastleRights object """
+        return CastleRights.from_index(self.castleRights)
+
+    @currentCastleRights.setter
+    def currentCastleRights(self, rights):
+        self.castleRights = rights.get_index()
+
+    def compute_zobrist_key(self):
+        """ computes the Zobrist key of the position from scratch """
+        key = 0
+        for piece in PIECES:
+            bb = self.bitboards[piece]
+            while bb:
+                bit = bb & -bb
+                bb ^= bit
+                key ^= ZOBRIST_PIECES[piece][bit.bit_length() - 1]
+        if not self.whiteTurn:
+            key ^= ZOBRIST_BLACK_TURN
+        return key ^ self._castle_and_enpassant_key()
+
+    def _castle_and_enpassant_key(self):
+        """ returns the part of the Zobrist key for the castle rights and the en passant square """
+        key = ZOBRIST_CASTLE[self.castleRights]
+        if self.enpassantSquare:
+            key ^= ZOBRIST_ENPASSANT[self.enpassantSquare[1]]
+        return key
+
+    def load_board(self, board):
+        """ sets up the gameboard and the bitboards from a 2d list of
+        pieces. Every piece has a bitboard with a bit set for each square
+        it stands on, and occupancy holds every square taken by a color.
+        The Zobrist key only covers the pieces until compute_zobrist_key
+        is called with the rest of the position set up. """
+        self.gameboard = [['--'] * 8 for row in range(8)]
+        self.bitboards = {piece: 0 for piece in PIECES}
+        self.occupancy = {'w': 0, 'b': 0}
+        self.zobristKey = 0
+        # the evaluation totals of ChessEval, white pieces count positive
+        self.midgameScore = 0
+        self.endgameScore = 0
+        self.gamePhase = 0
+        for sq in range(64):
+            piece = board[sq // 8][sq % 8]
+            if piece != '--':
+                self._put_piece(piece, sq)
+
+    def _put_piece(self, piece, sq):
+        """ places a piece on an empty square """
+        self.gameboard[sq >> 3][sq & 7] = piece
+        self.bitboards[piece] |= 1 << sq
+        self.occupancy[piece[0]] |= 1 << sq
+        self.zobristKey ^= ZOBRIST_PIECES[piece][sq]
+        self.midgameScore += MIDGAME_SCORES[piece][sq]
+        self.endgameScore += ENDGAME_SCORES[piece][sq]
+        self.gamePhase += PHASES[piece]
+
+    def _remove_piece(self, piece, sq):
+        """ removes the piece standing on sq """
+        self.gameboard[sq >> 3][sq & 7] = '--'
+        self.bitboards[piece] ^= 1 << sq
+        self.occupancy[piece[0]] ^= 1 << sq
+        self.zobristKey ^= ZOBRIST_PIECES[piece][sq]
+        self.midgameScore -= MIDGAME_SCORES[piece][sq]
+        self.endgameScore -= ENDGAME_SCORES[piece][sq]
+        self.gamePhase -= PHASES[piece]
 
     def update_kings_position(self):
-        for row in range(len(self.gameboard)):
-            for col in range(len(self.gameboard[row])):
-                if self.gameboard[row][col][1] == 'K':
-                    if self.gameboard[row][col][0] == 'w':
-                        self.wKLocation = (row, col)
-                    else:
-                        self.bKLocation = (row, col)
+        """ reads the king positions from the king bitboards, it is only
+        needed after setting up a board since move_piece and undo_move
+        keep the positions up to date themselves """
+        if self.bitboards['wK']:
+            self.wKLocation = divmod(self.bitboards['wK'].bit_length() - 1, 8)
+        if self.bitboards['bK']:
+            self.bKLocation = divmod(self.bitboards['bK'].bit_length() - 1, 8)
 
     def move_piece(self, move):
         """ Takes a move as a parameter and executes it. It takes the special cases from
-        pawn promotion, castling and en passant. """
-        self.gameboard[move.start_row][move.start_col] = '--'  # set the starting position empty
-        if move.pieceCaptured not in self.piecesCaptured:
-            self.piecesCaptured.append(move.pieceCaptured)  # add captured piece to piecesCaptured
-        self.gameboard[move.end_row][move.end_col] = move.pieceMoved  # set the ending position to the moved piece
-        self.moveLog.append(move)  # add move to move log
-
-        # action for pawn promotion
-        if move.isPawnPromotion:
-            self.gameboard[move.end_row][move.end_col] = move.pieceMoved[0] + move.promotion_piece
+        pawn promotion, castling and en passant. Everything undo_move needs
+        that the move does not hold is pushed onto stateLog as one record. """
+        start = move.start_row * 8 + move.start_col
+        end = move.end_row * 8 + move.end_col
+        self.stateLog.append((move.pieceCaptured, self.castleRights, self.enpassantSquare, self.halfmoveClock))
+        self.zobristHistory.append(self.zobristKey)
+        # the old castle rights and en passant square are taken out of the key
+        self.zobristKey ^= self._castle_and_enpassant_key()
+        self._remove_piece(move.pieceMoved, start)  # set the starting position empty
+        if move.pieceCaptured != '--':
+            self.piecesCaptured.append(move.pieceCaptured)  # add captured piece to piecesCaptured, undo_move takes it off
 
         # action for en passant
         if move.enPassantMove:
             # setting the captured piece to the pawn is handled by the Move class
             # delete the piece after capturing it in en passant
-            self.gameboard[move.start_row][move.end_col] = '--'
+            self._remove_piece(move.pieceCaptured, move.start_row * 8 + move.end_col)
+        elif move.pieceCaptured != '--':
+            self._remove_piece(move.pieceCaptured, end)
+
+        # action for pawn promotion
+        if move.isPawnPromotion:
+            self._put_piece(move.pieceMoved[0] + move.promotion_piece, end)
+        else:
+            self._put_piece(move.pieceMoved, end)  # set the ending position to the moved piece
+        self.moveLog.append(move)  # add move to move log
 
         # action for castle move
         if move.isCastle:
-            color = 'w' if self.whiteTurn else 'b'
+            rook = move.pieceMoved[0] + 'R'
             if move.end_col == move.start_col + 2:  # the castle is kingside
                 # move the rook to the new position
-                self.gameboard[move.end_row][move.end_col - 1] = color + 'R'
-                # replace the old rook position as empty
-                self.gameboard[move.end_row][move.end_col + 1] = '--'
+                self._remove_piece(rook, end + 1)
+                self._put_piece(rook, end - 1)
             else:   # the castle is queenside
                 # move the rook to the new position
-                self.gameboard[move.end_row][move.end_col + 1] = color + 'R'
-                # replace the old rook position as empty
-                self.gameboard[move.end_row][move.end_col - 2] = '--'
+                self._remove_piece(rook, end - 2)
+                self._put_piece(rook, end + 1)
+
+        # create an enpassant square if a pawn moved two squares, otherwise reset it
+        if move.pieceMoved[1] == 'P' and abs(move.start_row - move.end_row) == 2:
+            self.enpassantSquare = ((move.start_row + move.end_row) // 2, move.start_col)
+        else:
+            self.enpassantSquare = ()
+
+        # the halfmove clock restarts after a capture or pawn move
+        if move.pieceMoved[1] == 'P' or move.pieceCaptured != '--':
+            self.halfmoveClock = 0
+        else:
+            self.halfmoveClock += 1
 
         # update castling rights whenever a king or a rook is moved
         self.update_castle_rights(move)
+        self.zobristKey ^= self._castle_and_enpassant_key() ^ ZOBRIST_BLACK_TURN
 
-        self.update_kings_position()    # update king pos
+        # update king pos, only a king move can change it
+        if move.pieceMoved == 'wK':
+            self.wKLocation = (move.end_row, move.end_col)
+        elif move.pieceMoved == 'bK':
+            self.bKLocation = (move.end_row, move.end_col)
+        if not self.whiteTurn:
+            self.fullmoveNumber += 1
         self.whiteTurn = not self.whiteTurn  # switch the turn
 
 
     def undo_move(self):
-        """ This will undo the last move made"""
+        """ This will undo the last move made, the state that changed is
+        restored from the record move_piece pushed onto stateLog """
         if len(self.moveLog) > 0:
             move = self.moveLog.pop()  # remove move from log
-            self.gameboard[move.start_row][move.start_col] = move.pieceMoved  # replace moved piece
-            self.gameboard[move.end_row][move.end_col] = move.pieceCaptured  # replaced captured piece
+            captured, castle_rights, enpassant_square, halfmove_clock = self.stateLog.pop()
+            self.zobristHistory.pop()
+            if captured != '--':
+                self.piecesCaptured.pop()
+            start = move.start_row * 8 + move.start_col
+            end = move.end_row * 8 + move.end_col
+            self.zobristKey ^= self._castle_and_enpassant_key()
+            # take the moved (or promoted) piece off its end square
+            self._remove_piece(self.gameboard[move.end_row][move.end_col], end)
+            self._put_piece(move.pieceMoved, start)  # replace moved piece
 
             if move.enPassantMove:  # undo en passant move
                 # replace the piece that was captured
-                if self.whiteTurn:
-                    self.gameboard[move.end_row - 1][move.end_col] = 'wP'
-                else:
-                    self.gameboard[move.end_row + 1][move.end_col] = 'bP'
-                # reset the enpassant square to what it was before
-                self.enpassantSquare = (move.end_row, move.end_col)
+                self._put_piece(captured, move.start_row * 8 + move.end_col)
+            elif captured != '--':
+                self._put_piece(captured, end)  # replaced captured piece
 
             if move.isCastle:   # undo castle move
-                color = 'w' if not self.whiteTurn else 'b'
+                rook = move.pieceMoved[0] + 'R'
                 if move.end_col == move.start_col + 2:  # the castle is kingside
-                    # set the previous rook location empty
-                    self.gameboard[move.end_row][move.end_col - 1] = '--'
                     # replace the old rook position with the rook
-                    self.gameboard[move.end_row][move.end_col + 1] = color + 'R'
+                    self._remove_piece(rook, end - 1)
+                    self._put_piece(rook, end + 1)
                 else:  # the castle is queenside
-                    # set the previous rook location empty
-                    self.gameboard[move.end_row][move.end_col + 1] = '--'
                     # replace the old rook position with the rook
-                    self.gameboard[move.end_row][move.end_col - 2] = color + 'R'
+                    self._remove_piece(rook, end + 1)
+                    self._put_piece(rook, end - 2)
 
-            # undo castle rights
-            log = self.castleRightsLog.pop()  # get rid of the most recent castle right
-            # set the current castle right to the one before
-            self.currentCastleRights = CastleRights(log.wks, log.bks, log.wqs, log.bqs)
+            # reset the enpassant square, castle rights and halfmove clock to what they were before
+            self.enpassantSquare = enpassant_square
+            self.castleRights = castle_rights
+            self.halfmoveClock = halfmove_clock
+            self.zobristKey ^= self._castle_and_enpassant_key() ^ ZOBRIST_BLACK_TURN
 
-            self.update_kings_position()    # update kings position
+            # update kings position
+            if move.pieceMoved == 'wK':
+                self.wKLocation = (move.start_row, move.start_col)
+            elif move.pieceMoved == 'bK':
+                self.bKLocation = (move.start_row, move.start_col)
+            if self.whiteTurn:
+                self.fullmoveNumber -= 1
             self.whiteTurn = not self.whiteTurn  # switch the turn
 
 
     def update_castle_rights(self, move):
         """ method updates if a king or rook has moved and given up its
-        castling right. Does not track if king is in check or empty spaces
+        castling right, or if a rook was captured before it could castle.
+        Does not track if king is in check or empty spaces
         """
-        if move.pieceMoved == 'wK':
-            self.currentCastleRights.wks = False
-            self.currentCastleRights.wqs = False
-        elif move.pieceMoved == 'bK':
-            self.currentCastleRights.bks = False
-            self.currentCastleRights.bqs = False
-        elif move.pieceMoved == 'wR':
-            if move.start_row == 7:
-                if move.start_col == 7:     # right rook
-                    self.currentCastleRights.wks = False
-                elif move.start_col == 0:   # left rook
-                    self.currentCastleRights.wqs = False
-        elif move.pieceMoved == 'bR':
-            if move.start_row == 0:
-                if move.start_col == 7:     # right rook
-                    self.currentCastleRights.bks = False
-                elif move.start_col == 0:  # left rook
-                    self.currentCastleRights.bqs = False
-        self.castleRightsLog.append(CastleRights(self.currentCastleRights.wks, self.currentCastleRights.bks,
-                                                 self.currentCastleRights.wqs, self.currentCastleRights.bqs))
-
-
-    def get_valid_moves(self):
-        """ returns every move the user can play, considering checks
-        Algorithm steps:
-            generate all possible moves
-            for each possible move:
-                - simulate the move
-                - generate all possible moves the opponent can make
-                - if the king is still in check after generating all our possible moves:
-                    remove move from the list of possible moves
+        self.castleRights &= (CASTLE_RIGHTS_MASK[move.start_row * 8 + move.start_col] &
+                              CASTLE_RIGHTS_MASK[move.end_row * 8 + move.end_col])
+
+
+    def get_valid_moves(self, indexed=False):
+        """ returns every move the user can play, considering checks.
+        With indexed=True the moves come as a MoveIndex, so a user
+        interface can look them up by square.
+        Instead of simulating every move and looking for checks afterwards,
+        the checks and pins are worked out once for the position:
+            - the king may only step onto squares no enemy piece attacks
+            - in double check, only the king can move
+            - in single check, every other piece has to capture the
+              checking piece or block the line between it and the king
+            - a pinned piece may only move along the line of its pin
+            - en passant and castling are tested on their own
+        The position is never changed while the moves are generated.
         """
-        moves = self.get_possible_moves()  # generate all possible moves
+        color = 'w' if self.whiteTurn else 'b'
+        king = self.bitboards[color + 'K']
+        king_sq = king.bit_length() - 1
+        occupied = self.occupancy['w'] | self.occupancy['b']
+        moves = []
 
-        # add castle moves here
-        # ! adding castle moves in get_possible_moves causes recursion error !
-        # store a copy of the current castle rights, as they may change as we check valid moves
-        temp_castle_rights = CastleRights(self.currentCastleRights.wks, self.currentCastleRights.bks,
-                                          self.currentCastleRights.wqs, self.currentCastleRights.bqs)
-        if self.whiteTurn:
-            self.get_castle_moves(self.wKLocation, moves)
-        else:
-            self.get_castle_moves(self.bKLocation, moves)
-
-        # iterate through each move backwards to avoid bugs when removing items
-        for i in range(len(moves) - 1, -1, -1):     # for each possible move
-            self.move_piece(moves[i])   # simulate the move
-            # we need to swap the turn back because the move_piece method switched the turns
-            self.whiteTurn = not self.whiteTurn
-            if self.in_check():     # checks if the king is still in check
-                moves.remove(moves[i])  # remove move from moves
-            # after this we need to undo the actions we took to simulate a move
-            self.whiteTurn = not self.whiteTurn
-            self.undo_move()
-
-        # set the castle rights to what they were before
-        self.currentCastleRights = temp_castle_rights
-        return moves
+        # the king is taken off the board while checking its squares,
+        # otherwise it would hide the squares behind it from a slider
+        targets = KING_ATTACKS[king_sq] & ~self.occupancy[color]
+        occupied_without_king = occupied ^ king
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            sq = bit.bit_length() - 1
+            if not self._square_attacked(sq, color, occupied_without_king):
+                moves.append(Move(SQUARE_POS[king_sq], SQUARE_POS[sq], self.gameboard))
+
+        checkers = self._attackers(king_sq, color, occupied)
+        if checkers & (checkers - 1):   # double check, only the king can move
+            return MoveIndex(moves) if indexed else moves
+        allowed = FULL_BOARD
+        if checkers:    # the checking piece has to be captured or blocked
+            allowed = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
+        pins = self._pinned_pieces(king_sq, color, occupied)
+
+        for piece in 'PNBRQ':
+            if self.bitboards[color + piece]:
+                getattr(self, self.generatorFunctions[piece])(moves, allowed, pins)
+        self.get_enpassant_moves(king_sq, moves)
+        if not checkers:
+            self.get_castle_moves((king_sq // 8, king_sq % 8), moves)
+        return MoveIndex(moves) if indexed else moves
 
     def in_check(self):
         """ determines if the current player is in check"""
@@ -212,257 +565,370 @@ class GameState(object):
         else:
             return self.square_under_attack(self.bKLocation[0], self.bKLocation[1])
 
+    def repetition_count(self):
+        """ returns how many times the current position has been on the
+        board, counting this time. A capture or pawn move can never be
+        taken back, so only the positions since the last one (as many as
+        the halfmove clock) are compared, with the same side to move. """
+        history = self.zobristHistory
+        key = self.zobristKey
+        count = 1
+        oldest = max(len(history) - self.halfmoveClock, 0)
+        for i in range(len(history) - 2, oldest - 1, -2):
+            if history[i] == key:
+                count += 1
+        return count
+
+    def is_repetition(self):
+        """ determines if the current position has been on the board
+        before, the search scores such a position as a draw """
+        return self.repetition_count() > 1
+
+    def is_threefold_repetition(self):
+        return self.repetition_count() >= 3
+
+    def is_fifty_move_draw(self):
+        """ determines if fifty moves by each side were played without a
+        capture or pawn move. A checkmate on the last move still counts,
+        so check for it first. """
+        return self.halfmoveClock >= 100
+
+    def is_insufficient_material(self):
+        """ determines if neither side can ever mate: only kings and at
+        most one knight or bishop are left on the board """
+        bitboards = self.bitboards
+        if bitboards['wP'] | bitboards['bP'] | bitboards['wR'] | bitboards['bR'] | bitboards['wQ'] | bitboards['bQ']:
+            return False
+        minors = bitboards['wN'] | bitboards['bN'] | bitboards['wB'] | bitboards['bB']
+        return minors & (minors - 1) == 0
+
     def square_under_attack(self, r, c):
-        """ determines if the specified square is under attack """
-        # simulate the opponents moves and see if they can attack our piece
-        self.whiteTurn = not self.whiteTurn     # switch the turn
-        opp_moves = self.get_possible_moves()  # to generate opponents moves
-        self.whiteTurn = not self.whiteTurn     # turn must be switched back
-        for move in opp_moves:
-            if move.end_row == r and move.end_col == c:
-                return True
+        """ determines if the specified square is under attack by the
+        opponent. Instead of generating the opponents moves, we look outward
+        from the square as if it held each type of piece: if a knight jump
+        lands on an enemy knight, that knight attacks the square, and the
+        same goes for pawn diagonals, king steps and the sliding rays.
+        The search stops at the first attacker found.
+        """
+        return self._square_attacked(r * 8 + c, 'w' if self.whiteTurn else 'b',
+                                     self.occupancy['w'] | self.occupancy['b'])
+
+    def _square_attacked(self, sq, color, occupied):
+        """ determines if a piece of the opponent of color attacks sq,
+        with the sliding pieces blocked by the given occupied bitboard """
+        opp_color = 'b' if color == 'w' else 'w'
+        bitboards = self.bitboards
+        if KNIGHT_ATTACKS[sq] & bitboards[opp_color + 'N']:
+            return True
+        # an enemy pawn attacks the square if a pawn of our color on the square would attack it
+        if PAWN_ATTACKS[color][sq] & bitboards[opp_color + 'P']:
+            return True
+        if KING_ATTACKS[sq] & bitboards[opp_color + 'K']:
+            return True
+        # the rays are only traced if an enemy slider is on one of the lines through the square
+        sliders = bitboards[opp_color + 'R'] | bitboards[opp_color + 'Q']
+        if ROOK_LINES[sq] & sliders and sliding_attacks(sq, occupied, ROOK_RAYS) & sliders:
+            return True
+        sliders = bitboards[opp_color + 'B'] | bitboards[opp_color + 'Q']
+        if BISHOP_LINES[sq] & sliders and sliding_attacks(sq, occupied, BISHOP_RAYS) & sliders:
+            return True
         return False
 
+    def _attackers(self, sq, color, occupied):
+        """ returns a bitboard of every piece of the opponent of color
+        that attacks sq """
+        opp_color = 'b' if color == 'w' else 'w'
+        bitboards = self.bitboards
+        attackers = ((KNIGHT_ATTACKS[sq] & bitboards[opp_color + 'N']) |
+                     (PAWN_ATTACKS[color][sq] & bitboards[opp_color + 'P']) |
+                     (KING_ATTACKS[sq] & bitboards[opp_color + 'K']))
+        sliders = bitboards[opp_color + 'R'] | bitboards[opp_color + 'Q']
+        if ROOK_LINES[sq] & sliders:
+            attackers |= sliding_attacks(sq, occupied, ROOK_RAYS) & sliders
+        sliders = bitboards[opp_color + 'B'] | bitboards[opp_color + 'Q']
+        if BISHOP_LINES[sq] & sliders:
+            attackers |= sliding_attacks(sq, occupied, BISHOP_RAYS) & sliders
+        return attackers
+
+    def _pinned_pieces(self, king_sq, color, occupied):
+        """ returns a dict of the pinned pieces of color. A piece is pinned
+        when it is the only piece between its king and an enemy slider
+        looking down that line. Each pinned square is mapped to the squares
+        it may still move to: the line up to and including the pinner.
+        """
+        opp_color = 'b' if color == 'w' else 'w'
+        bitboards = self.bitboards
+        own = self.occupancy[color]
+        pins = {}
+        for sliders in ((bitboards[opp_color + 'R'] | bitboards[opp_color + 'Q']) & ROOK_LINES[king_sq],
+                        (bitboards[opp_color + 'B'] | bitboards[opp_color + 'Q']) & BISHOP_LINES[king_sq]):
+            while sliders:
+                bit = sliders & -sliders
+                sliders ^= bit
+                between = BETWEEN[king_sq][bit.bit_length() - 1]
+                blockers = between & occupied
+                # exactly one piece in between, and it is one of ours
+                if blockers & own and not blockers & (blockers - 1):
+                    pins[blockers.bit_length() - 1] = between | bit
+        return pins
+
     def get_possible_moves(self):
         """ returns a list of every the user can play, NOT considering checks,
         the moves are stored as Move objects
         Algorithm steps:
-            for every square on the board:
-                if the piece is not empty and it's that color's turn:
-                    generate moves for that specific piece
+            for every piece type:
+                if the side to move has pieces of that type on the board:
+                    generate moves for every piece on its bitboard
                     add them to moves
         """
         moves = []
-        for r in range(len(self.gameboard)):
-            for c in range(len(self.gameboard[r])):
-                color = self.gameboard[r][c][0]
-                piece = self.gameboard[r][c][1]
-                if (color == 'w' and self.whiteTurn) or (
-                        color == 'b' and not self.whiteTurn):
-                    # the generate functions take the r and c parameters reversed
-                    # this is because the methods think of r, c as x, y
-                    # in co-ordinate systems x is always before y
-                    # therefore: c = x, r = y, and (x, y) = (c, r)
-                    piece_moves = self.generatorFunctions[piece](c, r)
-                    for move in piece_moves:
-                        moves.append(move)
+        color = 'w' if self.whiteTurn else 'b'
+        for piece in 'PNBRQK':
+            if self.bitboards[color + piece]:
+                getattr(self, self.generatorFunctions[piece])(moves)
         return moves
 
-    def _generate_pawn_moves(self, c, r):
+    def _add_moves(self, sq, targets, moves):
+        """ adds a Move from sq to every square set in the targets bitboard """
+        start_pos = SQUARE_POS[sq]
+        while targets:
+            bit = targets & -targets  # isolate the lowest set bit
+            targets ^= bit
+            moves.append(Move(start_pos, SQUARE_POS[bit.bit_length() - 1], self.gameboard))
+
+    # the generators below take the squares pieces are allowed to move to
+    # and the pinned pieces, both are used by get_valid_moves. When they are
+    # left out, every pseudo-legal move is generated.
+
+    def _generate_pawn_moves(self, moves, allowed=FULL_BOARD, pins=None):
         """ Usually, the pawn can only move forward one tile. It has some
         extra conditions though: if you haven't moved the pawn yet it can
         travel two spaces, and if the pawn is capturing it can move diagonally.
         The pawn can also preform a move known as "en passant", and it
         can be promoted if it reaches the closest rank to the opponent.
         For the most part, we just have to check if the pawn can move in
-        each location manually and if it can then add the move.
+        each location manually and if it can then add the move. A pawn
+        reaching the last rank adds one move for every promotion piece. En
+        passant moves are only added here for pseudo-legal moves, legal
+        ones are generated by get_enpassant_moves.
         """
+        color = 'w' if self.whiteTurn else 'b'
+        step = -8 if self.whiteTurn else 8  # white pawns move up the board
+        first_row = 6 if self.whiteTurn else 1
+        last_row = 1 if self.whiteTurn else 6  # the row pawns promote from
+        enemies = self.occupancy['b' if self.whiteTurn else 'w']
+        empty = ~(self.occupancy['w'] | self.occupancy['b']) & FULL_BOARD
+        enpassant = 0
+        if self.enpassantSquare and pins is None:
+            target = self.enpassantSquare[0] * 8 + self.enpassantSquare[1]
+            # only capture en passant if there is an enemy pawn to take behind the square
+            if self.bitboards[('b' if self.whiteTurn else 'w') + 'P'] >> (target - step) & 1:
+                enpassant = 1 << target
 
-        step_up = -1 if self.whiteTurn else 1
-        moves = []
-
-        # every move features an increase in the row by at least one,
-        # so no list of locations is needed
-        if 0 <= r + step_up <= 7:   # if the move is not out of bounds
+        pawns = self.bitboards[color + 'P']
+        while pawns:
+            bit = pawns & -pawns
+            pawns ^= bit
+            sq = bit.bit_length() - 1
+            mask = allowed
+            if pins and sq in pins:
+                mask &= pins[sq]
+            ahead = sq + step
+            if sq >> 3 == last_row:
+                targets = PAWN_ATTACKS[color][sq] & enemies
+                if empty >> ahead & 1:
+                    targets |= 1 << ahead
+                self._add_promotions(sq, targets & mask, moves)
+                continue
             # standard pawn move: if the space ahead is free, add the move
-            if self.gameboard[r + step_up][c] == '--':
-                moves.append(Move((c, r), (c, r + step_up), self.gameboard))
-
-                # 2 step move: can only preform this move if standard move is possible
-                # if the pawn has not moved yet (the pawn can only move forward)
-                if (self.whiteTurn and r == 6) or (not self.whiteTurn and r == 1):
-                    # if the space two steps ahead is empty, add the move
-                    if self.gameboard[r + step_up * 2][c] == '--':
-                        moves.append(Move((c, r), (c, r + step_up * 2), self.gameboard))
+            if empty >> ahead & 1:
+                if mask >> ahead & 1:
+                    moves.append(Move(SQUARE_POS[sq], SQUARE_POS[ahead], self.gameboard))
+                # 2 step move: can only preform this move if the space ahead is free
+                # if the pawn has not moved yet and the space two steps ahead is empty
+                if sq >> 3 == first_row and empty >> (ahead + step) & 1 and mask >> (ahead + step) & 1:
+                    moves.append(Move(SQUARE_POS[sq], SQUARE_POS[ahead + step], self.gameboard))
 
             # checking diagonal captures
-            color = 'b' if self.whiteTurn else 'w'
-            if c + 1 <= 7 and self.gameboard[r + step_up][c + 1][0] == color:   # regular capture
-                moves.append(Move((c, r), (c + 1, r + step_up), self.gameboard))
-            elif c + 1 <= 7 and (r + step_up, c + 1) == self.enpassantSquare:   # enpassant move
-                moves.append(Move((c, r), (c + 1, r + step_up), self.gameboard))
-            if 0 <= c - 1 and self.gameboard[r + step_up][c - 1][0] == color:
-                moves.append(Move((c, r), (c - 1, r + step_up), self.gameboard))
-            elif 0 <= c - 1 and (r + step_up, c - 1) == self.enpassantSquare:   # enpassant move
-                moves.append(Move((c, r), (c - 1, r + step_up), self.gameboard))
+            attacks = PAWN_ATTACKS[color][sq]
+            self._add_moves(sq, attacks & enemies & mask, moves)
+            if attacks & enpassant:  # enpassant move
+                moves.append(Move(SQUARE_POS[sq], SQUARE_POS[enpassant.bit_length() - 1],
+                                  self.gameboard, enpassant_move=True))
 
-        return moves
+    def _add_promotions(self, sq, targets, moves):
+        """ adds a promotion to every piece in PROMOTION_PIECES for a pawn
+        moving from sq to each square set in the targets bitboard """
+        start_pos = SQUARE_POS[sq]
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            end_pos = SQUARE_POS[bit.bit_length() - 1]
+            for piece in PROMOTION_PIECES:
+                moves.append(Move(start_pos, end_pos, self.gameboard, promotion_piece=piece))
 
-    def _generate_rook_moves(self, c, r):
-        """ The rook can move up and down and left to right. The rook has
-        to stop moving in that direction until it hits the bounds, a
-        friendly piece or an enemy piece (which it captures). To generate
-        the moves, we will keep generating moves in every direction using
-        a while loop until the piece has to stop.
+    def get_enpassant_moves(self, king_sq, moves):
+        """ En passant is the only move that takes a piece from a square
+        other than the one it moves to, so it can open a line to the king
+        that the pin detection does not see (for example when both pawns
+        leave the king's rank). Each en passant capture is tested by
+        taking both pawns off the board, putting ours on the new square
+        and checking if anything but the captured pawn still attacks the king.
         """
-        moves = []
-        directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+        if not self.enpassantSquare:
+            return
         color = 'w' if self.whiteTurn else 'b'
         opp_color = 'b' if self.whiteTurn else 'w'
+        target = self.enpassantSquare[0] * 8 + self.enpassantSquare[1]
+        captured = 1 << (target + (8 if self.whiteTurn else -8))
+        if not self.bitboards[opp_color + 'P'] & captured:
+            return
+        occupied = self.occupancy['w'] | self.occupancy['b']
+        # our pawns standing where an enemy pawn on the target square would attack
+        pawns = PAWN_ATTACKS[opp_color][target] & self.bitboards[color + 'P']
+        while pawns:
+            bit = pawns & -pawns
+            pawns ^= bit
+            after = (occupied ^ bit ^ captured) | (1 << target)
+            if not self._attackers(king_sq, color, after) & ~captured:
+                moves.append(Move(SQUARE_POS[bit.bit_length() - 1], SQUARE_POS[target],
+                                  self.gameboard, enpassant_move=True))
 
-        # while True:
-        # step increase/decrease
-        # check if move is in bounds, if not exit
-        # check if move will capture it's own color, if so exit
-        # add the piece
-        # check if the piece has captured another color, if so exit
-
-        for direction in directions:
-            row_inc, col_inc = r, c
-            while True:
-                row_inc += direction[0]
-                col_inc += direction[1]
-                if row_inc > 7 or col_inc > 7 or row_inc < 0 or col_inc < 0:
-                    break
-                if self.gameboard[row_inc][col_inc][0] == color:
-                    break
-                moves.append(Move((c, r), (col_inc, row_inc), self.gameboard))
-                if self.gameboard[row_inc][col_inc][0] == opp_color:
-                    break
-
-        return moves
+    def _generate_rook_moves(self, moves, allowed=FULL_BOARD, pins=None):
+        """ The rook can move up and down and left to right. The rook has
+        to stop moving in that direction until it hits the bounds, a
+        friendly piece or an enemy piece (which it captures). The rays in
+        every direction are precomputed, so the squares a rook attacks are
+        found by cutting each ray off at the first piece standing on it.
+        """
+        color = 'w' if self.whiteTurn else 'b'
+        own = self.occupancy[color]
+        occupied = own | self.occupancy['b' if self.whiteTurn else 'w']
+        rooks = self.bitboards[color + 'R']
+        while rooks:
+            bit = rooks & -rooks
+            rooks ^= bit
+            sq = bit.bit_length() - 1
+            targets = sliding_attacks(sq, occupied, ROOK_RAYS) & ~own & allowed
+            if pins and sq in pins:
+                targets &= pins[sq]
+            self._add_moves(sq, targets, moves)
 
-    def _generate_knight_moves(self, c, r):
+    def _generate_knight_moves(self, moves, allowed=FULL_BOARD, pins=None):
         """ The knight moves in an L shape in every direction. The knight
         can also jump over other pieces. This piece is similar to the
-        king; we just have to check if each location is movable, if so
-        then add the move
+        king; the squares it can jump to are precomputed for every square,
+        so we only have to take away the squares of its own color. A
+        pinned knight can never move, since it always leaves the line.
         """
-        moves = []
-        locations = [   # create all the possible moves
-            (c + 2, r + 1),
-            (c + 2, r - 1),
-            (c - 2, r + 1),
-            (c - 2, r - 1),
-            (c + 1, r + 2),
-            (c + 1, r - 2),
-            (c - 1, r + 2),
-            (c - 1, r - 2),
-        ]
-
         color = 'w' if self.whiteTurn else 'b'
-        for loc in locations:
-            # if the location is in bounds
-            if 0 <= loc[0] <= 7 and 0 <= loc[1] <= 7:
-                # if knight is not taking his own color
-                if self.gameboard[loc[1]][loc[0]][0] != color:
-                    # add move
-                    moves.append(Move((c, r), loc, self.gameboard))
-        return moves
+        own = self.occupancy[color]
+        knights = self.bitboards[color + 'N']
+        while knights:
+            bit = knights & -knights
+            knights ^= bit
+            sq = bit.bit_length() - 1
+            if pins and sq in pins:
+                continue
+            self._add_moves(sq, KNIGHT_ATTACKS[sq] & ~own & allowed, moves)
 
-    def _generate_bishop_moves(self, c, r):
+    def _generate_bishop_moves(self, moves, allowed=FULL_BOARD, pins=None):
         """ The bishop can move in every diagonal direction. The piece
         has to stop once it reaches the bounds, a friendly piece, or
-        captures an enemy piece. The move generation is very similar to
-        the rook, except we must increment both axes to generate the
-        moves.
+        captures an enemy piece. The move generation is the same as for
+        the rook, except we use the diagonal rays.
         """
-        moves = []
-        directions = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
         color = 'w' if self.whiteTurn else 'b'
-        opp_color = 'b' if self.whiteTurn else 'w'
-
-        # while True:
-        # (row, col) increase/decrease
-        # check if move is in bounds, if not exit
-        # check if move will capture it's own color, if so exit
-        # add the piece
-        # check if the piece has captured another color, if so exit
-
-        for direction in directions:
-            row_inc, col_inc = r, c
-            while True:
-                row_inc += direction[0]
-                col_inc += direction[1]
-                if row_inc > 7 or col_inc > 7 or row_inc < 0 or col_inc < 0:
-                    break
-                if self.gameboard[row_inc][col_inc][0] == color:
-                    break
-                moves.append(Move((c, r), (col_inc, row_inc), self.gameboard))
-                if self.gameboard[row_inc][col_inc][0] == opp_color:
-                    break
-
-        return moves
+        own = self.occupancy[color]
+        occupied = own | self.occupancy['b' if self.whiteTurn else 'w']
+        bishops = self.bitboards[color + 'B']
+        while bishops:
+            bit = bishops & -bishops
+            bishops ^= bit
+            sq = bit.bit_length() - 1
+            targets = sliding_attacks(sq, occupied, BISHOP_RAYS) & ~own & allowed
+            if pins and sq in pins:
+                targets &= pins[sq]
+            self._add_moves(sq, targets, moves)
 
-    def _generate_king_moves(self, c, r):
+    def _generate_king_moves(self, moves, allowed=FULL_BOARD, pins=None):
         """ The king can move a distance of one tile in any square.
         The move generation is simple for this piece, we just have to look
         one square in every direction and check if that location is
         movable. If so, move the piece there. The king can also castle,
         which is a more complex move that requires a different strategy
-        to generate. To generate a castle, we just have to check that the
-        king and the rook have not moved and the space in between them
-        is empty.
+        to generate (see get_castle_moves). The legal king moves are
+        generated by get_valid_moves itself, since the king may never step
+        onto an attacked square.
         """
-        moves = []
-        locations = [   # creating all possible moves
-            (c + 1, r),
-            (c - 1, r),
-            (c, r + 1),
-            (c, r - 1),
-            (c + 1, r + 1),
-            (c + 1, r - 1),
-            (c - 1, r + 1),
-            (c - 1, r - 1)]
-
         color = 'w' if self.whiteTurn else 'b'
-        for loc in locations:
-            # if the location is in bounds
-            if 0 <= loc[0] <= 7 and 0 <= loc[1] <= 7:
-                # if king is not taking his own color
-                if self.gameboard[loc[1]][loc[0]][0] != color:
-                    # add move
-                    moves.append(Move((c, r), loc, self.gameboard))
-
-        return moves
+        own = self.occupancy[color]
+        kings = self.bitboards[color + 'K']
+        while kings:
+            bit = kings & -kings
+            kings ^= bit
+            sq = bit.bit_length() - 1
+            self._add_moves(sq, KING_ATTACKS[sq] & ~own & allowed, moves)
 
     def get_castle_moves(self, pos, moves):
         """ for castling there are 4 conditions:
             (1) cannot castle if the king is in check
             (2) The king or rook of respective side cannot have already moved
             (3) the space in between the castles must be open
-            (4) the king does not end up in check
+            (4) the king does not pass through or end up on an attacked square
         """
         r, c = pos  # pos will be the king position as (row, col)
         if self.square_under_attack(r, c):     # step (1)
             return
+        rook = ('w' if self.whiteTurn else 'b') + 'R'
         # kingside castle
-        if ((self.currentCastleRights.wks and self.whiteTurn) or
-            (self.currentCastleRights.bks and not self.whiteTurn)):     # step (2)
+        if self.castleRights & (CASTLE_WKS if self.whiteTurn else CASTLE_BKS):     # step (2)
             # step (3)
-            if self.gameboard[r][c + 1] == '--' and self.gameboard[r][c + 2] == '--':
+            if (c + 3 < 8 and self.gameboard[r][c + 1] == '--' and self.gameboard[r][c + 2] == '--'
+                    and self.gameboard[r][c + 3] == rook):
                 # step (4)
-                if not self.square_under_attack(r, c + 2):
-                    moves.append(Move((c, r), (c + 2, r), self.gameboard))  # add move
+                if not self.square_under_attack(r, c + 1) and not self.square_under_attack(r, c + 2):
+                    moves.append(Move((c, r), (c + 2, r), self.gameboard, is_castle=True))  # add move
         # queenside castle
-        if ((self.currentCastleRights.wqs and self.whiteTurn)
-            or (self.currentCastleRights.bqs and not self.whiteTurn)):     # step (2)
-            if (self.gameboard[r][c - 1] == '--' and self.gameboard[r][c - 2] == '--'
-                    and self.gameboard[r][c - 3] == '--'):  # step (3)
+        if self.castleRights & (CASTLE_WQS if self.whiteTurn else CASTLE_BQS):     # step (2)
+            if (c - 4 >= 0 and self.gameboard[r][c - 1] == '--' and self.gameboard[r][c - 2] == '--'
+                    and self.gameboard[r][c - 3] == '--' and self.gameboard[r][c - 4] == rook):  # step (3)
                 # step (4)
-                if not self.square_under_attack(r, c - 2):
-                    moves.append(Move((c, r), (c - 2, r), self.gameboard))    # add move
+                if not self.square_under_attack(r, c - 1) and not self.square_under_attack(r, c - 2):
+                    moves.append(Move((c, r), (c - 2, r), self.gameboard, is_castle=True))    # add move
 
 
-    def _generate_queen_moves(self, c, r):
+    def _generate_queen_moves(self, moves, allowed=FULL_BOARD, pins=None):
         """ The queen can move in any direction, diagonal or straight for
         any amount of blocks until she reaches the bounds, hits a friendly
         piece, or captures an enemy piece. The queen is essentially a rook
-        and a bishop, so all that is needed to generate the queen moves
-        is to generate rook moves and then generate bishop moves."""
-        moves = []
-        for move in self._generate_rook_moves(c, r):
-            moves.append(move)
-        for move in self._generate_bishop_moves(c, r):
-            moves.append(move)
-        return moves
+        and a bishop, so her attacks are the rook rays and the bishop rays
+        put together."""
+        color = 'w' if self.whiteTurn else 'b'
+        own = self.occupancy[color]
+        occupied = own | self.occupancy['b' if self.whiteTurn else 'w']
+        queens = self.bitboards[color + 'Q']
+        while queens:
+            bit = queens & -queens
+            queens ^= bit
+            sq = bit.bit_length() - 1
+            attacks = sliding_attacks(sq, occupied, ROOK_RAYS) | sliding_attacks(sq, occupied, BISHOP_RAYS)
+            targets = attacks & ~own & allowed
+            if pins and sq in pins:
+                targets &= pins[sq]
+            self._add_moves(sq, targets, moves)
 
 
 class Move(object):
     """ The Move class stores the information about a move that player
     may make. Is used in the GameState class. Contains functionality to
     translate "x, y" positions to "file, rank" positions (ex. A1 to A3).
+    Thousands of moves are created and thrown away during a search, so
+    the class uses __slots__ instead of a dict per move, and a move can
+    be packed into a 16-bit number with encode() and rebuilt with decode().
     """
+    __slots__ = ('start_row', 'start_col', 'end_row', 'end_col', 'pieceMoved', 'pieceCaptured',
+                 'isPawnPromotion', 'promotion_piece', 'enPassantMove', 'isCastle')
     y_to_rank = {i: chr(97 + i) for i in range(8)}
     x_to_file = {i: f'{8 - i}' for i in range(8)}
 
@@ -476,26 +942,93 @@ class Move(object):
         self.pieceMoved = gameboard[self.start_row][self.start_col]
         self.pieceCaptured = gameboard[self.end_row][self.end_col]
         # pawn promotion
-        self.isPawnPromotion = ((self.pieceMoved == 'wP' and self.end_row == 0) or
-                                (self.pieceMoved == 'bP' and self.end_row == 7))
+        self.isPawnPromotion = self.pieceMoved[1] == 'P' and (self.end_row == 0 or self.end_row == 7)
         self.promotion_piece = promotion_piece
         # en passant
         self.enPassantMove = enpassant_move
         if self.enPassantMove:  # we need to set the captured pawn as the captured piece
-            step = 1 if self.pieceMoved[0] == 'b' else -1
-            self.pieceCaptured = gameboard[self.end_row + step][self.end_col]
+            # the captured pawn stands beside the moving pawn, on the row it started from
+            self.pieceCaptured = gameboard[self.start_row][self.end_col]
         # castling
         self.isCastle = is_castle
 
+    def encode(self):
+        """ packs the move into 16 bits: the start square in bits 0-5, the
+        end square in bits 6-11 and a flag in bits 12-15 (0 for a normal
+        move, 1-4 for a promotion to Q, R, B or N, 5 for en passant and
+        6 for castling). Squares are numbered row * 8 + col. """
+        code = (self.start_row * 8 + self.start_col) | (self.end_row * 8 + self.end_col) << 6
+        if self.isPawnPromotion:
+            code |= FLAG_PROMOTIONS[self.promotion_piece] << 12
+        elif self.enPassantMove:
+            code |= FLAG_ENPASSANT << 12
+        elif self.isCastle:
+            code |= FLAG_CASTLE << 12
+        return code
+
+    @classmethod
+    def decode(cls, code, gameboard):
+        """ rebuilds a move packed by encode() on the given gameboard """
+        flag = code >> 12
+        promotion_piece = 'P'
+        for piece, piece_flag in FLAG_PROMOTIONS.items():
+            if flag == piece_flag:
+                promotion_piece = piece
+        return cls(SQUARE_POS[code & 63], SQUARE_POS[(code >> 6) & 63], gameboard, promotion_piece,
+                   enpassant_move=flag == FLAG_ENPASSANT, is_castle=flag == FLAG_CASTLE)
+
     def get_chess_pos(self):
         first_pos = self.get_rank_file(self.start_row, self.start_col)
         second_pos = self.get_rank_file(self.end_row, self.end_col)
         return first_pos + ' to ' + second_pos
 
+    def get_uci(self):
+        """ returns the move in long algebraic notation (ex. e2e4, or e7e8q
+        for a promotion), the form chess engines use to talk about moves """
+        uci = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        if self.isPawnPromotion:
+            uci += self.promotion_piece.lower()
+        return uci
+
     def get_rank_file(self, x, y):
         return self.y_to_rank[y] + self.x_to_file[x]
 
 
+class MoveIndex(list):
+    """ The MoveIndex class is the list of valid moves of a position,
+    indexed by square so a click can be turned into a move without
+    searching the list. Positions are (x, y) tuples, like the ones the
+    Move class is built from. The moves are the ones the engine generated,
+    with their promotion, en passant and castle flags already set.
+    """
+
+    def __init__(self, moves):
+        super().__init__(moves)
+        self.origins = {}   # start position -> [Move()]
+        self.squares = {}   # (start position, end position) -> [Move()], one per promotion piece
+        for move in moves:
+            start = (move.start_col, move.start_row)
+            self.origins.setdefault(start, []).append(move)
+            self.squares.setdefault((start, (move.end_col, move.end_row)), []).append(move)
+
+    def moves_from(self, start_pos):
+        """ returns the moves of the piece at start_pos """
+        return self.origins.get(start_pos, [])
+
+    def find(self, start_pos, end_pos, promotion_piece=None):
+        """ returns the move from start_pos to end_pos or None if it is not
+        valid. A promotion gives the move to promotion_piece, or the first
+        promotion (to a queen) if no piece is given. """
+        moves = self.squares.get((start_pos, end_pos))
+        if not moves:
+            return None
+        if promotion_piece is not None:
+            for move in moves:
+                if move.promotion_piece == promotion_piece:
+                    return move
+        return moves[0]
+
+
 class CastleRights(object):
 
     def __init__(self, wks, bks, wqs, bqs):
@@ -503,3 +1036,50 @@ class CastleRights(object):
         self.bks = bks
         self.wqs = wqs
         self.bqs = bqs
+
+    def get_index(self):
+        """ returns the castle rights packed into a number from 0 to 15 """
+        return self.wks | self.bks << 1 | self.wqs << 2 | self.bqs << 3
+
+    @classmethod
+    def from_index(cls, index):
+        """ unpacks castle rights packed by get_index() """
+        return cls(bool(index & CASTLE_WKS), bool(index & CASTLE_BKS),
+                   bool(index & CASTLE_WQS), bool(index & CASTLE_BQS))
+
+
+def parse_epd(line):
+    """ reads a line of an EPD file (or a plain FEN line) and returns the
+    GameState and a dict of its operations, for example
+    'bm Nf3; id "test 1";' becomes {'bm': 'Nf3', 'id': 'test 1'} """
+    fields = line.split(None, 4)
+    if len(fields) < 5:
+        return GameState.from_fen(line), {}
+    rest = fields[4].split()
+    # a FEN line ends with the halfmove clock and move number instead of operations
+    if len(rest) == 2 and rest[0].isdigit() and rest[1].isdigit():
+        return GameState.from_fen(line), {}
+    operations = {}
+    for operation in fields[4].split(';'):
+        operation = operation.strip()
+        if operation:
+            opcode, _, operand = operation.partition(' ')
+            operations[opcode] = operand.strip().strip('"')
+    gamestate = GameState.from_fen(' '.join(fields[:4]))
+    if 'hmvc' in operations:
+        gamestate.halfmoveClock = int(operations['hmvc'])
+    if 'fmvn' in operations:
+        gamestate.fullmoveNumber = int(operations['fmvn'])
+    return gamestate, operations
+
+
+def read_positions(path):
+    """ yields a (GameState, operations) tuple for every line of a FEN or
+    EPD file. The file is read lazily, one line at a time, so files with
+    millions of positions never have to fit in memory. Blank lines and
+    lines starting with '#' are skipped. """
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield parse_epd(line)
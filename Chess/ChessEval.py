@@ -0,0 +1,146 @@
+""" The ChessEval module scores positions for the search. A position is
+scored by material and piece-square tables (a bonus or penalty for every
+piece on every square), once for the middlegame and once for the endgame,
+and the two scores are blended by how much material is left on the board.
+
+The scores of every piece on every square are added up in the tables
+below, so GameState can keep the totals up to date in _put_piece and
+_remove_piece and evaluate() never has to look at the board.
+"""
+
+PIECE_VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 0}
+ENDGAME_PIECE_VALUES = {'P': 120, 'N': 300, 'B': 320, 'R': 520, 'Q': 920, 'K': 0}
+# how much a piece counts towards the middlegame, 24 with all pieces on the board
+PHASE_WEIGHTS = {'P': 0, 'N': 1, 'B': 1, 'R': 2, 'Q': 4, 'K': 0}
+MAX_PHASE = 24
+
+# piece-square tables for white, as seen from white's side of the board
+# (the first row is rank 8), black uses them mirrored
+PAWN_TABLE = [
+    0,   0,   0,   0,   0,   0,   0,   0,
+    50,  50,  50,  50,  50,  50,  50,  50,
+    10,  10,  20,  30,  30,  20,  10,  10,
+    5,   5,   10,  25,  25,  10,  5,   5,
+    0,   0,   0,   20,  20,  0,   0,   0,
+    5,   -5,  -10, 0,   0,   -10, -5,  5,
+    5,   10,  10,  -20, -20, 10,  10,  5,
+    0,   0,   0,   0,   0,   0,   0,   0]
+PAWN_ENDGAME_TABLE = [
+    0,   0,   0,   0,   0,   0,   0,   0,
+    80,  80,  80,  80,  80,  80,  80,  80,
+    50,  50,  50,  50,  50,  50,  50,  50,
+    30,  30,  30,  30,  30,  30,  30,  30,
+    15,  15,  15,  15,  15,  15,  15,  15,
+    5,   5,   5,   5,   5,   5,   5,   5,
+    0,   0,   0,   0,   0,   0,   0,   0,
+    0,   0,   0,   0,   0,   0,   0,   0]
+KNIGHT_TABLE = [
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0,   0,   0,   0,   -20, -40,
+    -30, 0,   10,  15,  15,  10,  0,   -30,
+    -30, 5,   15,  20,  20,  15,  5,   -30,
+    -30, 0,   15,  20,  20,  15,  0,   -30,
+    -30, 5,   10,  15,  15,  10,  5,   -30,
+    -40, -20, 0,   5,   5,   0,   -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50]
+BISHOP_TABLE = [
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0,   0,   0,   0,   0,   0,   -10,
+    -10, 0,   5,   10,  10,  5,   0,   -10,
+    -10, 5,   5,   10,  10,  5,   5,   -10,
+    -10, 0,   10,  10,  10,  10,  0,   -10,
+    -10, 10,  10,  10,  10,  10,  10,  -10,
+    -10, 5,   0,   0,   0,   0,   5,   -10,
+    -20, -10, -10, -10, -10, -10, -10, -20]
+ROOK_TABLE = [
+    0,   0,   0,   0,   0,   0,   0,   0,
+    5,   10,  10,  10,  10,  10,  10,  5,
+    -5,  0,   0,   0,   0,   0,   0,   -5,
+    -5,  0,   0,   0,   0,   0,   0,   -5,
+    -5,  0,   0,   0,   0,   0,   0,   -5,
+    -5,  0,   0,   0,   0,   0,   0,   -5,
+    -5,  0,   0,   0,   0,   0,   0,   -5,
+    0,   0,   0,   5,   5,   0,   0,   0]
+QUEEN_TABLE = [
+    -20, -10, -10, -5,  -5,  -10, -10, -20,
+    -10, 0,   0,   0,   0,   0,   0,   -10,
+    -10, 0,   5,   5,   5,   5,   0,   -10,
+    -5,  0,   5,   5,   5,   5,   0,   -5,
+    0,   0,   5,   5,   5,   5,   0,   -5,
+    -10, 5,   5,   5,   5,   5,   0,   -10,
+    -10, 0,   5,   0,   0,   0,   0,   -10,
+    -20, -10, -10, -5,  -5,  -10, -10, -20]
+KING_TABLE = [
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20,  20,  0,   0,   0,   0,   20,  20,
+    20,  30,  10,  0,   0,   10,  30,  20]
+# in the endgame the king should come to the center
+KING_ENDGAME_TABLE = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0,   0,   -10, -20, -30,
+    -30, -10, 20,  30,  30,  20,  -10, -30,
+    -30, -10, 30,  40,  40,  30,  -10, -30,
+    -30, -10, 30,  40,  40,  30,  -10, -30,
+    -30, -10, 20,  30,  30,  20,  -10, -30,
+    -30, -30, 0,   0,   0,   0,   -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50]
+
+MIDGAME_TABLES = {'P': PAWN_TABLE, 'N': KNIGHT_TABLE, 'B': BISHOP_TABLE,
+                  'R': ROOK_TABLE, 'Q': QUEEN_TABLE, 'K': KING_TABLE}
+ENDGAME_TABLES = {'P': PAWN_ENDGAME_TABLE, 'N': KNIGHT_TABLE, 'B': BISHOP_TABLE,
+                  'R': ROOK_TABLE, 'Q': QUEEN_TABLE, 'K': KING_ENDGAME_TABLE}
+
+
+def _square_scores(values, tables):
+    """ returns piece -> list of 64 scores (material + table), positive
+    for white and negative for black """
+    scores = {}
+    for piece_type, table in tables.items():
+        scores['w' + piece_type] = [values[piece_type] + table[sq] for sq in range(64)]
+        # square sq of black is the mirrored square sq ^ 56 of white
+        scores['b' + piece_type] = [-(values[piece_type] + table[sq ^ 56]) for sq in range(64)]
+    return scores
+
+
+MIDGAME_SCORES = _square_scores(PIECE_VALUES, MIDGAME_TABLES)
+ENDGAME_SCORES = _square_scores(ENDGAME_PIECE_VALUES, ENDGAME_TABLES)
+PHASES = {color + piece_type: weight for piece_type, weight in PHASE_WEIGHTS.items() for color in 'wb'}
+
+
+def blend(midgame, endgame, phase):
+    """ mixes the middlegame and endgame scores by the game phase. It
+    rounds towards zero, so a position with the colors swapped gets
+    exactly the negated score. """
+    phase = min(phase, MAX_PHASE)
+    score = midgame * phase + endgame * (MAX_PHASE - phase)
+    return score // MAX_PHASE if score >= 0 else -(-score // MAX_PHASE)
+
+
+def evaluate(gamestate):
+    """ returns the score of the position in centipawns, from the point
+    of view of the side to move. It only reads the totals GameState keeps
+    up to date, so it takes the same time in any position. """
+    score = blend(gamestate.midgameScore, gamestate.endgameScore, gamestate.gamePhase)
+    return score if gamestate.whiteTurn else -score
+
+
+def evaluate_board(gamestate):
+    """ scores the position by scanning every piece, the slow way.
+    evaluate() must always give the same result, this is useful to
+    check the totals GameState keeps. """
+    midgame = endgame = phase = 0
+    for piece, bb in gamestate.bitboards.items():
+        while bb:
+            bit = bb & -bb
+            bb ^= bit
+            sq = bit.bit_length() - 1
+            midgame += MIDGAME_SCORES[piece][sq]
+            endgame += ENDGAME_SCORES[piece][sq]
+            phase += PHASES[piece]
+    score = blend(midgame, endgame, phase)
+    return score if gamestate.whiteTurn else -score
@@ -4,6 +4,7 @@ displaying the state of the game (the frontend).
 
 import pygame as py
 import ChessEngine
+import ChessWorker
 import os
 import tkinter as tk
 from tkinter import messagebox
@@ -15,6 +16,10 @@ GRID_LENGTH = 8
 SQR_SIZE = WIDTH // GRID_LENGTH
 MAX_FPS = 15
 IMAGES = {}
+ENGINE_TIME = 2     # seconds the engine thinks about a move
+ENGINE_PONDER = True    # let the engine think on the player's time
+# events after which the window was covered or minimized and has to be drawn again
+REDRAW_EVENTS = (py.VIDEOEXPOSE, py.WINDOWEXPOSED, py.WINDOWRESTORED)
 
 
 # load the images into pygame, is only done once
@@ -26,14 +31,20 @@ def load_images():
 
 
 # main method for the program, will handle user input and updating the screen
+# press 'e' to let the engine play the side to move, escape to stop it
 def main():
     screen = py.display.set_mode((WIDTH, HEIGHT))
     screen.fill((255, 255, 255))
     py.display.set_caption('Chess')
     clock = py.time.Clock()
     gamestate = ChessEngine.GameState()
-    valid_moves = gamestate.get_valid_moves()
+    valid_moves = gamestate.get_valid_moves(indexed=True)
     load_images()
+    view = BoardView(screen)
+    # the engine searches in another process, the loop only polls it for moves
+    worker = ChessWorker.EngineWorker()
+    engine_color = None  # the color the engine plays, None if it does not play
+    caption = 'Chess'
     mouse_history = []  # a list containing the players click[(x1, y1), (x2, y2)]
     # first tuple is the click that selected the piece,
     # second tuple is the click that placed the following piece
@@ -47,6 +58,10 @@ def main():
             if event.type == py.QUIT:  # close window event handler
                 run = False
                 break
+            elif event.type in REDRAW_EVENTS:  # the window has to be drawn again
+                view.invalidate()
+            elif event.type == py.MOUSEBUTTONDOWN and engine_color == ('w' if gamestate.whiteTurn else 'b'):
+                continue    # the engine is playing this move
             elif event.type == py.MOUSEBUTTONDOWN:  # mouse-clicked event handler
                 position = py.mouse.get_pos()
                 x = position[0] // SQR_SIZE
@@ -62,9 +77,8 @@ def main():
                     mouse_history.append(sq_selected)  # append for 1st or 2nd click
 
                 if len(mouse_history) == 1:  # the user has selected a piece
-                    # add move to show_suggested_moves if the move is for the piece selected by the mouse
-                    show_suggested_moves = [move for move in valid_moves if
-                                            (move.start_col, move.start_row) == mouse_history[0]]
+                    # show the moves of the piece selected by the mouse
+                    show_suggested_moves = valid_moves.moves_from(mouse_history[0])
                 else:
                     show_suggested_moves = []
 
@@ -72,66 +86,81 @@ def main():
                 if len(mouse_history) == 2 and mouse_history[0] == mouse_history[1]:
                     mouse_history = []  # clear mouse history
                 elif len(mouse_history) == 2:  # if the user wants to move a piece
-                    # create the move to send to the engine
-                    move = ChessEngine.Move(mouse_history[0], mouse_history[1],
-                                            gamestate.gameboard)
-
-                    # check if the move is good
-                    move_is_valid = False
-                    for m in valid_moves:
-                        if ((m.start_row, m.start_col) == (move.start_row, move.start_col) and
-                                (m.end_row, m.end_col) == (move.end_row, move.end_col)):
-                            move_is_valid = True
-                            break
-
-                    if move_is_valid:  # if the move is valid
+                    # look up the engine's move, it is None if the move is not valid
+                    move = valid_moves.find(mouse_history[0], mouse_history[1])
+
+                    if move is not None:  # if the move is valid
                         if move.isPawnPromotion:    # if move is pawn promotion
-                            move = ChessEngine.Move(mouse_history[0], mouse_history[1],
-                                                    gamestate.gameboard, promotion_piece=choose_pawn_promo())
-                        elif ((move.end_row, move.end_col) == gamestate.enpassantSquare
-                              and move.pieceMoved[1] == 'P'):   # if move is enpassant
-                            move = ChessEngine.Move(mouse_history[0], mouse_history[1], gamestate.gameboard, enpassant_move=True)
-                        # if move is castle
-                        elif abs(move.end_col - move.start_col) == 2 and move.pieceMoved[1] == 'K':
-                            move = ChessEngine.Move(mouse_history[0], mouse_history[1], gamestate.gameboard, is_castle=True)
+                            move = valid_moves.find(mouse_history[0], mouse_history[1], choose_pawn_promo())
                         gamestate.move_piece(move)  # move the piece
-                        gamestate.enpassantSquare = ()  # reset the enpassant square after every move
-                        # create an enpassant square if necessary
-                        if move.pieceMoved[1] == 'P' and abs(move.start_row - move.end_row) == 2:
-                            step = 1 if move.pieceMoved[0] == 'b' else -1
-                            gamestate.enpassantSquare = (move.start_row + step, move.start_col)
                         print(move.get_chess_pos())  # move log
                         mouse_history = []  # clear full move history
-                        valid_moves = gamestate.get_valid_moves()
+                        valid_moves = gamestate.get_valid_moves(indexed=True)
+                        if engine_color == ('w' if gamestate.whiteTurn else 'b') and valid_moves:
+                            if worker.ponder_move == move.get_uci():
+                                worker.ponderhit()  # the engine already thought about this move
+                            else:
+                                worker.request_move(gamestate, ENGINE_TIME)
                     else:  # if the user tried an invalid move
                         mouse_history = []  # assume the player has de-selected their piece
 
             elif event.type == py.KEYDOWN:  # keystroke event handler
                 # undo when 'z' or 'u' are pressed
                 if event.key == py.K_z or event.key == py.K_u:
-                    if gamestate.moveLog[-1].isCastle:  # if the last move is a castle
-                        # we need to manually remove the first castleRights.
-                        gamestate.castleRightsLog.pop()
+                    worker.cancel()
+                    engine_color = None
                     gamestate.undo_move()   # undo the move
                     # after you undo a move, you must update the current valid moves
-                    valid_moves = gamestate.get_valid_moves()
+                    valid_moves = gamestate.get_valid_moves(indexed=True)
                     mouse_history = []
-
-
-        draw_gamestate(screen, gamestate, mouse_history, show_suggested_moves)
+                # the engine plays the side to move from now on
+                elif event.key == py.K_e and valid_moves:
+                    engine_color = 'w' if gamestate.whiteTurn else 'b'
+                    mouse_history = []
+                    show_suggested_moves = []
+                    worker.request_move(gamestate, ENGINE_TIME)
+                # stop the engine
+                elif event.key == py.K_ESCAPE:
+                    worker.cancel()
+                    engine_color = None
+
+        # play the moves the engine found, then let it ponder on the reply it expects
+        for best_move, reply in worker.poll():
+            for move in valid_moves:
+                if move.get_uci() == best_move:
+                    gamestate.move_piece(move)
+                    print(move.get_chess_pos())  # move log
+                    valid_moves = gamestate.get_valid_moves(indexed=True)
+                    if ENGINE_PONDER and reply is not None and valid_moves:
+                        worker.ponder(gamestate, reply, ENGINE_TIME)
+                    break
+        new_caption = 'Chess - thinking...' if worker.is_thinking() else 'Chess'
+        if new_caption != caption:
+            caption = new_caption
+            py.display.set_caption(caption)
+
+        view.draw(gamestate, mouse_history, show_suggested_moves)
         clock.tick(MAX_FPS)
-        py.display.flip()
 
-        if len(valid_moves) == 0:
-            if gamestate.in_check():
+        if len(valid_moves) == 0 or gamestate.is_threefold_repetition() or gamestate.is_fifty_move_draw():
+            if len(valid_moves) == 0 and view.in_check(gamestate):
                 # checkmate
                 display_messagebox('Black' if gamestate.whiteTurn else 'White')
-            else:
+            elif len(valid_moves) == 0:
                 # stalemate
                 display_messagebox()
+            elif gamestate.is_threefold_repetition():
+                display_messagebox(reason='Threefold repetition')
+            else:
+                display_messagebox(reason='Fifty-move rule')
             # after the game is finished, reset the board and regenerate valid moves
+            worker.cancel()
+            engine_color = None
             gamestate.reset_gamestate()
-            valid_moves = gamestate.get_valid_moves()
+            valid_moves = gamestate.get_valid_moves(indexed=True)
+            view.invalidate()   # the messagebox was drawn over the board
+
+    worker.close()
 
 
 # function to choose a piece for pawn promotion
@@ -146,7 +175,7 @@ def choose_pawn_promo():
         ('Queen', 'Q'),
         ('Bishop', 'B'),
         ('Rook', 'R'),
-        ('Knight', 'K')
+        ('Knight', 'N')
     ]
     v = tk.StringVar()
     v.set('Q')  # set default value
@@ -164,13 +193,13 @@ def choose_pawn_promo():
 
 
 # function to display the end game result as a tkinter messagebox
-def display_messagebox(winner=None):
+def display_messagebox(winner=None, reason='Stalemate'):
     window = tk.Tk()
     window.eval('tk::PlaceWindow %s center' % window.winfo_toplevel())
     window.withdraw()
 
     if winner is None:
-        messagebox.showinfo('Game Over', "Stalemate: it's a tie")
+        messagebox.showinfo('Game Over', f"{reason}: it's a tie")
     else:
         messagebox.showinfo('Game Over', f'Checkmate: {winner} won')
 
@@ -179,120 +208,109 @@ def display_messagebox(winner=None):
     window.quit()
 
 
-# function to update the screen
-def draw_gamestate(screen, gamestate, mouse_history, suggested_moves):
-    draw_squares(screen)
-    if len(gamestate.moveLog) > 0:
-        draw_last_move(screen, gamestate.moveLog[len(gamestate.moveLog) - 1])
-    if gamestate.in_check():
-        if gamestate.whiteTurn:
-            y, x = gamestate.wKLocation
-            x, y = x * SQR_SIZE, y * SQR_SIZE
-            py.draw.rect(screen, (255, 0, 0), (x, y, SQR_SIZE, SQR_SIZE))
-        else:
-            y, x = gamestate.bKLocation
-            x, y = x * SQR_SIZE, y * SQR_SIZE
-            py.draw.rect(screen, (255, 0, 0), (x, y, SQR_SIZE, SQR_SIZE))
-    if len(mouse_history) == 1:
-        draw_selected_square(screen, mouse_history[0])
-        draw_move_suggestions(screen, suggested_moves)
-    draw_file_and_rank(screen)
-    draw_pieces(screen, gamestate.gameboard)
-    py.display.update()
-
-
-# draws the last move that happened in game
-def draw_last_move(screen, move):
-    start_y, start_x = move.start_row, move.start_col
-    draw_selected_square(screen, (start_x, start_y))
-    end_y, end_x = move.end_row, move.end_col
-    draw_selected_square(screen, (end_x, end_y), trans=True)
-
-
-# draws all possible moves for any given piece
-def draw_move_suggestions(screen, suggested_moves):
-    for move in suggested_moves:  # drawing move suggestions
-        y, x = move.end_row, move.end_col
-        draw_selected_square(screen, (x, y), trans=True)
-
-
-# draws the file and rank symbols
-def draw_file_and_rank(screen):
-    light = (238, 240, 201)  # light beige
-    dark = (111, 153, 87)  # brown
-    font = py.font.Font('freesansbold.ttf', 14)
-    light_color = False
-
-    # rank is 8-1
-    rank = '8'
-    for i in range(GRID_LENGTH):
-        if light_color:
-            text = font.render(rank, True, dark, light)
-        else:
-            text = font.render(rank, True, light, dark)
-        light_color = not light_color
-        text_rect = text.get_rect()
-        text_rect.center = (WIDTH - 6, (i * SQR_SIZE) + 10)
-        screen.blit(text, text_rect)
-        rank = str(int(rank) - 1)
-
-    # file is A-H
-    file = 'A'
-    for i in range(GRID_LENGTH):
-        if light_color:
-            text = font.render(file, True, dark, light)
-        else:
-            text = font.render(file, True, light, dark)
-        light_color = not light_color
-        text_rect = text.get_rect()
-        text_rect.center = ((i * SQR_SIZE) + 7, HEIGHT - 9)
-        screen.blit(text, text_rect)
-        file = chr(ord(file) + 1)
-
-
-# draws the square tiles
-def draw_squares(screen):
-    light = (238, 240, 201)  # light beige
-    dark = (111, 153, 87)  # brown
-
-    white_first = False
-    # the top-left square is always light
-    for i in range(GRID_LENGTH):
-        white_first = False if white_first else True
-        for j in range(GRID_LENGTH):
-            if white_first:
-                py.draw.rect(screen, light, (j * SQR_SIZE, i * SQR_SIZE, SQR_SIZE, SQR_SIZE))
-                white_first = False
-            else:
-                py.draw.rect(screen, dark, (j * SQR_SIZE, i * SQR_SIZE, SQR_SIZE, SQR_SIZE))
-                white_first = True
-
-
-# highlights the square under the piece that the user wants to move
-def draw_selected_square(screen, position, trans=False):
-    color = (255, 253, 130)
-    x, y = position
-    x *= SQR_SIZE
-    y *= SQR_SIZE
-    if trans:  # if the highlight is to be slightly transparent
-        s = py.Surface((SQR_SIZE, SQR_SIZE))
-        s.set_alpha(140)
-        s.fill(color)
-        screen.blit(s, (x, y))
-    else:  # the highlight is a solid yellow
-        py.draw.rect(screen, color, (x, y, SQR_SIZE, SQR_SIZE))
-
-
-# draws the pieces
-def draw_pieces(screen, gameboard):
-    # because gameboard is a list, x and y are flipped
-    # position (i, j) becomes [j][i]
-    for i in range(GRID_LENGTH):  # x
-        for j in range(GRID_LENGTH):  # y
-            piece = gameboard[j][i]  # [y][x]
-            if piece != '--':
-                screen.blit(IMAGES[piece],
-                            (i * SQR_SIZE, j * SQR_SIZE, SQR_SIZE, SQR_SIZE))
+# draws the board, redrawing only the squares that look different from the last frame
+class BoardView(object):
+    """ The BoardView class keeps the parts of the picture that never change
+    (the squares with the file and rank symbols, the highlights) as
+    surfaces, and remembers what every square looked like the last time it
+    was drawn. draw only redraws the squares that changed and only pushes
+    their rectangles to the display, so a board that is not touched costs
+    almost nothing to show.
+    """
+
+    LIGHT = (238, 240, 201)  # light beige
+    DARK = (111, 153, 87)  # brown
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.board = py.Surface((WIDTH, HEIGHT))
+        self.draw_squares()
+        self.labels = {}    # square -> [(rendered symbol, its rect)]
+        self.draw_file_and_rank()
+        # highlights: solid for the selected square, transparent for moves, red for a king in check
+        self.highlights = {'selected': py.Surface((SQR_SIZE, SQR_SIZE)),
+                           'move': py.Surface((SQR_SIZE, SQR_SIZE)),
+                           'check': py.Surface((SQR_SIZE, SQR_SIZE))}
+        self.highlights['selected'].fill((255, 253, 130))
+        self.highlights['move'].fill((255, 253, 130))
+        self.highlights['move'].set_alpha(140)
+        self.highlights['check'].fill((255, 0, 0))
+        self.drawn = [None] * 64  # what every square looked like when it was last drawn
+        self.check_key = None   # the position the check status below belongs to
+        self.check = False
+
+    # draws the square tiles, the top-left square is always light
+    def draw_squares(self):
+        for i in range(GRID_LENGTH):
+            for j in range(GRID_LENGTH):
+                color = self.LIGHT if (i + j) % 2 == 0 else self.DARK
+                py.draw.rect(self.board, color, (j * SQR_SIZE, i * SQR_SIZE, SQR_SIZE, SQR_SIZE))
+
+    # renders the file and rank symbols once, in the color of the other squares
+    def draw_file_and_rank(self):
+        font = py.font.Font('freesansbold.ttf', 14)
+        for i in range(GRID_LENGTH):
+            # rank is 8-1, along the right edge
+            self.add_label(font, str(GRID_LENGTH - i), i, GRID_LENGTH - 1, (WIDTH - 6, (i * SQR_SIZE) + 10))
+            # file is A-H, along the bottom edge
+            self.add_label(font, chr(ord('A') + i), GRID_LENGTH - 1, i, ((i * SQR_SIZE) + 7, HEIGHT - 9))
+
+    def add_label(self, font, symbol, row, col, center):
+        light = (row + col) % 2 == 0
+        text = font.render(symbol, True, self.DARK if light else self.LIGHT, self.LIGHT if light else self.DARK)
+        self.labels.setdefault(row * 8 + col, []).append((text, text.get_rect(center=center)))
+
+    def in_check(self, gamestate):
+        """ returns gamestate.in_check(), computed once per position """
+        key = (gamestate.zobristKey, len(gamestate.moveLog))
+        if key != self.check_key:
+            self.check_key = key
+            self.check = gamestate.in_check()
+        return self.check
+
+    def invalidate(self):
+        """ makes the next draw redraw the whole board, for when the window was covered """
+        self.drawn = [None] * 64
+
+    def square_highlights(self, gamestate, mouse_history, suggested_moves):
+        """ returns the highlights of every square, in the order they are drawn """
+        highlights = [()] * 64
+        if len(gamestate.moveLog) > 0:
+            move = gamestate.moveLog[-1]
+            highlights[move.start_row * 8 + move.start_col] += ('selected',)
+            highlights[move.end_row * 8 + move.end_col] += ('move',)
+        if self.in_check(gamestate):
+            y, x = gamestate.wKLocation if gamestate.whiteTurn else gamestate.bKLocation
+            highlights[y * 8 + x] += ('check',)
+        if len(mouse_history) == 1:
+            x, y = mouse_history[0]
+            highlights[y * 8 + x] += ('selected',)
+            for move in suggested_moves:
+                highlights[move.end_row * 8 + move.end_col] += ('move',)
+        return highlights
+
+    def draw(self, gamestate, mouse_history, suggested_moves):
+        """ redraws the squares that changed since the last call and updates
+        only their part of the display """
+        highlights = self.square_highlights(gamestate, mouse_history, suggested_moves)
+        dirty = []
+        for sq in range(64):
+            y, x = divmod(sq, 8)
+            looks = (gamestate.gameboard[y][x], highlights[sq])
+            if looks == self.drawn[sq]:
+                continue
+            self.drawn[sq] = looks
+            rect = py.Rect(x * SQR_SIZE, y * SQR_SIZE, SQR_SIZE, SQR_SIZE)
+            self.screen.blit(self.board, rect, rect)
+            for highlight in highlights[sq]:
+                self.screen.blit(self.highlights[highlight], rect)
+            for text, text_rect in self.labels.get(sq, ()):
+                self.screen.blit(text, text_rect)
+            if looks[0] != '--':
+                self.screen.blit(IMAGES[looks[0]], rect)
+            dirty.append(rect)
+        if dirty:
+            py.display.update(dirty)
 
 
 if __name__ == '__main__':
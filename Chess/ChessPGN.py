@@ -0,0 +1,265 @@
+""" The ChessPGN module reads games in Portable Game Notation (PGN) and
+replays them through a GameState. Every step is a generator, so a file is
+read one game at a time and even archives of many gigabytes never have to
+fit in memory:
+    read_games      splits a file into (headers, movetext) tuples
+    tokenize        splits movetext into SAN moves, skipping comments,
+                    variations, move numbers and annotations
+    replay          plays the moves with parse_san and move_piece and
+                    yields the position before every move
+    iter_games      combines them and yields a Game per game in the file
+process_games runs a function on every game of a file in a process pool,
+sending the games to the workers in chunks.
+
+usage:
+    python ChessPGN.py games.pgn                    replay every game
+    python ChessPGN.py games.pgn --processes 4      replay in 4 processes
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import re
+import time
+import ChessEngine
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+# a SAN move: piece, start file and rank (to tell two pieces apart), capture, end square, promotion
+SAN_PATTERN = re.compile(r'^([NBRQK])?([a-h])?([1-8])?(x)?([a-h][1-8])(?:=?([NBRQ]))?$')
+TOKEN_PATTERN = re.compile(r'\{[^}]*\}|;[^\n]*|\(|\)|\$\d+|[^\s(){};]+')
+MOVE_NUMBER_PATTERN = re.compile(r'^\d+\.*')
+HEADER_PATTERN = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+
+
+class Game(object):
+    """ The Game class holds one replayed game: its headers (a dict of the
+    tag pairs), the moves as Move() objects, the result and the position
+    at the end. If a move could not be read, error holds the reason and
+    moves stops before it, gamestate is then the position the game got to.
+    If the FEN header is not a valid position, gamestate is None. """
+
+    def __init__(self, headers, moves, result, gamestate, error=None):
+        self.headers = headers
+        self.moves = moves
+        self.result = result
+        self.gamestate = gamestate
+        self.error = error
+
+
+def parse_san(gamestate, san):
+    """ returns the legal Move() of the position that the SAN string
+    describes (ex. Nf3, exd5, O-O, e8=Q+), raises a ValueError if no move
+    or more than one move matches """
+    san = san.rstrip('+#!?')
+    valid_moves = gamestate.get_valid_moves()
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        end_col = 6 if len(san) == 3 else 2
+        matches = [move for move in valid_moves if move.isCastle and move.end_col == end_col]
+    else:
+        match = SAN_PATTERN.match(san)
+        if match is None:
+            raise ValueError(f'invalid SAN move: {san!r}')
+        piece, from_file, from_rank, _, square, promotion = match.groups()
+        piece = piece or 'P'
+        end_row, end_col = 8 - int(square[1]), ord(square[0]) - ord('a')
+        matches = [move for move in valid_moves
+                   if move.pieceMoved[1] == piece and move.end_row == end_row and move.end_col == end_col
+                   and (from_file is None or move.start_col == ord(from_file) - ord('a'))
+                   and (from_rank is None or move.start_row == 8 - int(from_rank))
+                   and (not move.isPawnPromotion or move.promotion_piece == (promotion or 'Q'))]
+    if len(matches) != 1:
+        problem = 'illegal' if not matches else 'ambiguous'
+        raise ValueError(f'{problem} move {san!r} in position {gamestate.to_fen()}')
+    return matches[0]
+
+
+def move_to_san(gamestate, move):
+    """ returns the move in standard algebraic notation (ex. Nbd2, exd5,
+    O-O, e8=Q+). move must be legal in the position of gamestate. """
+    if move.isCastle:
+        san = 'O-O' if move.end_col == 6 else 'O-O-O'
+    else:
+        end_square = move.get_rank_file(move.end_row, move.end_col)
+        piece = move.pieceMoved[1]
+        if piece == 'P':
+            san = end_square
+            if move.pieceCaptured != '--':
+                san = ChessEngine.Move.y_to_rank[move.start_col] + 'x' + san
+            if move.isPawnPromotion:
+                san += '=' + move.promotion_piece
+        else:
+            # add the start file, rank or both if another piece of the same type can go there too
+            others = [other for other in gamestate.get_valid_moves()
+                      if other.pieceMoved == move.pieceMoved and other.end_row == move.end_row
+                      and other.end_col == move.end_col
+                      and (other.start_row, other.start_col) != (move.start_row, move.start_col)]
+            disambiguation = ''
+            if others:
+                if all(other.start_col != move.start_col for other in others):
+                    disambiguation = ChessEngine.Move.y_to_rank[move.start_col]
+                elif all(other.start_row != move.start_row for other in others):
+                    disambiguation = str(8 - move.start_row)
+                else:
+                    disambiguation = move.get_rank_file(move.start_row, move.start_col)
+            san = piece + disambiguation + ('x' if move.pieceCaptured != '--' else '') + end_square
+    gamestate.move_piece(move)
+    if gamestate.in_check():
+        san += '#' if not gamestate.get_valid_moves() else '+'
+    gamestate.undo_move()
+    return san
+
+
+def read_games(lines):
+    """ yields a (headers, movetext) tuple for every game in lines, which
+    can be an open file or any other iterable of lines """
+    headers = {}
+    movetext = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            if movetext:    # a header after the moves starts the next game
+                yield headers, '\n'.join(movetext)
+                headers, movetext = {}, []
+            match = HEADER_PATTERN.match(line)
+            if match is not None:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"')
+        elif line and not line.startswith('%'):  # lines starting with % are escaped
+            movetext.append(line)
+    if headers or movetext:
+        yield headers, '\n'.join(movetext)
+
+
+def tokenize(movetext):
+    """ yields the SAN moves and the result of the movetext of a game,
+    skipping comments, variations, move numbers and annotation glyphs """
+    depth = 0   # how many variations we are inside
+    for token in TOKEN_PATTERN.findall(movetext):
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth = max(0, depth - 1)
+        elif depth or token[0] in '{;$':
+            continue
+        elif token in RESULTS:
+            yield token
+        else:
+            # remove move numbers such as 12. or 12... also when written as 12.e4,
+            # castling written with zeros (0-0) has no dot and is left alone
+            if not token.startswith('0-'):
+                token = MOVE_NUMBER_PATTERN.sub('', token)
+            if token:
+                yield token
+
+
+def replay(movetext, fen=ChessEngine.STARTING_FEN):
+    """ plays the moves of the movetext from the position fen and yields
+    (gamestate, move) before every move, then (gamestate, None) for the
+    final position. The same GameState is yielded every time and changes
+    after the caller asks for the next item; use to_fen() to keep a
+    position. A move that can not be read raises a ValueError. """
+    yield from _replay_from(ChessEngine.GameState.from_fen(fen), movetext)
+
+
+def _replay_from(gamestate, movetext):
+    """ plays the moves of the movetext on gamestate, see replay() """
+    for token in tokenize(movetext):
+        if token in RESULTS:
+            break
+        move = parse_san(gamestate, token)
+        yield gamestate, move
+        gamestate.move_piece(move)
+    yield gamestate, None
+
+
+def replay_game(headers, movetext):
+    """ replays a game read by read_games and returns a Game """
+    # games from a set-up position store it in the FEN header
+    fen = headers.get('FEN', ChessEngine.STARTING_FEN)
+    moves = []
+    result = headers.get('Result', '*')
+    try:
+        gamestate = ChessEngine.GameState.from_fen(fen)
+    except ValueError as error:
+        return Game(headers, moves, result, None, str(error))
+    try:
+        # the moves are played on gamestate, so it holds the last position reached if one fails
+        for gamestate, move in _replay_from(gamestate, movetext):
+            if move is not None:
+                moves.append(move)
+    except ValueError as error:
+        return Game(headers, moves, result, gamestate, str(error))
+    return Game(headers, moves, result, gamestate)
+
+
+def iter_games(path):
+    """ yields a Game for every game of a PGN file, reading it lazily """
+    with open(path, encoding='utf-8', errors='replace') as file:
+        for headers, movetext in read_games(file):
+            yield replay_game(headers, movetext)
+
+
+def iter_positions(path):
+    """ yields (gamestate, move) for every move of every game of a PGN
+    file, see replay(). Games with a move that can not be read are
+    cut off at that move. """
+    with open(path, encoding='utf-8', errors='replace') as file:
+        for headers, movetext in read_games(file):
+            try:
+                yield from replay(movetext, headers.get('FEN', ChessEngine.STARTING_FEN))
+            except ValueError:
+                continue
+
+
+def _process_chunk(args):
+    function, chunk = args
+    return [function(replay_game(headers, movetext)) for headers, movetext in chunk]
+
+
+def game_summary(game):
+    """ the default function of process_games, only small results should
+    be sent back from the workers so it does not return the Game itself """
+    return len(game.moves), game.error
+
+
+def process_games(path, function=game_summary, processes=None, chunk_size=64):
+    """ yields function(game) for every game of a PGN file, replaying the
+    games in a pool of processes. The file is still read lazily in the
+    main process and sent to the workers chunk_size games at a time, so
+    at most a few chunks per worker are in memory. function must be
+    defined at the top level of a module so it can be pickled. The results
+    come back in the order of the games. With processes=1 no pool is
+    started. """
+    with open(path, encoding='utf-8', errors='replace') as file:
+        games = read_games(file)
+        chunks = iter(lambda: list(itertools.islice(games, chunk_size)), [])
+        if processes == 1:
+            for chunk in chunks:
+                yield from _process_chunk((function, chunk))
+            return
+        with multiprocessing.Pool(processes) as pool:
+            for results in pool.imap(_process_chunk, ((function, chunk) for chunk in chunks)):
+                yield from results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the games of a PGN file through the chess engine.')
+    parser.add_argument('path', help='the PGN file')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes (default: 1)')
+    parser.add_argument('--chunk-size', type=int, default=64, help='games sent to a worker at a time')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    games = positions = errors = 0
+    for moves, error in process_games(args.path, processes=args.processes, chunk_size=args.chunk_size):
+        games += 1
+        positions += moves
+        if error is not None:
+            errors += 1
+            print(f'game {games}: {error}')
+    elapsed = time.perf_counter() - start
+    print(f'{games} games, {positions} moves, {errors} with errors in {elapsed:.3f}s '
+          f'({positions / max(elapsed, 1e-9):.0f} moves/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+""" The ChessParallel module spreads perft and the search over a pool of
+processes, one Python process can only use one core. Both split the work
+at the root: every task is a position plus a short list of moves to play
+from it, and the pool hands the tasks out one at a time (imap_unordered
+with a chunk size of 1), so a process that finishes a small subtree
+takes the next task while another is still busy with a big one.
+
+A task holds the position as a GameState.snapshot() and the moves as
+Move.encode() numbers, not a pickled GameState with its whole move log.
+A search task also holds the Zobrist keys of the positions since the last
+capture or pawn move, so the workers see repetitions of the game too.
+
+The search runs iterative deepening in the main process. Depth 1 is
+searched there too, it is quick and gives the first best move. At every
+deeper depth the best move of the last depth is searched first with a full window,
+then the other moves are searched in parallel with a null window around
+its score, which only tells if a move is better. The few moves that are
+better are searched again with a full window.
+
+usage:
+    python ChessParallel.py perft --depth 5 --processes 8
+    python ChessParallel.py search --fen "<fen>" --time 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+import ChessEngine
+import ChessPerft
+import ChessSearch
+import ChessTransposition
+from ChessSearch import INFINITY, MAX_PLY, MATE_SCORE, SearchResult
+
+_searcher = None    # the Searcher of a worker process, kept between tasks for its transposition table
+
+
+def _play(gamestate, codes):
+    """ plays the moves (Move.encode() numbers) and returns them as Move() objects """
+    moves = []
+    for code in codes:
+        move = ChessEngine.Move.decode(code, gamestate.gameboard)
+        gamestate.move_piece(move)
+        moves.append(move)
+    return moves
+
+
+def _undo(gamestate, count):
+    for i in range(count):
+        gamestate.undo_move()
+
+
+def split_moves(gamestate, depth, min_tasks):
+    """ returns the move sequences perft of depth is split into: the root
+    moves, or the sequences of two or more moves if there are fewer root
+    moves than min_tasks. Sequences that end in checkmate or stalemate are
+    left out, there are no positions below them. """
+    paths = [()]
+    while len(paths) < min_tasks and len(paths[0]) < depth - 1:
+        longer = []
+        for path in paths:
+            _play(gamestate, path)
+            longer += [path + (move.encode(),) for move in gamestate.get_valid_moves()]
+            _undo(gamestate, len(path))
+        if not longer:
+            break
+        paths = longer
+    return paths
+
+
+def _perft_task(task):
+    snapshot, path, depth = task
+    gamestate = ChessEngine.GameState.from_snapshot(snapshot)
+    _play(gamestate, path)
+    return path[0], ChessPerft.perft(gamestate, depth - len(path))
+
+
+def parallel_divide(gamestate, depth, processes=None):
+    """ returns the perft count below every root move, keyed by the move
+    in long algebraic notation, counted by a pool of processes """
+    if depth < 1:
+        raise ValueError('divide needs a depth of at least 1')
+    root_moves = {move.encode(): move.get_uci() for move in gamestate.get_valid_moves()}
+    results = {uci: 0 for uci in root_moves.values()}
+    if not results:     # checkmate or stalemate, there is nothing to split
+        return results
+    if depth == 1:
+        return {uci: 1 for uci in results}
+    snapshot = gamestate.snapshot()
+    # several tasks per process, so the big subtrees can be balanced by the small ones
+    paths = [path for path in split_moves(gamestate, depth, 8 * (processes or os.cpu_count() or 1)) if path]
+    with multiprocessing.Pool(processes) as pool:
+        tasks = ((snapshot, path, depth) for path in paths)
+        for code, nodes in pool.imap_unordered(_perft_task, tasks, chunksize=1):
+            results[root_moves[code]] += nodes
+    return results
+
+
+def parallel_perft(gamestate, depth, processes=None):
+    """ returns the number of positions reached after depth moves, counted
+    by a pool of processes """
+    if depth == 0:
+        return 1
+    return sum(parallel_divide(gamestate, depth, processes).values())
+
+
+def _init_worker(hash_mb):
+    global _searcher
+    _searcher = ChessSearch.Searcher(ChessTransposition.TranspositionTable(hash_mb))
+
+
+def _recent_history(gamestate):
+    """ returns the Zobrist keys a repetition of the position can be
+    found in: the ones since the last capture or pawn move """
+    history = gamestate.zobristHistory
+    return tuple(history[len(history) - min(gamestate.halfmoveClock, len(history)):])
+
+
+def _search_task(task):
+    """ searches one root move, returns (move code, score or None if the
+    time ran out, pv as move codes, nodes) """
+    snapshot, history, code, depth, alpha, beta, deadline, search_id = task
+    time_limit = None
+    if deadline is not None:
+        time_limit = deadline - time.time()
+        if time_limit <= 0:
+            return code, None, [], 0
+    gamestate = ChessEngine.GameState.from_snapshot(snapshot)
+    gamestate.zobristHistory = list(history)
+    move = ChessEngine.Move.decode(code, gamestate.gameboard)
+    outcome = _searcher.search_root_move(gamestate, move, depth, alpha, beta, time_limit, search_id)
+    if outcome is None:
+        return code, None, [], _searcher.nodes
+    score, pv = outcome
+    return code, score, [pv_move.encode() for pv_move in pv], _searcher.nodes
+
+
+class ParallelSearcher(object):
+    """ The ParallelSearcher class searches like ChessSearch.Searcher with
+    the root moves split over a pool of processes. Every process keeps its
+    own transposition table of hash_mb megabytes. Close it (or use it in a
+    with statement) to stop the processes.
+    """
+
+    def __init__(self, processes=None, hash_mb=16):
+        self.pool = multiprocessing.Pool(processes, _init_worker, (hash_mb,))
+        self.searcher = ChessSearch.Searcher(ChessTransposition.TranspositionTable(hash_mb))    # for depth 1
+        self.nodes = 0
+        self.searches = 0   # with the depth it tells the workers when a new search starts
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, tasks):
+        """ runs the search tasks and returns {move code: (score, pv codes)},
+        or None if the time ran out before every task finished """
+        results = {}
+        timed_out = False
+        for code, score, pv, nodes in self.pool.imap_unordered(_search_task, tasks, chunksize=1):
+            self.nodes += nodes
+            if score is None:
+                timed_out = True    # the other tasks are still collected, they stop at the same deadline
+            else:
+                results[code] = score, pv
+        return None if timed_out else results
+
+    def _search_depth(self, snapshot, history, order, depth, deadline):
+        """ returns (score, pv codes, move order for the next depth) or None if the time ran out """
+        # every task of this depth shares the id, so the tables of the workers age once per depth
+        search_id = (self.searches, depth)
+        first = self._run([(snapshot, history, order[0], depth, -INFINITY, INFINITY, deadline, search_id)])
+        if first is None:
+            return None
+        best_score, best_pv = first[order[0]]
+        # a null window only tells if a move is better than the first one
+        scouts = self._run([(snapshot, history, code, depth, best_score, best_score + 1, deadline, search_id)
+                            for code in order[1:]])
+        if scouts is None:
+            return None
+        better = [code for code, (score, pv) in scouts.items() if score > best_score]
+        if better:
+            results = self._run([(snapshot, history, code, depth, best_score, INFINITY, deadline, search_id)
+                                 for code in better])
+            if results is None:
+                return None
+            for code, (score, pv) in results.items():
+                if score > best_score:
+                    best_score, best_pv = score, pv
+        # the best move first, then the moves that were better than the old best, then the rest
+        next_order = [best_pv[0]] + [code for code in better + order if code != best_pv[0]]
+        return best_score, best_pv, list(dict.fromkeys(next_order))
+
+    def search(self, gamestate, depth=None, time_limit=None, callback=None):
+        """ searches the position and returns a SearchResult, with the same
+        arguments as Searcher.search """
+        if depth is None:
+            depth = MAX_PLY if time_limit is not None else 4
+        start = time.perf_counter()
+        deadline = time.time() + time_limit if time_limit is not None else None
+        self.nodes = 0
+        self.searches += 1
+        moves = gamestate.get_valid_moves()
+        result = SearchResult(moves[0] if moves else None, 0, moves[:1], 0, 0, 0.0)
+        if len(moves) <= 1:  # nothing to search
+            return result
+
+        # without a good first move nearly every move would beat it and be searched twice
+        result = self.searcher.search(gamestate, depth=1, time_limit=time_limit)
+        self.nodes = result.nodes
+        if callback is not None:
+            callback(result)
+        if abs(result.score) >= MATE_SCORE - MAX_PLY:
+            return result
+        snapshot = gamestate.snapshot()
+        history = _recent_history(gamestate)
+        best_code = result.best_move.encode()
+        order = [best_code] + [move.encode() for move in moves if move.encode() != best_code]
+        for current_depth in range(2, min(depth, MAX_PLY) + 1):
+            outcome = self._search_depth(snapshot, history, order, current_depth, deadline)
+            if outcome is None:
+                break
+            score, pv_codes, order = outcome
+            pv = _play(gamestate, pv_codes)
+            _undo(gamestate, len(pv))
+            result = SearchResult(pv[0], score, pv, current_depth, self.nodes, time.perf_counter() - start)
+            if callback is not None:
+                callback(result)
+            if abs(score) >= MATE_SCORE - MAX_PLY:  # found a mate, searching deeper will not change it
+                break
+        result.nodes = self.nodes
+        result.elapsed = time.perf_counter() - start
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run perft or a search on several processes.')
+    parser.add_argument('command', choices=('perft', 'divide', 'search'))
+    parser.add_argument('--fen', default=ChessEngine.STARTING_FEN, help='the position (default: the starting position)')
+    parser.add_argument('--depth', type=int, default=None, help='number of moves to look ahead')
+    parser.add_argument('--time', type=float, default=None, help='seconds to search')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--hash', type=int, default=16, help='transposition table size of every process in MB')
+    args = parser.parse_args()
+
+    gamestate = ChessEngine.GameState.from_fen(args.fen)
+    start = time.perf_counter()
+    if args.command == 'search':
+        def report(result):
+            pv = ' '.join(move.get_uci() for move in result.pv)
+            print(f'depth {result.depth} score {result.score} nodes {result.nodes} pv {pv}', flush=True)
+
+        with ParallelSearcher(args.processes, args.hash) as searcher:
+            result = searcher.search(gamestate, args.depth, args.time, report)
+        print(f'bestmove {result.best_move.get_uci() if result.best_move else "(none)"} '
+              f'in {time.perf_counter() - start:.3f}s')
+        return
+    depth = args.depth if args.depth is not None else 3
+    if args.command == 'divide':
+        results = parallel_divide(gamestate, depth, args.processes)
+        for name in sorted(results):
+            print(f'{name}: {results[name]}')
+        nodes = sum(results.values())
+    else:
+        nodes = parallel_perft(gamestate, depth, args.processes)
+    elapsed = time.perf_counter() - start
+    print(f'depth {depth}: {nodes} nodes in {elapsed:.3f}s ({nodes / max(elapsed, 1e-9):.0f} nodes/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+""" The ChessPerft module counts every position the engine can reach after
+a number of moves (perft). Comparing the counts with well known reference
+numbers tests that the move generator follows the rules, and the time it
+takes gives the speed of the engine in nodes per second.
+
+usage:
+    python ChessPerft.py --depth 4                  perft of the starting position
+    python ChessPerft.py --fen "<fen>" --depth 3 --divide
+    python ChessPerft.py --suite                    run the reference positions
+"""
+
+import argparse
+import sys
+import time
+import ChessEngine
+
+# reference positions as (name, fen, node counts for depth 1, 2, 3, ...)
+SUITE = [
+    ('initial position', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+     [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     [48, 2039, 97862, 4085603]),
+    ('rook endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     [14, 191, 2812, 43238, 674624]),
+    ('promotions and castling', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     [6, 264, 9467, 422333]),
+    ('promotion with check', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     [44, 1486, 62379, 2103487]),
+    # en passant, castling and promotion edge cases
+    ('illegal en passant, rook pin', '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1',
+     [18, 92, 1670, 10138, 185429, 1134888]),
+    ('illegal en passant, bishop pin', '8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1',
+     [13, 102, 1266, 10276, 135655, 1015133]),
+    ('en passant gives check', '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1',
+     [15, 126, 1928, 13931, 206379, 1440467]),
+    ('short castle gives check', '5k2/8/8/8/8/8/8/4K2R w K - 0 1',
+     [15, 66, 1198, 6399, 120330, 661072]),
+    ('long castle gives check', '3k4/8/8/8/8/8/8/R3K3 w Q - 0 1',
+     [16, 71, 1286, 7418, 141077, 803711]),
+    ('castle rights', 'r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1',
+     [26, 1141, 27826, 1274206]),
+    ('castling prevented', 'r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1',
+     [44, 1494, 50509, 1720476]),
+    ('promote out of check', '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1',
+     [11, 133, 1442, 19174, 266199, 3821001]),
+    ('discovered check', '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1',
+     [29, 165, 5160, 31961, 1004658]),
+    ('promote to give check', '4k3/1P6/8/8/8/8/K7/8 w - - 0 1',
+     [9, 40, 472, 2661, 38983, 217342]),
+    ('underpromote to give check', '8/P1k5/K7/8/8/8/8/8 w - - 0 1',
+     [6, 27, 273, 1329, 18135, 92683]),
+    ('self stalemate', 'K1k5/8/P7/8/8/8/8/8 w - - 0 1',
+     [2, 6, 13, 63, 382, 2217]),
+    ('stalemate and checkmate', '8/k1P5/8/1K6/8/8/8/8 w - - 0 1',
+     [10, 25, 268, 926, 10857, 43261, 567584]),
+    ('stalemate and checkmate, black', '8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1',
+     [37, 183, 6559, 23527]),
+]
+
+
+def perft(gamestate, depth):
+    """ returns the number of positions reached after depth moves. The
+    moves of the last ply are only counted, not played (bulk counting),
+    since get_valid_moves only returns legal moves.
+    """
+    if depth == 0:
+        return 1
+    moves = gamestate.get_valid_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        gamestate.move_piece(move)
+        nodes += perft(gamestate, depth - 1)
+        gamestate.undo_move()
+    return nodes
+
+
+def divide(gamestate, depth):
+    """ returns the perft count below every root move, keyed by the move
+    in long algebraic notation. Comparing it with another engine shows
+    which move a wrong count comes from.
+    """
+    results = {}
+    for move in gamestate.get_valid_moves():
+        gamestate.move_piece(move)
+        results[move.get_uci()] = perft(gamestate, depth - 1)
+        gamestate.undo_move()
+    return results
+
+
+def run_perft(fen, depth, show_divide=False):
+    """ runs perft on a position and prints the nodes and nodes per second """
+    gamestate = ChessEngine.GameState.from_fen(fen)
+    start = time.perf_counter()
+    if show_divide:
+        results = divide(gamestate, depth)
+        for name in sorted(results):
+            print(f'{name}: {results[name]}')
+        nodes = sum(results.values())
+    else:
+        nodes = perft(gamestate, depth)
+    elapsed = time.perf_counter() - start
+    print(f'depth {depth}: {nodes} nodes in {elapsed:.3f}s ({nodes / max(elapsed, 1e-9):.0f} nodes/s)')
+    return nodes
+
+
+def run_suite(max_depth, max_nodes):
+    """ runs every reference position up to max_depth, skipping the depths
+    with more than max_nodes positions. Returns True if every count matches.
+    """
+    passed = True
+    total_nodes = 0
+    total_time = 0.0
+    for name, fen, counts in SUITE:
+        for depth, expected in enumerate(counts[:max_depth], 1):
+            if expected > max_nodes:
+                break
+            gamestate = ChessEngine.GameState.from_fen(fen)
+            start = time.perf_counter()
+            nodes = perft(gamestate, depth)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+            result = 'ok' if nodes == expected else f'FAILED (expected {expected})'
+            print(f'{name}, depth {depth}: {nodes} nodes in {elapsed:.3f}s {result}')
+            passed = passed and nodes == expected
+    print(f'total: {total_nodes} nodes in {total_time:.3f}s ({total_nodes / max(total_time, 1e-9):.0f} nodes/s)')
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count and time the moves of the chess engine.')
+    parser.add_argument('--fen', default=ChessEngine.STARTING_FEN, help='position to search (default: the starting position)')
+    parser.add_argument('--depth', type=int, default=3, help='number of moves to look ahead')
+    parser.add_argument('--divide', action='store_true', help='show the node count of every root move')
+    parser.add_argument('--suite', action='store_true', help='check the counts of the reference positions')
+    parser.add_argument('--max-nodes', type=int, default=200000,
+                        help='skip suite depths with more nodes than this')
+    args = parser.parse_args()
+
+    if args.suite:
+        if not run_suite(args.depth, args.max_nodes):
+            sys.exit(1)
+    else:
+        run_perft(args.fen, args.depth, args.divide)
+
+
+if __name__ == '__main__':
+    main()
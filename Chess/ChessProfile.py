@@ -0,0 +1,179 @@
+""" The ChessProfile module counts how often the hot parts of ChessEngine
+are called and how long they take, without an outside profiler. A
+Profiler replaces the methods with counting versions while it is enabled
+and puts the originals back when it is disabled, so the engine runs at
+full speed when nothing is measured.
+
+Times are inclusive: the time of get_valid_moves also holds the time of
+the move generators it calls.
+
+usage:
+    python ChessProfile.py --depth 4                  profile a perft of the starting position
+    python ChessProfile.py --fen "<fen>" --depth 3 --output stats.json
+
+    profiler = ChessProfile.Profiler()
+    with profiler:
+        searcher.search(gamestate, depth=4)
+    print(profiler.to_json())
+"""
+
+import argparse
+import functools
+import json
+import time
+import ChessEngine
+import ChessPerft
+
+# the methods that are measured, as (class, method name)
+INSTRUMENTED = [
+    (ChessEngine.GameState, 'get_possible_moves'),
+    (ChessEngine.GameState, 'get_valid_moves'),
+    (ChessEngine.GameState, '_generate_pawn_moves'),
+    (ChessEngine.GameState, '_generate_knight_moves'),
+    (ChessEngine.GameState, '_generate_bishop_moves'),
+    (ChessEngine.GameState, '_generate_rook_moves'),
+    (ChessEngine.GameState, '_generate_queen_moves'),
+    (ChessEngine.GameState, '_generate_king_moves'),
+    (ChessEngine.GameState, 'get_enpassant_moves'),
+    (ChessEngine.GameState, 'get_castle_moves'),
+    (ChessEngine.GameState, 'square_under_attack'),
+    (ChessEngine.GameState, '_square_attacked'),
+    (ChessEngine.GameState, '_attackers'),
+    (ChessEngine.GameState, 'in_check'),
+    (ChessEngine.GameState, 'move_piece'),
+    (ChessEngine.GameState, 'undo_move'),
+    (ChessEngine.Move, '__init__'),
+]
+
+_enabled_profiler = None    # only one profiler can replace the methods at a time
+
+
+class Profiler(object):
+    """ The Profiler class keeps a call count and a total time for every
+    instrumented method. If sample_callback is given, it is called with
+    stats() about every sample_interval seconds while the profiler is
+    enabled, so the numbers can be scraped while a search runs.
+    """
+
+    def __init__(self, sample_interval=None, sample_callback=None):
+        if (sample_callback is None) != (sample_interval is None) or sample_interval is not None and sample_interval <= 0:
+            raise ValueError('sampling needs a callback and an interval above 0 seconds')
+        self.sample_interval = sample_interval
+        self.sample_callback = sample_callback
+        self.next_sample = float('inf')
+        self.counters = {}  # 'Class.method' -> [calls, seconds]
+        self.originals = []     # (class, method name, original function) while enabled
+        self.elapsed = 0.0  # seconds the profiler was enabled, before the current run
+        self.started = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def is_enabled(self):
+        return self.started is not None
+
+    def enable(self):
+        """ replaces the instrumented methods with counting versions """
+        global _enabled_profiler
+        if _enabled_profiler is self:
+            return
+        if _enabled_profiler is not None:
+            raise RuntimeError('another profiler is already enabled')
+        _enabled_profiler = self
+        for cls, name in INSTRUMENTED:
+            function = cls.__dict__[name]
+            self.originals.append((cls, name, function))
+            setattr(cls, name, self._wrap(f'{cls.__name__}.{name}', function))
+        self.started = time.perf_counter()
+        if self.sample_callback is not None:
+            self.next_sample = self.started + self.sample_interval
+
+    def disable(self):
+        """ puts the original methods back, the numbers are kept """
+        global _enabled_profiler
+        if _enabled_profiler is not self:
+            return
+        for cls, name, function in self.originals:
+            setattr(cls, name, function)
+        self.originals = []
+        self.elapsed += time.perf_counter() - self.started
+        self.started = None
+        self.next_sample = float('inf')
+        _enabled_profiler = None
+
+    def reset(self):
+        """ sets every number back to zero """
+        for counter in self.counters.values():
+            counter[0] = 0
+            counter[1] = 0.0
+        self.elapsed = 0.0
+        if self.started is not None:
+            self.started = time.perf_counter()
+
+    def _wrap(self, name, function):
+        counter = self.counters.setdefault(name, [0, 0.0])
+        clock = time.perf_counter
+
+        @functools.wraps(function)
+        def counting(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = clock()
+                counter[0] += 1
+                counter[1] += end - start
+                if end >= self.next_sample:
+                    self.next_sample = end + self.sample_interval
+                    self.sample_callback(self.stats())
+        return counting
+
+    def stats(self):
+        """ returns the numbers as a dict:
+            {'elapsed': seconds enabled,
+             'methods': {'GameState.move_piece': {'calls': n, 'seconds': t}, ...}}
+        methods that were never called are left out """
+        elapsed = self.elapsed
+        if self.started is not None:
+            elapsed += time.perf_counter() - self.started
+        return {'elapsed': elapsed,
+                'methods': {name: {'calls': calls, 'seconds': seconds}
+                            for name, (calls, seconds) in sorted(self.counters.items()) if calls}}
+
+    def to_json(self, indent=2):
+        return json.dumps(self.stats(), indent=indent)
+
+    def report(self):
+        """ returns the numbers as a table, the slowest method first """
+        methods = self.stats()['methods']
+        lines = [f'{"method":<36}{"calls":>12}{"seconds":>10}{"us/call":>10}']
+        for name, numbers in sorted(methods.items(), key=lambda item: -item[1]['seconds']):
+            per_call = numbers['seconds'] / numbers['calls'] * 1e6
+            lines.append(f'{name:<36}{numbers["calls"]:>12}{numbers["seconds"]:>10.3f}{per_call:>10.2f}')
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile the move generator with a perft run.')
+    parser.add_argument('--fen', default=ChessEngine.STARTING_FEN, help='the position (default: the starting position)')
+    parser.add_argument('--depth', type=int, default=3, help='number of moves to look ahead')
+    parser.add_argument('--output', help='write the numbers to this JSON file')
+    args = parser.parse_args()
+
+    profiler = Profiler()
+    with profiler:
+        gamestate = ChessEngine.GameState.from_fen(args.fen)
+        nodes = ChessPerft.perft(gamestate, args.depth)
+    print(f'depth {args.depth}: {nodes} nodes')
+    print(profiler.report())
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(profiler.to_json())
+
+
+if __name__ == '__main__':
+    main()
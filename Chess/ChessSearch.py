@@ -0,0 +1,350 @@
+""" The ChessSearch module lets the computer pick a move. It searches the
+moves of a GameState with negamax alpha-beta, one depth at a time
+(iterative deepening), until it reaches the requested depth or runs out
+of time. Alpha-beta only cuts off a lot of the tree if the best moves are
+searched first, so the moves are ordered by the best move of the last
+iteration or the transposition table, then captures, then killer moves
+and the history heuristic. The positions at the end of the search are
+scored by ChessEval.evaluate.
+"""
+
+import time
+import ChessTablebase
+import ChessTransposition
+from ChessEval import PIECE_VALUES, evaluate
+from ChessTransposition import EXACT, LOWER_BOUND, UPPER_BOUND
+
+MATE_SCORE = 100000
+INFINITY = 1000000
+MAX_PLY = 64
+
+
+def move_key(move):
+    """ returns a 16-bit number that identifies a move within a position,
+    it is used to recognize the same move in lists generated at different
+    times and to store moves in the transposition table """
+    return move.encode()
+
+
+def score_to_table(score, ply):
+    """ mate scores count plies from the root, the table stores them
+    counted from the position itself so they are valid in any search """
+    if score >= MATE_SCORE - MAX_PLY:
+        return score + ply
+    if score <= -MATE_SCORE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score >= MATE_SCORE - MAX_PLY:
+        return score - ply
+    if score <= -MATE_SCORE + MAX_PLY:
+        return score + ply
+    return score
+
+
+def tablebase_score(result, plies, ply):
+    """ turns a tablebase result into a search score, a won position is
+    scored like a mate found by the search """
+    if result == ChessTablebase.WIN:
+        return MATE_SCORE - ply - plies
+    if result == ChessTablebase.LOSS:
+        return -MATE_SCORE + ply + plies
+    return 0
+
+
+class SearchTimeout(Exception):
+    """ raised inside the search when the time runs out or stop() is called """
+    pass
+
+
+class SearchResult(object):
+    """ The SearchResult class holds what a search found: the best move,
+    its score in centipawns (from the point of view of the side to move),
+    the principal variation and how much work the search did.
+    """
+
+    def __init__(self, best_move, score, pv, depth, nodes, elapsed):
+        self.best_move = best_move
+        self.score = score
+        self.pv = pv    # a list of Move() objects, starting with best_move
+        self.depth = depth  # the last depth that was fully searched
+        self.nodes = nodes
+        self.elapsed = elapsed  # seconds
+        self.nps = int(nodes / elapsed) if elapsed > 0 else 0
+
+
+class Searcher(object):
+    """ The Searcher class keeps the move ordering tables between searches
+    and runs the iterative deepening loop. A search can be limited by
+    depth, by time or both; stop() ends a running search from another
+    thread, and the result of the last finished depth is returned. With
+    an opening book (a ChessBook.OpeningBook) the book move is played
+    without searching while the game is still in the book, and with
+    endgame tablebases (a ChessTablebase.Tablebases) positions with few
+    pieces are looked up instead of searched.
+    """
+
+    def __init__(self, table=None, book=None, tablebases=None):
+        # the transposition table is kept between searches, pass one in to choose its size
+        self.table = table if table is not None else ChessTransposition.TranspositionTable()
+        self.book = book
+        self.tablebases = tablebases
+        self.killers = [[None, None] for i in range(MAX_PLY)]  # two quiet moves per ply that caused a cutoff
+        self.history = {}   # move_key() of quiet moves -> how often they caused a cutoff
+        self.nodes = 0
+        self.stopped = False
+        self.deadline = None
+        self.search_id = None   # the search_id of the last search_root_move
+
+    def stop(self):
+        self.stopped = True
+
+    def search(self, gamestate, depth=None, time_limit=None, callback=None):
+        """ searches the position and returns a SearchResult. depth is the
+        maximum depth in plies and time_limit the maximum time in seconds,
+        if neither is given the search goes to depth 4. callback is called
+        with the SearchResult of every depth as soon as it is finished.
+        A stop() or set_time_limit() from another thread that comes before
+        the search starts still applies to it.
+        """
+        if depth is None:
+            depth = MAX_PLY if time_limit is not None else 4
+        self.killers = [[None, None] for i in range(MAX_PLY)]
+        self.history = {}
+        self.nodes = 0
+        self.table.new_search()
+        start = time.perf_counter()
+        if time_limit is not None:
+            self.deadline = start + time_limit
+        try:
+            return self._iterate(gamestate, depth, start, callback)
+        finally:
+            # a stop() or a deadline set while pondering only applies to this search
+            self.stopped = False
+            self.deadline = None
+
+    def set_time_limit(self, time_limit):
+        """ gives the running (or next) search time_limit seconds from now,
+        a search started without a time limit, for example to ponder on the
+        opponent's time, is stopped by the deadline from then on """
+        self.deadline = time.perf_counter() + time_limit
+
+    def search_root_move(self, gamestate, move, depth, alpha=-INFINITY, beta=INFINITY, time_limit=None,
+                         search_id=None):
+        """ searches a single root move to depth and returns (score, pv)
+        with the score from the point of view of the side to move, or None
+        if the time ran out. The score is only exact inside the window
+        (alpha, beta), like in _negamax. This lets the root moves of a
+        search be split between processes (see ChessParallel). The root
+        moves of one search should pass the same search_id, the table only
+        starts a new search (and ages its entries) when the id changes. """
+        self.nodes = 0
+        if search_id is None or search_id != self.search_id:
+            self.table.new_search()
+            self.search_id = search_id
+        if time_limit is not None:
+            self.deadline = time.perf_counter() + time_limit
+        gamestate.move_piece(move)
+        try:
+            score, pv = self._negamax(gamestate, depth - 1, -beta, -alpha, 1, [])
+        except SearchTimeout:
+            return None
+        finally:
+            gamestate.undo_move()
+            self.stopped = False
+            self.deadline = None
+        return -score, [move] + pv
+
+    def _iterate(self, gamestate, depth, start, callback):
+        if self.book is not None:
+            book_move = self.book.choose_move(gamestate)
+            if book_move is not None:
+                return SearchResult(book_move, 0, [book_move], 0, 0, time.perf_counter() - start)
+        if self.tablebases is not None:
+            entry = self.tablebases.best_move(gamestate)
+            if entry is not None:
+                move, result, plies = entry
+                return SearchResult(move, tablebase_score(result, plies, 0), [move], 0, 0,
+                                    time.perf_counter() - start)
+
+        moves = gamestate.get_valid_moves()
+        result = SearchResult(moves[0] if moves else None, 0, moves[:1], 0, 0, 0.0)
+        if len(moves) <= 1:  # nothing to search
+            return result
+
+        pv = []
+        for current_depth in range(1, min(depth, MAX_PLY) + 1):
+            try:
+                score, pv = self._search_root(gamestate, moves, current_depth, pv)
+            except SearchTimeout:
+                break
+            result = SearchResult(pv[0], score, pv, current_depth, self.nodes, time.perf_counter() - start)
+            if callback is not None:
+                callback(result)
+            if abs(score) >= MATE_SCORE - MAX_PLY:  # found a mate, searching deeper will not change it
+                break
+        result.nodes = self.nodes
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def _search_root(self, gamestate, moves, depth, pv):
+        """ searches every root move to depth and returns the best score
+        and principal variation. The moves are searched in place, the best
+        one is moved to the front so the next iteration starts with it. """
+        alpha, beta = -INFINITY, INFINITY
+        best_pv = pv
+        self._order_moves(moves, move_key(pv[0]) if pv else None, 0)
+        for i, move in enumerate(moves):
+            gamestate.move_piece(move)
+            try:
+                score, child_pv = self._negamax(gamestate, depth - 1, -beta, -alpha, 1, pv[1:] if i == 0 else [])
+            finally:
+                gamestate.undo_move()
+            score = -score
+            if score > alpha:
+                alpha = score
+                best_pv = [move] + child_pv
+        return alpha, best_pv
+
+    def _negamax(self, gamestate, depth, alpha, beta, ply, pv):
+        """ returns the score of the position and its principal variation.
+        A score of beta or more means the opponent will avoid this line
+        (beta cutoff), so the rest of the moves do not need searching. """
+        self._count_node()
+        # a position seen before on the way here (or in the game) can be
+        # repeated forever by either side, so it is a draw
+        if gamestate.halfmoveClock >= 100 or gamestate.is_repetition():
+            return 0, []
+        if self.tablebases is not None:
+            occupied = gamestate.occupancy['w'] | gamestate.occupancy['b']
+            if bin(occupied).count('1') <= ChessTablebase.MAX_PIECES:
+                entry = self.tablebases.probe(gamestate)
+                if entry is not None:
+                    return tablebase_score(entry[0], entry[1], ply), []
+        if depth <= 0:
+            return self._quiescence(gamestate, alpha, beta, ply), []
+
+        # a result stored for this position can end the search here if it
+        # was searched at least as deep and its bound fits the window
+        key = gamestate.zobristKey
+        entry = self.table.probe(key)
+        hash_move = pv_key = move_key(pv[0]) if pv else None
+        if entry is not None:
+            entry_depth, bound, score, hash_move = entry
+            if entry_depth >= depth and not pv:
+                score = score_from_table(score, ply)
+                if bound == EXACT:
+                    return score, []
+                if bound == LOWER_BOUND and score >= beta:
+                    return beta, []
+                if bound == UPPER_BOUND and score <= alpha:
+                    return alpha, []
+            if pv_key is not None:
+                hash_move = pv_key
+
+        moves = gamestate.get_valid_moves()
+        if len(moves) == 0:
+            if gamestate.in_check():
+                return -MATE_SCORE + ply, []   # checkmate, prefer the quickest mate
+            return 0, []    # stalemate
+        if ply >= MAX_PLY - 1:
+            return evaluate(gamestate), []
+
+        self._order_moves(moves, hash_move, ply)
+        best_pv = []
+        original_alpha = alpha
+        for i, move in enumerate(moves):
+            gamestate.move_piece(move)
+            try:
+                score, child_pv = self._negamax(gamestate, depth - 1, -beta, -alpha, ply + 1,
+                                                pv[1:] if i == 0 else [])
+            finally:
+                gamestate.undo_move()
+            score = -score
+            if score >= beta:
+                if move.pieceCaptured == '--' and not move.isPawnPromotion:
+                    self._store_killer(move, ply, depth)
+                self.table.store(key, depth, LOWER_BOUND, score_to_table(beta, ply), move_key(move))
+                return beta, []
+            if score > alpha:
+                alpha = score
+                best_pv = [move] + child_pv
+        if alpha > original_alpha:
+            self.table.store(key, depth, EXACT, score_to_table(alpha, ply), move_key(best_pv[0]))
+        else:
+            self.table.store(key, depth, UPPER_BOUND, score_to_table(alpha, ply))
+        return alpha, best_pv
+
+    def _quiescence(self, gamestate, alpha, beta, ply):
+        """ keeps searching captures and promotions after the depth runs out,
+        so the search does not stop in the middle of an exchange. The side
+        to move may also stand pat and take the static evaluation. """
+        stand_pat = evaluate(gamestate)
+        if stand_pat >= beta:
+            return beta
+        alpha = max(alpha, stand_pat)
+        if ply >= MAX_PLY - 1:
+            return alpha
+
+        captures = [move for move in gamestate.get_valid_moves()
+                    if move.pieceCaptured != '--' or move.isPawnPromotion]
+        captures.sort(key=self._capture_order, reverse=True)
+        for move in captures:
+            self._count_node()
+            gamestate.move_piece(move)
+            try:
+                score = -self._quiescence(gamestate, -beta, -alpha, ply + 1)
+            finally:
+                gamestate.undo_move()
+            if score >= beta:
+                return beta
+            alpha = max(alpha, score)
+        return alpha
+
+    def _count_node(self):
+        """ counts a node and checks the clock every 1024 nodes """
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            if self.stopped or (self.deadline is not None and time.perf_counter() >= self.deadline):
+                self.stopped = True
+        if self.stopped:
+            raise SearchTimeout()
+
+    @staticmethod
+    def _capture_order(move):
+        """ most valuable victim, least valuable attacker (MVV-LVA) """
+        score = 10 * PIECE_VALUES[move.pieceCaptured[1]] if move.pieceCaptured != '--' else 0
+        if move.isPawnPromotion:
+            score += PIECE_VALUES[move.promotion_piece]
+        return score - PIECE_VALUES[move.pieceMoved[1]] // 10
+
+    def _order_moves(self, moves, best_key, ply):
+        """ sorts the moves best first: the move from the principal variation
+        or the transposition table (best_key), captures by MVV-LVA, the
+        killer moves of this ply, then the other quiet moves by their
+        history score """
+        killers = self.killers[ply]
+        history = self.history
+
+        def order(move):
+            key = move_key(move)
+            if key == best_key:
+                return 3000000
+            if move.pieceCaptured != '--' or move.isPawnPromotion:
+                return 2000000 + self._capture_order(move)
+            if key == killers[0] or key == killers[1]:
+                return 1000000
+            return history.get(key, 0)
+
+        moves.sort(key=order, reverse=True)
+
+    def _store_killer(self, move, ply, depth):
+        """ remembers a quiet move that caused a beta cutoff, it will be
+        tried early in the sibling positions and anywhere else it is legal """
+        key = move_key(move)
+        if self.killers[ply][0] != key:
+            self.killers[ply][1] = self.killers[ply][0]
+            self.killers[ply][0] = key
+        self.history[key] = self.history.get(key, 0) + depth * depth
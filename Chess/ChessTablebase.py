@@ -0,0 +1,527 @@
+""" The ChessTablebase module builds and reads endgame tablebases: tables
+with the result of every position of an ending with a few pieces (KQK,
+KRK, KPK, KBNK, ...) under perfect play, and how many plies it takes to
+mate (DTM).
+
+The tables are built backwards from the checkmates (retrograde analysis).
+Every legal move of every position is counted once; then, one ply at a
+time, a position with a move to a lost position is won, and a position
+whose moves all lead to won positions is lost. Captures and promotions
+leave the table and take the result from the smaller table they lead to,
+so the tables of an ending are built after the tables it can turn into.
+Positions that are never resolved are draws.
+
+A table is stored in one file per material signature (ex. KQvK.ctb), with
+the white pieces before the v and the black pieces after it:
+    bytes 0-3    magic b'CTB1'
+    bytes 4-19   signature, padded with zeros
+    then         2 bits per position: draw, win or loss for the side
+                 to move, or illegal
+    then         1 byte per position: plies to mate
+A position is numbered by the side to move and the square of every piece,
+so a probe is one lookup in each part of the file. Positions with castle
+rights or a possible en passant capture are not in the tables.
+
+usage:
+    python ChessTablebase.py generate KQvK KRvK KPvK --directory tables
+    python ChessTablebase.py probe --directory tables --fen "<fen>"
+"""
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import time
+import ChessEngine
+from ChessEngine import (KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, ROOK_RAYS, BISHOP_RAYS,
+                         ROOK_LINES, BISHOP_LINES, sliding_attacks)
+
+# the result of a position for the side to move
+DRAW = 0
+WIN = 1
+LOSS = 2
+ILLEGAL = 3
+
+MAGIC = b'CTB1'
+HEADER_SIZE = 20
+EXTENSION = '.ctb'
+MAX_PIECES = 4
+PIECE_ORDER = 'KQRBNP'
+PIECE_VALUES = {'K': 0, 'Q': 9, 'R': 5, 'B': 3, 'N': 3, 'P': 1}
+PROMOTION_PIECES = 'QRBN'
+
+
+def _side_key(pieces):
+    return sum(PIECE_VALUES[piece] for piece in pieces), pieces
+
+
+def is_insufficient(signature):
+    """ a side with a lone king can not lose, and a single knight or
+    bishop can not mate, so these endings are draws without a table """
+    white, black = signature.split('v')
+    return len(white) + len(black) <= 3 and (white + black).strip('K') in ('', 'B', 'N')
+
+
+def canonical_position(pieces, white_to_move):
+    """ turns a list of (piece, sq) tuples into (signature, index) for the
+    table that holds the position. The side with more material is played
+    by white in the tables, so the colors may be swapped (and the board
+    mirrored) to find it. """
+    white = ''.join(sorted((piece[1] for piece, sq in pieces if piece[0] == 'w'), key=PIECE_ORDER.index))
+    black = ''.join(sorted((piece[1] for piece, sq in pieces if piece[0] == 'b'), key=PIECE_ORDER.index))
+    if _side_key(black) > _side_key(white):
+        pieces = [(('w' if piece[0] == 'b' else 'b') + piece[1], sq ^ 56) for piece, sq in pieces]
+        white, black = black, white
+        white_to_move = not white_to_move
+    order = {piece: i for i, piece in enumerate(_slots(white + 'v' + black))}
+    pieces = sorted(pieces, key=lambda entry: (order[entry[0]], entry[1]))
+    index = 0 if white_to_move else 1
+    for piece, sq in pieces:
+        index = index * 64 + sq
+    return white + 'v' + black, index
+
+
+def _slots(signature):
+    """ the pieces of a table in the order their squares are numbered """
+    white, black = signature.split('v')
+    return ['w' + piece for piece in white] + ['b' + piece for piece in black]
+
+
+def table_dependencies(signature):
+    """ returns the signatures a capture or promotion in the ending can lead to """
+    slots = _slots(signature)
+    result = set()
+    for i, piece in enumerate(slots):
+        if piece[1] == 'K':
+            continue
+        rest = slots[:i] + slots[i + 1:]    # the piece is captured
+        result.add(canonical_position([(p, sq) for sq, p in enumerate(rest)], True)[0])
+        if piece[1] == 'P':
+            for promotion in PROMOTION_PIECES:
+                promoted = slots[:i] + [piece[0] + promotion] + slots[i + 1:]
+                result.add(canonical_position([(p, sq) for sq, p in enumerate(promoted)], True)[0])
+    return {dependency for dependency in result if not is_insufficient(dependency)}
+
+
+class Tablebases(object):
+    """ The Tablebases class reads the tables in a directory. A table file
+    is opened with mmap the first time it is needed, so only the pages
+    that are probed are ever read from disk.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}    # signature -> mmap, or None if there is no file
+
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+        self.tables = {}
+
+    def _table(self, signature):
+        if signature not in self.tables:
+            path = os.path.join(self.directory, signature + EXTENSION)
+            table = None
+            if os.path.exists(path):
+                with open(path, 'rb') as file:
+                    table = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if table[:4] != MAGIC:
+                    table.close()
+                    raise ValueError(f'{path} is not a tablebase file')
+            self.tables[signature] = table
+        return self.tables[signature]
+
+    def probe_index(self, signature, index):
+        """ returns (result, plies to mate) of a position by table index,
+        or None if the table is not in the directory """
+        if is_insufficient(signature):
+            return DRAW, 0
+        table = self._table(signature)
+        if table is None:
+            return None
+        size = 2 * 64 ** len(_slots(signature))
+        result = table[HEADER_SIZE + (index >> 2)] >> ((index & 3) * 2) & 3
+        return result, table[HEADER_SIZE + (size + 3) // 4 + index]
+
+    def probe(self, gamestate):
+        """ returns (result, plies to mate) for the side to move, where
+        result is DRAW, WIN or LOSS, or None if the position is not in
+        the tables """
+        occupied = gamestate.occupancy['w'] | gamestate.occupancy['b']
+        if bin(occupied).count('1') > MAX_PIECES or gamestate.castleRights:
+            return None
+        if gamestate.enpassantSquare:
+            row, col = gamestate.enpassantSquare
+            color = 'w' if gamestate.whiteTurn else 'b'
+            opponent = 'b' if gamestate.whiteTurn else 'w'
+            # an en passant capture is possible if one of our pawns attacks the square
+            if PAWN_ATTACKS[opponent][row * 8 + col] & gamestate.bitboards[color + 'P']:
+                return None
+        pieces = []
+        for piece, bb in gamestate.bitboards.items():
+            while bb:
+                bit = bb & -bb
+                bb ^= bit
+                pieces.append((piece, bit.bit_length() - 1))
+        signature, index = canonical_position(pieces, gamestate.whiteTurn)
+        entry = self.probe_index(signature, index)
+        if entry is None or entry[0] == ILLEGAL:
+            return None
+        return entry
+
+    def best_move(self, gamestate):
+        """ returns (move, result, plies to mate) with the move that wins
+        fastest, or draws, or loses slowest, or None if the position is
+        not in the tables """
+        entry = self.probe(gamestate)
+        if entry is None:
+            return None
+        best = None
+        best_order = None
+        for move in gamestate.get_valid_moves():
+            gamestate.move_piece(move)
+            reply = self.probe(gamestate)
+            gamestate.undo_move()
+            if reply is None:
+                continue
+            result, plies = reply
+            # the result of the reply is for the opponent
+            if result == LOSS:
+                order = (2, -plies)
+            elif result == DRAW:
+                order = (1, 0)
+            else:
+                order = (0, plies)
+            if best_order is None or order > best_order:
+                best, best_order = move, order
+        if best is None:
+            return None
+        return best, entry[0], entry[1]
+
+
+class TableGenerator(object):
+    """ The TableGenerator class builds the table of one material
+    signature. The moves are generated with the attack tables of
+    ChessEngine on plain lists of squares, since a table has millions of
+    positions and building a GameState for each would take too long.
+    The tables of the endings that captures and promotions lead to must
+    already be in the directory.
+    """
+
+    def __init__(self, signature, directory):
+        self.signature = signature
+        self.slots = _slots(signature)
+        self.colors = [piece[0] for piece in self.slots]
+        self.types = [piece[1] for piece in self.slots]
+        self.count = len(self.slots)
+        self.size = 2 * 64 ** self.count
+        self.kings = {'w': self.slots.index('wK'), 'b': self.slots.index('bK')}
+        self.tablebases = Tablebases(directory)
+        self.directory = directory
+
+    def decode(self, index):
+        squares = [0] * self.count
+        for i in range(self.count - 1, -1, -1):
+            index, squares[i] = divmod(index, 64)
+        return index == 0, squares     # white to move, squares
+
+    def encode(self, white_to_move, squares):
+        index = 0 if white_to_move else 1
+        for sq in squares:
+            index = index * 64 + sq
+        return index
+
+    def attacked(self, sq, color, squares, occupied):
+        """ determines if a piece of color attacks sq """
+        for i in range(self.count):
+            if self.colors[i] != color or squares[i] < 0:
+                continue
+            piece, from_sq = self.types[i], squares[i]
+            if piece == 'K':
+                hit = KING_ATTACKS[from_sq] >> sq & 1
+            elif piece == 'N':
+                hit = KNIGHT_ATTACKS[from_sq] >> sq & 1
+            elif piece == 'P':
+                hit = PAWN_ATTACKS[color][from_sq] >> sq & 1
+            else:
+                hit = 0
+                if piece in 'RQ' and ROOK_LINES[from_sq] >> sq & 1:
+                    hit = sliding_attacks(from_sq, occupied, ROOK_RAYS) >> sq & 1
+                if not hit and piece in 'BQ' and BISHOP_LINES[from_sq] >> sq & 1:
+                    hit = sliding_attacks(from_sq, occupied, BISHOP_RAYS) >> sq & 1
+            if hit:
+                return True
+        return False
+
+    def is_legal(self, white_to_move, squares):
+        """ two pieces on a square, a pawn on the first or last rank or the
+        side that just moved left in check make a position illegal """
+        if len(set(squares)) != self.count:
+            return False
+        for piece, sq in zip(self.types, squares):
+            if piece == 'P' and (sq < 8 or sq >= 56):
+                return False
+        occupied = sum(1 << sq for sq in squares)
+        mover = 'b' if white_to_move else 'w'
+        return not self.attacked(squares[self.kings[mover]], 'w' if white_to_move else 'b', squares, occupied)
+
+    def in_check(self, white_to_move, squares):
+        color = 'w' if white_to_move else 'b'
+        opponent = 'b' if white_to_move else 'w'
+        occupied = sum(1 << sq for sq in squares if sq >= 0)
+        return self.attacked(squares[self.kings[color]], opponent, squares, occupied)
+
+    def moves(self, white_to_move, squares):
+        """ yields (slot, to_sq, captured slot or -1, promotion piece or '')
+        for every legal move """
+        color = 'w' if white_to_move else 'b'
+        occupied = 0
+        own = 0
+        for i, sq in enumerate(squares):
+            occupied |= 1 << sq
+            if self.colors[i] == color:
+                own |= 1 << sq
+        enemies = occupied & ~own
+        opponent = 'b' if white_to_move else 'w'
+        king = squares[self.kings[color]]
+        for i in range(self.count):
+            if self.colors[i] != color:
+                continue
+            piece, from_sq = self.types[i], squares[i]
+            if piece == 'K':
+                targets = KING_ATTACKS[from_sq] & ~own
+            elif piece == 'N':
+                targets = KNIGHT_ATTACKS[from_sq] & ~own
+            elif piece == 'P':
+                step = -8 if color == 'w' else 8
+                targets = PAWN_ATTACKS[color][from_sq] & enemies
+                if not occupied >> (from_sq + step) & 1:
+                    targets |= 1 << (from_sq + step)
+                    start_row = 6 if color == 'w' else 1
+                    if from_sq // 8 == start_row and not occupied >> (from_sq + 2 * step) & 1:
+                        targets |= 1 << (from_sq + 2 * step)
+            else:
+                targets = 0
+                if piece in 'RQ':
+                    targets |= sliding_attacks(from_sq, occupied, ROOK_RAYS)
+                if piece in 'BQ':
+                    targets |= sliding_attacks(from_sq, occupied, BISHOP_RAYS)
+                targets &= ~own
+            while targets:
+                bit = targets & -targets
+                targets ^= bit
+                to_sq = bit.bit_length() - 1
+                captured = squares.index(to_sq) if enemies & bit else -1
+                new_squares = list(squares)
+                new_squares[i] = to_sq
+                if captured >= 0:
+                    new_squares[captured] = -1
+                # the move is legal if it does not leave our king attacked
+                king_sq = to_sq if piece == 'K' else king
+                if self.attacked(king_sq, opponent, new_squares, occupied & ~(1 << from_sq) | bit):
+                    continue
+                if piece == 'P' and (to_sq < 8 or to_sq >= 56):
+                    for promotion in PROMOTION_PIECES:
+                        yield i, to_sq, captured, promotion
+                else:
+                    yield i, to_sq, captured, ''
+
+    def predecessors(self, white_to_move, squares):
+        """ yields the index of every position with a quiet move (not a
+        capture or promotion) to this one """
+        mover = 'b' if white_to_move else 'w'
+        occupied = sum(1 << sq for sq in squares)
+        empty = ~occupied
+        for i in range(self.count):
+            if self.colors[i] != mover:
+                continue
+            piece, sq = self.types[i], squares[i]
+            if piece == 'K':
+                sources = KING_ATTACKS[sq] & empty
+            elif piece == 'N':
+                sources = KNIGHT_ATTACKS[sq] & empty
+            elif piece == 'P':
+                # the pawn came from behind, one square or two from its first square
+                step = 8 if mover == 'w' else -8
+                sources = 0
+                back = sq + step
+                if 8 <= back < 56 and not occupied >> back & 1:
+                    sources |= 1 << back
+                    if sq // 8 == (4 if mover == 'w' else 3) and not occupied >> (back + step) & 1:
+                        sources |= 1 << (back + step)
+            else:
+                sources = 0
+                if piece in 'RQ':
+                    sources |= sliding_attacks(sq, occupied, ROOK_RAYS)
+                if piece in 'BQ':
+                    sources |= sliding_attacks(sq, occupied, BISHOP_RAYS)
+                sources &= empty
+            while sources:
+                bit = sources & -sources
+                sources ^= bit
+                new_squares = list(squares)
+                new_squares[i] = bit.bit_length() - 1
+                yield self.encode(not white_to_move, new_squares)
+
+    def _exit_result(self, white_to_move, squares, slot, to_sq, captured, promotion):
+        """ returns (result, plies) for the opponent after a capture or promotion """
+        pieces = []
+        for i, sq in enumerate(squares):
+            if i == captured:
+                continue
+            if i == slot:
+                pieces.append((self.colors[i] + (promotion or self.types[i]), to_sq))
+            else:
+                pieces.append((self.slots[i], sq))
+        signature, index = canonical_position(pieces, not white_to_move)
+        entry = self.tablebases.probe_index(signature, index)
+        if entry is None:
+            raise FileNotFoundError(f'the {signature} table is needed to build {self.signature}')
+        return entry
+
+    def generate(self):
+        """ builds the table and returns it as (results, plies) bytearrays,
+        one entry per position index """
+        results = bytearray(self.size)  # DRAW until proven otherwise
+        plies = bytearray(self.size)
+        move_counts = bytearray(self.size)
+        resolved = bytearray(self.size)
+        exit_wins = {}  # ply -> positions with a capture or promotion that wins in that many plies
+        exit_losses = {}    # ply -> positions with a capture or promotion that loses in that many plies
+        lost, won = [], []
+
+        # count the moves of every position and find the checkmates
+        for index in range(self.size):
+            white_to_move, squares = self.decode(index)
+            if not self.is_legal(white_to_move, squares):
+                results[index] = ILLEGAL
+                resolved[index] = 1
+                continue
+            count = 0
+            for slot, to_sq, captured, promotion in self.moves(white_to_move, squares):
+                count += 1
+                if captured < 0 and not promotion:
+                    continue
+                result, distance = self._exit_result(white_to_move, squares, slot, to_sq, captured, promotion)
+                if result == LOSS:
+                    exit_wins.setdefault(distance + 1, []).append(index)
+                elif result == WIN:
+                    exit_losses.setdefault(distance + 1, []).append(index)
+            move_counts[index] = count
+            if count == 0:
+                resolved[index] = 1
+                if self.in_check(white_to_move, squares):
+                    results[index] = LOSS
+                    lost.append(index)
+
+        # one ply at a time, resolve the positions that reach the positions resolved at the last ply
+        ply = 0
+        last_ply = max(list(exit_wins) + list(exit_losses) + [0])
+        while lost or won or ply < last_ply:
+            ply += 1
+            new_lost, new_won = [], []
+            wins = [predecessor for index in lost for predecessor in self.predecessors(*self.decode(index))]
+            for index in wins + exit_wins.pop(ply, []):
+                if not resolved[index]:
+                    resolved[index] = 1
+                    results[index] = WIN
+                    plies[index] = ply
+                    new_won.append(index)
+            losses = [predecessor for index in won for predecessor in self.predecessors(*self.decode(index))]
+            for index in losses + exit_losses.pop(ply, []):
+                if not resolved[index]:
+                    move_counts[index] -= 1
+                    if move_counts[index] == 0:
+                        resolved[index] = 1
+                        results[index] = LOSS
+                        plies[index] = ply
+                        new_lost.append(index)
+            lost, won = new_lost, new_won
+        return results, plies
+
+    def write(self, results, plies):
+        path = os.path.join(self.directory, self.signature + EXTENSION)
+        packed = bytearray((self.size + 3) // 4)
+        for index, result in enumerate(results):
+            if result:
+                packed[index >> 2] |= result << ((index & 3) * 2)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(MAGIC + self.signature.encode().ljust(HEADER_SIZE - len(MAGIC), b'\0'))
+            file.write(packed)
+            file.write(plies)
+        os.replace(path + '.tmp', path)    # readers never see a half written table
+        return path
+
+
+def _build_table(args):
+    signature, directory = args
+    start = time.perf_counter()
+    generator = TableGenerator(signature, directory)
+    results, plies = generator.generate()
+    generator.write(results, plies)
+    generator.tablebases.close()
+    longest = max(plies)
+    return signature, time.perf_counter() - start, longest
+
+
+def generate_tables(signatures, directory, processes=None, overwrite=False, report=print):
+    """ builds the tables of the signatures and of every ending they can
+    turn into. Tables that do not depend on each other are built at the
+    same time in a pool of processes. """
+    os.makedirs(directory, exist_ok=True)
+    needed = set()
+    todo = [canonical_position([(piece, sq) for sq, piece in enumerate(_slots(signature))], True)[0]
+            for signature in signatures]
+    while todo:
+        signature = todo.pop()
+        if len(_slots(signature)) > MAX_PIECES:
+            raise ValueError(f'{signature} has more than {MAX_PIECES} pieces')
+        if signature not in needed and not is_insufficient(signature):
+            needed.add(signature)
+            todo.extend(table_dependencies(signature))
+    if not overwrite:
+        needed = {signature for signature in needed
+                  if not os.path.exists(os.path.join(directory, signature + EXTENSION))}
+
+    # build in rounds, each round holds the tables whose dependencies are all built
+    built = set()
+    while needed:
+        ready = sorted(signature for signature in needed if not (table_dependencies(signature) & needed))
+        with multiprocessing.Pool(min(processes or os.cpu_count(), len(ready))) as pool:
+            for signature, elapsed, longest in pool.imap_unordered(_build_table, [(s, directory) for s in ready]):
+                report(f'{signature}: built in {elapsed:.1f}s, longest mate {longest} plies')
+        needed -= set(ready)
+        built |= set(ready)
+    return sorted(built)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or probe endgame tablebases.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='build tables')
+    generate.add_argument('signatures', nargs='+', help='endings to build (ex. KQvK KRvK KPvK)')
+    generate.add_argument('--directory', default='tablebases', help='where the tables are stored')
+    generate.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    generate.add_argument('--overwrite', action='store_true', help='build tables that already exist again')
+    probe = commands.add_parser('probe', help='look up a position')
+    probe.add_argument('--directory', default='tablebases', help='where the tables are stored')
+    probe.add_argument('--fen', required=True, help='the position')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate_tables(args.signatures, args.directory, args.processes, args.overwrite)
+    else:
+        tablebases = Tablebases(args.directory)
+        gamestate = ChessEngine.GameState.from_fen(args.fen)
+        entry = tablebases.best_move(gamestate)
+        if entry is None:
+            print('position not in the tables')
+        else:
+            move, result, plies = entry
+            print(f'{("draw", "win", "loss")[result]}, mate in {plies} plies, best move {move.get_uci()}'
+                  if result != DRAW else f'draw, best move {move.get_uci()}')
+
+
+if __name__ == '__main__':
+    main()
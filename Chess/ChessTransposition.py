@@ -0,0 +1,106 @@
+""" The ChessTransposition module stores search results by the Zobrist key
+of the position, so a position reached again through a different move
+order (a transposition) does not have to be searched twice.
+
+The table has a fixed size set in MB and is stored in two flat arrays of
+64-bit numbers that are allocated once, so its memory does not grow
+during long searches. Every slot holds the key of its position and one
+packed number:
+    bits  0-31  score + 2 ** 31
+    bits 32-39  depth
+    bits 40-41  bound type
+    bits 42-47  age (the search it was stored in, modulo 64)
+    bits 48-63  best move (see Move.encode)
+"""
+
+from array import array
+
+# the kind of score stored in an entry
+EXACT = 0   # the score is exact
+LOWER_BOUND = 1     # the search failed high, the score is at least this
+UPPER_BOUND = 2     # the search failed low, the score is at most this
+
+ENTRY_SIZE = 16     # bytes per entry, 8 for the key and 8 for the packed data
+SCORE_OFFSET = 1 << 31
+
+
+class TranspositionTable(object):
+    """ The TranspositionTable class is a fixed-size hash table of search
+    results. The replacement policy decides what happens when two positions
+    want the same slot:
+        'depth'  - keep the deeper search, unless the stored entry is from
+                   an older search (depth-preferred with aging)
+        'always' - the newest entry always replaces the old one
+    """
+
+    def __init__(self, size_mb=16, policy='depth'):
+        if policy not in ('depth', 'always'):
+            raise ValueError(f'unknown replacement policy: {policy}')
+        self.policy = policy
+        # round the number of slots down to a power of two, so a slot can be
+        # found by masking the key instead of a modulo
+        entries = max(1, size_mb * 1024 * 1024 // ENTRY_SIZE)
+        self.size = 1 << (entries.bit_length() - 1)
+        self.mask = self.size - 1
+        self.keys = array('Q', bytes(8 * self.size))
+        self.data = array('Q', bytes(8 * self.size))  # 0 marks an empty slot
+        self.age = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.overwrites = 0     # entries of another position that were replaced
+
+    def new_search(self):
+        """ starts a new search, entries from older searches are replaced first """
+        self.age = (self.age + 1) & 63
+
+    def clear(self):
+        """ empties the table and resets the counters """
+        self.keys = array('Q', bytes(8 * self.size))
+        self.data = array('Q', bytes(8 * self.size))
+        self.age = 0
+        self.hits = self.misses = self.stores = self.overwrites = 0
+
+    def probe(self, key):
+        """ returns (depth, bound, score, move) stored for the position, or
+        None if the position is not in the table """
+        index = key & self.mask
+        data = self.data[index]
+        if data and self.keys[index] == key:
+            self.hits += 1
+            return ((data >> 32) & 0xFF, (data >> 40) & 0x3,
+                    (data & 0xFFFFFFFF) - SCORE_OFFSET, data >> 48)
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, bound, score, move=0):
+        """ stores a search result, the replacement policy decides if it
+        may take the slot from the entry already stored there """
+        index = key & self.mask
+        old = self.data[index]
+        if old:
+            same_position = self.keys[index] == key
+            if self.policy == 'depth' and not same_position:
+                # keep a deeper entry from the current search
+                if (old >> 42) & 63 == self.age and (old >> 32) & 0xFF > depth:
+                    return
+            if same_position and not move:
+                move = old >> 48    # keep the best move we already know
+            if not same_position:
+                self.overwrites += 1
+        self.stores += 1
+        self.keys[index] = key
+        self.data[index] = ((score + SCORE_OFFSET) | min(depth, 255) << 32 | bound << 40 |
+                            self.age << 42 | move << 48)
+
+    def usage(self):
+        """ returns the fraction of slots that are in use """
+        return sum(1 for data in self.data if data) / self.size
+
+    def stats(self):
+        """ returns the counters as a dict, to tune the size of the table """
+        probes = self.hits + self.misses
+        return {'size_mb': self.size * ENTRY_SIZE / (1024 * 1024), 'entries': self.size,
+                'policy': self.policy, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / probes if probes else 0.0,
+                'stores': self.stores, 'overwrites': self.overwrites}
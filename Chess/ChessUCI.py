@@ -0,0 +1,245 @@
+""" The ChessUCI module runs the chess engine without a window. It speaks
+the Universal Chess Interface (UCI) over stdin and stdout, so chess GUIs
+and match runners can play against it. Only the engine modules are
+imported, pygame and tkinter are not needed.
+
+The search runs in a thread, so commands like stop and isready are
+answered while the engine is thinking. With go ponder the engine thinks
+on the opponent's time, until ponderhit turns the search into a normal
+one with the time limit of the go command, or stop ends it.
+
+usage:
+    python ChessUCI.py
+"""
+
+import sys
+import threading
+import ChessBook
+import ChessEngine
+import ChessSearch
+import ChessTablebase
+import ChessTransposition
+
+ENGINE_NAME = 'simple-python-chess'
+ENGINE_AUTHOR = 'Cezar Hirsescu'
+DEFAULT_HASH_MB = 16
+
+
+class UCIEngine(object):
+    """ The UCIEngine class reads UCI commands one line at a time with
+    handle() and writes the answers with output, which defaults to
+    printing to stdout.
+    """
+
+    def __init__(self, output=None):
+        self.output = output if output is not None else self._print
+        self.output_lock = threading.Lock()
+        self.gamestate = ChessEngine.GameState()
+        self.searcher = ChessSearch.Searcher(ChessTransposition.TranspositionTable(DEFAULT_HASH_MB))
+        self.search_thread = None
+        # pondering state, ponder_lock keeps ponderhit and the end of the search apart
+        self.pondering = False
+        self.ponder_time_limit = None
+        self.ponder_lock = threading.Lock()
+        self.ponder_event = threading.Event()
+        self.search_finished = False
+        self.commands = {
+            'uci': self.uci, 'isready': self.isready, 'ucinewgame': self.ucinewgame,
+            'setoption': self.setoption, 'position': self.position, 'go': self.go,
+            'ponderhit': self.ponderhit, 'stop': self.stop, 'quit': self.quit}
+
+    @staticmethod
+    def _print(line):
+        print(line, flush=True)
+
+    def send(self, line):
+        # the search thread and the main thread both write, keep their lines apart
+        with self.output_lock:
+            self.output(line)
+
+    def run(self, lines=sys.stdin):
+        """ handles commands until quit or the end of the input """
+        for line in lines:
+            if not self.handle(line):
+                break
+        self.stop()
+
+    def handle(self, line):
+        """ handles one command, returns False after quit. Unknown commands
+        are ignored, as UCI asks. """
+        words = line.split()
+        if not words:
+            return True
+        command = self.commands.get(words[0])
+        if command is None:
+            return True
+        return command(words[1:]) is not False
+
+    def uci(self, args):
+        self.send(f'id name {ENGINE_NAME}')
+        self.send(f'id author {ENGINE_AUTHOR}')
+        self.send(f'option name Hash type spin default {DEFAULT_HASH_MB} min 1 max 1024')
+        self.send('option name Ponder type check default true')
+        self.send('option name BookFile type string default <empty>')
+        self.send('option name TablebasePath type string default <empty>')
+        self.send('uciok')
+
+    def isready(self, args):
+        self.send('readyok')
+
+    def ucinewgame(self, args):
+        self.stop()
+        self.searcher.table.clear()
+        self.gamestate = ChessEngine.GameState()
+
+    def setoption(self, args):
+        # setoption name <name> value <value>
+        if 'value' not in args:
+            return
+        name = ' '.join(args[1:args.index('value')]).lower()
+        value = ' '.join(args[args.index('value') + 1:])
+        if name == 'hash' and value.isdigit():
+            self.stop()
+            self.searcher.table = ChessTransposition.TranspositionTable(max(1, int(value)))
+        elif name == 'bookfile':
+            self.stop()
+            if self.searcher.book is not None:
+                self.searcher.book.close()
+                self.searcher.book = None
+            if value and value != '<empty>':
+                try:
+                    self.searcher.book = ChessBook.OpeningBook(value)
+                except (OSError, ValueError) as error:
+                    self.send(f'info string {error}')
+        elif name == 'tablebasepath':
+            self.stop()
+            if self.searcher.tablebases is not None:
+                self.searcher.tablebases.close()
+            self.searcher.tablebases = None
+            if value and value != '<empty>':
+                self.searcher.tablebases = ChessTablebase.Tablebases(value)
+
+    def position(self, args):
+        # position [startpos | fen <fen>] [moves <move> ...]
+        self.stop()
+        moves = args.index('moves') if 'moves' in args else len(args)
+        try:
+            if args and args[0] == 'fen':
+                gamestate = ChessEngine.GameState.from_fen(' '.join(args[1:moves]))
+            else:
+                gamestate = ChessEngine.GameState()
+            for uci in args[moves + 1:]:
+                gamestate.move_piece(self._find_move(gamestate, uci))
+        except ValueError as error:
+            self.send(f'info string {error}')
+            return
+        self.gamestate = gamestate
+
+    @staticmethod
+    def _find_move(gamestate, uci):
+        for move in gamestate.get_valid_moves():
+            if move.get_uci() == uci:
+                return move
+        raise ValueError(f'illegal move {uci} in position {gamestate.to_fen()}')
+
+    def go(self, args):
+        # go [ponder] [depth <plies>] [movetime <ms>] [wtime <ms> btime <ms> winc <ms> binc <ms>] [infinite]
+        self.stop()
+        options = {}
+        for i, name in enumerate(args[:-1]):
+            if name in ('depth', 'movetime', 'wtime', 'btime', 'winc', 'binc', 'movestogo') and args[i + 1].isdigit():
+                options[name] = int(args[i + 1])
+        depth = options.get('depth')
+        time_limit = None
+        if 'movetime' in options:
+            time_limit = options['movetime'] / 1000
+        elif 'wtime' in options or 'btime' in options:
+            # use a share of the time left on the clock plus most of the increment
+            side = 'w' if self.gamestate.whiteTurn else 'b'
+            remaining = options.get(side + 'time', 0)
+            increment = options.get(side + 'inc', 0)
+            moves_to_go = options.get('movestogo', 30)
+            time_limit = max(0.01, (remaining / moves_to_go + increment * 0.8) / 1000)
+        if 'infinite' in args:  # search until stop
+            depth, time_limit = ChessSearch.MAX_PLY, None
+        self.pondering = 'ponder' in args
+        self.search_finished = False
+        self.ponder_event.clear()
+        if self.pondering:  # the clock starts at ponderhit
+            self.ponder_time_limit = time_limit
+            time_limit = None
+            if depth is None:
+                depth = ChessSearch.MAX_PLY
+        # position and go stop the search before they touch the board, so
+        # the search thread can play its moves on self.gamestate
+        self.search_thread = threading.Thread(target=self._search, args=(self.gamestate, depth, time_limit),
+                                              daemon=True)
+        self.search_thread.start()
+
+    def _search(self, gamestate, depth, time_limit):
+        result = None
+        try:
+            result = self.searcher.search(gamestate, depth, time_limit, callback=self._send_info)
+        except Exception as error:
+            self.send(f'info string search failed: {error!r}')
+        finally:
+            # every go gets a bestmove, even if the search failed, or the GUI waits for it forever
+            self._send_bestmove(result)
+
+    def _send_bestmove(self, result):
+        with self.ponder_lock:
+            self.search_finished = True
+            self.searcher.deadline = None   # a ponderhit may have come in as the search ended
+        if self.pondering:
+            # UCI does not allow a bestmove before ponderhit or stop
+            self.ponder_event.wait()
+        if result is None or result.best_move is None:
+            self.send('bestmove 0000')
+        elif len(result.pv) > 1:
+            self.send(f'bestmove {result.best_move.get_uci()} ponder {result.pv[1].get_uci()}')
+        else:
+            self.send(f'bestmove {result.best_move.get_uci()}')
+
+    def _send_info(self, result):
+        if abs(result.score) >= ChessSearch.MATE_SCORE - ChessSearch.MAX_PLY:
+            plies = ChessSearch.MATE_SCORE - abs(result.score)
+            moves = (plies + 1) // 2
+            score = f'mate {moves if result.score > 0 else -moves}'
+        else:
+            score = f'cp {result.score}'
+        pv = ' '.join(move.get_uci() for move in result.pv)
+        self.send(f'info depth {result.depth} score {score} nodes {result.nodes} nps {result.nps} '
+                  f'time {int(result.elapsed * 1000)} pv {pv}')
+
+    def ponderhit(self, args):
+        """ the opponent played the move we pondered on, the search goes on
+        as a normal search from now """
+        with self.ponder_lock:
+            if self.search_thread is None or not self.pondering:
+                return
+            self.pondering = False
+            if not self.search_finished and self.ponder_time_limit is not None:
+                self.searcher.set_time_limit(self.ponder_time_limit)
+        self.ponder_event.set()
+
+    def stop(self, args=None):
+        """ stops a running search and waits for its bestmove """
+        if self.search_thread is not None:
+            self.searcher.stop()
+            self.ponder_event.set()
+            self.search_thread.join()
+            self.pondering = False
+            self.search_thread = None
+            self.searcher.stopped = False   # the search may have finished before stop() was called
+
+    def quit(self, args):
+        self.stop()
+        return False
+
+
+def main():
+    UCIEngine().run()
+
+
+if __name__ == '__main__':
+    main()
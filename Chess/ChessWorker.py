@@ -0,0 +1,131 @@
+""" The ChessWorker module runs the engine next to a user interface. The
+engine lives in a worker process (or a thread) and is driven through two
+queues with the same text commands as the UCI engine of ChessUCI, so the
+interface sends a request and polls for the answer without ever waiting
+for the search.
+"""
+
+import multiprocessing
+import queue
+import threading
+import ChessUCI
+
+
+def _run_engine(requests, responses, hash_mb):
+    """ the body of the worker, handles commands until None or quit """
+    engine = ChessUCI.UCIEngine(output=responses.put)
+    engine.setoption(['name', 'Hash', 'value', str(hash_mb)])
+    engine.run(iter(requests.get, None))
+
+
+class EngineWorker(object):
+    """ The EngineWorker class starts the engine in a worker and keeps
+    track of the searches it asked for. request_move starts a search,
+    ponder searches the position after the move the opponent is expected
+    to play, ponderhit and cancel act on the running search, and poll
+    returns what the engine sent since the last call without blocking.
+    Every search ends with a bestmove, the ones of cancelled searches are
+    dropped by poll.
+    """
+
+    def __init__(self, use_process=True, hash_mb=16):
+        if use_process:
+            # the search gets its own process, so it never takes the CPU from the interface
+            self.requests = multiprocessing.Queue()
+            self.responses = multiprocessing.Queue()
+            self.worker = multiprocessing.Process(target=_run_engine, args=(self.requests, self.responses, hash_mb),
+                                                  daemon=True)
+        else:
+            self.requests = queue.Queue()
+            self.responses = queue.Queue()
+            self.worker = threading.Thread(target=_run_engine, args=(self.requests, self.responses, hash_mb),
+                                           daemon=True)
+        self.worker.start()
+        self.searches = []  # [kind, cancelled] of every search that has not sent its bestmove yet
+        self.ponder_move = None     # the move the running ponder search expects the opponent to play
+        self.last_info = None
+
+    @staticmethod
+    def _position(gamestate, extra_moves=()):
+        """ returns the position command of the game. Only the moves since
+        the last capture or pawn move are sent, an older position can not
+        be repeated, so the engine still sees every possible repetition. """
+        count = min(gamestate.halfmoveClock, len(gamestate.moveLog))
+        moves = gamestate.moveLog[len(gamestate.moveLog) - count:]
+        for i in range(count):
+            gamestate.undo_move()
+        fen = gamestate.to_fen()
+        for move in moves:
+            gamestate.move_piece(move)
+        ucis = [move.get_uci() for move in moves] + list(extra_moves)
+        return f'position fen {fen}' + (' moves ' + ' '.join(ucis) if ucis else '')
+
+    @staticmethod
+    def _go(time_limit, depth):
+        go = 'go'
+        if depth is not None:
+            go += f' depth {depth}'
+        if time_limit is not None:
+            go += f' movetime {int(time_limit * 1000)}'
+        return go
+
+    def is_thinking(self):
+        """ determines if the engine is searching for a move we are waiting for """
+        return any(kind == 'move' and not cancelled for kind, cancelled in self.searches)
+
+    def request_move(self, gamestate, time_limit=None, depth=None):
+        """ starts a search for the best move of the position """
+        self.cancel()
+        self.requests.put(self._position(gamestate))
+        self.requests.put(self._go(time_limit, depth))
+        self.searches.append(['move', False])
+
+    def ponder(self, gamestate, ponder_move, time_limit=None, depth=None):
+        """ searches the position after ponder_move (in UCI notation) while
+        the opponent thinks, the time limit starts at ponderhit """
+        self.cancel()
+        self.requests.put(self._position(gamestate, [ponder_move]))
+        self.requests.put(self._go(time_limit, depth).replace('go', 'go ponder', 1))
+        self.searches.append(['ponder', False])
+        self.ponder_move = ponder_move
+
+    def ponderhit(self):
+        """ the opponent played the move of the ponder search, its result
+        becomes the answer to a move request """
+        for search in self.searches:
+            if search[0] == 'ponder' and not search[1]:
+                search[0] = 'move'
+                self.requests.put('ponderhit')
+        self.ponder_move = None
+
+    def cancel(self):
+        """ stops every running search, their results are thrown away """
+        if any(not cancelled for kind, cancelled in self.searches):
+            self.requests.put('stop')
+            for search in self.searches:
+                search[1] = True
+        self.ponder_move = None
+
+    def poll(self):
+        """ returns (best move, expected reply or None) in UCI notation for
+        every move request that finished since the last call, without
+        waiting. The last info line of the search is kept in last_info. """
+        moves = []
+        while True:
+            try:
+                line = self.responses.get_nowait()
+            except queue.Empty:
+                return moves
+            if line.startswith('info'):
+                self.last_info = line
+            elif line.startswith('bestmove') and self.searches:
+                kind, cancelled = self.searches.pop(0)
+                words = line.split()
+                if kind == 'move' and not cancelled:
+                    moves.append((words[1], words[3] if len(words) > 3 else None))
+
+    def close(self):
+        """ stops the engine and its worker """
+        self.cancel()
+        self.requests.put('quit')
+        self.worker.join(timeout=1)